@@ -3,7 +3,7 @@ import numpy as np
 from scipy import stats
 from sklearn.metrics import pairwise_distances
 import scipy
-from scipy.stats import hypergeom, mannwhitneyu, linregress, norm, ttest_ind
+from scipy.stats import hypergeom, linregress, norm, ttest_ind
 #from scipy.sparse import issparse, csr_matrix
 import scipy.sparse as sps
 from statsmodels.stats.multitest import multipletests
@@ -18,6 +18,7 @@ import sys
 import pandas as pd
 from sys import exit
 import time #debugging
+import multiprocessing
 
 MIN_CONGA_SCORE = 1e-100
 
@@ -44,49 +45,50 @@ def _find_neighbor_neighbor_interactions(
 
     '''
     preprocess.add_mait_info_to_adata_obs(adata) # for annotation of overlaps
-    is_mait = adata.obs['is_invariant']
+    is_mait = adata.obs['is_invariant'].values
 
     num_clones = len(nbrs_gex)
 
     pval_rescale = num_clones if scale_pvals_by_num_clones else 1.0
 
-    results = []
-    adjusted_pvalues = [pval_rescale]*num_clones # initialize to big value
-
-    for ii in range(num_clones):
-        is_ii_group = (agroups==agroups[ii]) | (bgroups==bgroups[ii])
-        assert is_ii_group[ii]
-        actual_num_clones = num_clones - np.sum( is_ii_group ) - counts_correction
-
-        ii_nbrs_gex = nbrs_gex[ii] # might be slice of array, or list entry if use_sym_nbrs
-        ii_nbrs_tcr = nbrs_tcr[ii]
-        ii_nbrs_gex_set = frozenset( ii_nbrs_gex)
-        assert ii not in ii_nbrs_gex_set
-
-        num_neighbors_gex = len(ii_nbrs_gex)
-        num_neighbors_tcr = len(ii_nbrs_tcr)
+    # nbrs_gex/nbrs_tcr might be arrays or lists of arrays (if use_sym_nbrs)
+    gex_csr = _make_csr_nbrs_fast(nbrs_gex)
+    gex_csr.data[:] = 1 # set semantics for the gex nbrs
+    assert not np.any(gex_csr.diagonal())
+    tcr_csr = _make_csr_nbrs_fast(nbrs_tcr)
 
-        overlap = sum( 1 for x in ii_nbrs_tcr if x in ii_nbrs_gex_set )
-        expected_overlap = float( num_neighbors_gex*num_neighbors_tcr )/actual_num_clones
-        if overlap and overlap > expected_overlap:
-            nbr_pval = pval_rescale * hypergeom.sf( overlap-1, actual_num_clones, num_neighbors_gex, num_neighbors_tcr)
-        else:
-            nbr_pval = pval_rescale
+    num_neighbors_gex = np.diff(_make_nbrs_indptr(nbrs_gex))
+    num_neighbors_tcr = np.diff(_make_nbrs_indptr(nbrs_tcr))
+    overlaps = np.asarray(gex_csr.multiply(tcr_csr).sum(axis=1)).ravel()
+    del gex_csr, tcr_csr
 
-        if verbose:
-            print('nbr_overlap:', ii, overlap, nbr_pval)
+    actual_num_clones = (num_clones - _get_same_group_sizes(agroups, bgroups)
+                         - counts_correction)
 
-        adjusted_pvalues[ii] = nbr_pval
+    expected_overlaps = (num_neighbors_gex*num_neighbors_tcr).astype(float)\
+                        / actual_num_clones
+    adjusted_pvalues = np.full((num_clones,), float(pval_rescale))
+    mask = (overlaps>0) & (overlaps > expected_overlaps)
+    adjusted_pvalues[mask] = pval_rescale * _hypergeom_sf_unique(
+        overlaps[mask]-1, actual_num_clones[mask], num_neighbors_gex[mask],
+        num_neighbors_tcr[mask])
 
-        if nbr_pval > pval_threshold:
-            continue ## NOTE
+    if verbose:
+        for ii in range(num_clones):
+            print('nbr_overlap:', ii, overlaps[ii], adjusted_pvalues[ii])
 
-        double_nbrs = [ x for x in ii_nbrs_tcr if x in ii_nbrs_gex_set ]
+    results = []
+    for ii in np.nonzero(adjusted_pvalues <= pval_threshold)[0]:
+        overlap = overlaps[ii]
+        ii_nbrs_gex_set = frozenset(nbrs_gex[ii])
+        double_nbrs = [ x for x in nbrs_tcr[ii] if x in ii_nbrs_gex_set ]
         assert overlap == len(double_nbrs)
 
         if verbose:
-            print('nbr_overlap_nbrs:', ii, overlap, nbr_pval, double_nbrs)
+            print('nbr_overlap_nbrs:', ii, overlap, adjusted_pvalues[ii],
+                  double_nbrs)
 
+        nbr_pval = adjusted_pvalues[ii]
         overlap_corrected = overlap
         if correct_overlaps_for_groups:
             # this is heuristic
@@ -96,16 +98,16 @@ def _find_neighbor_neighbor_interactions(
             if overlap_corrected < overlap:
                 delta = overlap-overlap_corrected
                 nbr_pval = pval_rescale * hypergeom.sf(
-                    overlap_corrected-1, actual_num_clones,
-                    num_neighbors_gex-delta, num_neighbors_tcr-delta)
+                    overlap_corrected-1, actual_num_clones[ii],
+                    num_neighbors_gex[ii]-delta, num_neighbors_tcr[ii]-delta)
                 adjusted_pvalues[ii] = nbr_pval # update
                 if nbr_pval > pval_threshold:
                     continue ## NOTE
 
         nbr_pval = max(nbr_pval, MIN_CONGA_SCORE) # no 0s
         results.append(dict(conga_score=nbr_pval,
-                            num_neighbors_gex=num_neighbors_gex,
-                            num_neighbors_tcr=num_neighbors_tcr,
+                            num_neighbors_gex=num_neighbors_gex[ii],
+                            num_neighbors_tcr=num_neighbors_tcr[ii],
                             overlap=overlap,
                             overlap_corrected=overlap_corrected,
                             mait_fraction=np.sum(is_mait[double_nbrs])/overlap,
@@ -252,6 +254,51 @@ def _make_csr_nbrs(nbrs):
     data = np.full((len(col),), 1)
     return sps.csr_matrix((data, (row, col)), shape=(len(nbrs), len(nbrs)))
 
+def _make_nbrs_indptr(nbrs):
+    if isinstance(nbrs, np.ndarray) and nbrs.ndim == 2:
+        return np.arange(nbrs.shape[0]+1, dtype=np.int64) * nbrs.shape[1]
+    return np.concatenate([[0], np.cumsum([len(x) for x in nbrs])])
+
+def _make_csr_nbrs_fast(nbrs):
+    ''' Like _make_csr_nbrs, but built directly from the nbr arrays with
+    int32 data, and without the python row-index list. Duplicate nbrs are
+    summed, as in _make_csr_nbrs
+    '''
+    num_clones = len(nbrs)
+    indptr = _make_nbrs_indptr(nbrs)
+    if isinstance(nbrs, np.ndarray) and nbrs.ndim == 2:
+        indices = np.sort(nbrs, axis=1).ravel() # copy, faster than scipy sort
+    else:
+        indices = np.hstack(nbrs)
+    csr = sps.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, indptr),
+        shape=(num_clones, num_clones))
+    csr.has_sorted_indices = isinstance(nbrs, np.ndarray) and nbrs.ndim == 2
+    csr.sum_duplicates()
+    return csr
+
+def _hypergeom_sf_unique(k, M, n, N):
+    ''' Same as hypergeom.sf(k, M, n, N) for integer arrays, but only
+    evaluated once for each distinct (k, M, n, N), since scipy loops over
+    the elements in python. Usually there are few distinct values
+    '''
+    params = np.stack(np.broadcast_arrays(k, M, n, N))
+    if params.shape[1] == 0:
+        return np.zeros((0,))
+    unique_params, inverse = np.unique(params, axis=1, return_inverse=True)
+    return hypergeom.sf(*unique_params)[inverse.ravel()]
+
+def _get_same_group_sizes(agroups, bgroups):
+    ''' Returns an array with the number of clones (including itself) that
+    share an agroup or a bgroup with each clone
+    '''
+    asizes = np.bincount(agroups)
+    bsizes = np.bincount(bgroups)
+    _, ab_inverse, ab_sizes = np.unique(
+        np.stack([agroups, bgroups]), axis=1, return_inverse=True,
+        return_counts=True)
+    return asizes[agroups] + bsizes[bgroups] - ab_sizes[ab_inverse.ravel()]
+
 def _compute_nbr_overlap_slow(gex_nbrs, tcr_nbrs):
     overlap = 0
     for g_nbrs, t_nbrs in zip(gex_nbrs, tcr_nbrs):
@@ -259,6 +306,214 @@ def _compute_nbr_overlap_slow(gex_nbrs, tcr_nbrs):
         overlap += sum(x in g_nbrs_set for x in t_nbrs)
     return overlap
 
+def _permuted_graph_overlap(gex_csr, tcr_indptr, tcr_indices, tcr_data, p):
+    ''' The number of shared edges between the gex graph and the tcr graph
+    with its vertices renumbered by the permutation p (ie, an edge i->j
+    becomes p[i]->p[j]), counting multiplicities
+
+    gex_csr is the gex graph matrix, and tcr_indptr/indices/data are the
+    tcr graph matrix in csr format (see _make_csr_nbrs_fast). We gather the
+    permuted tcr rows directly into a new csr matrix, rather than going
+    through a COO matrix
+    '''
+    N = len(p)
+    q = np.empty_like(p)
+    q[p] = np.arange(N) # row u of the permuted graph is row q[u]
+    new_lens = np.diff(tcr_indptr)[q]
+    new_indptr = np.zeros((N+1,), dtype=np.int64)
+    np.cumsum(new_lens, out=new_indptr[1:])
+    edges = np.repeat(tcr_indptr[q] - new_indptr[:-1], new_lens)
+    edges += np.arange(len(tcr_indices))
+    M = sps.csr_matrix(
+        (tcr_data[edges], p[tcr_indices[edges]], new_indptr), shape=(N,N))
+    return int(gex_csr.multiply(M).sum())
+
+def _make_graph_edge_arrays(nbrs):
+    ''' Returns the rows and cols of all the edges of the nbr graph '''
+    indptr = _make_nbrs_indptr(nbrs)
+    rows = np.repeat(np.arange(len(nbrs), dtype=np.int32), np.diff(indptr))
+    if isinstance(nbrs, np.ndarray) and nbrs.ndim == 2:
+        cols = nbrs.ravel().astype(np.int32)
+    else:
+        cols = np.hstack(nbrs).astype(np.int32)
+    return rows, cols
+
+def _get_key_codes(*keys):
+    ''' Returns integer codes (0,1,...) for the distinct combinations of
+    the values in the equal-length integer arrays in keys
+    '''
+    codes = np.zeros((len(keys[0]),), dtype=np.int64)
+    for key in keys:
+        _, key = np.unique(key, return_inverse=True)
+        codes = codes*(key.max()+1) + key.ravel()
+        _, codes = np.unique(codes, return_inverse=True)
+        codes = codes.ravel()
+    return codes
+
+def _count_same_key_pairs(*keys):
+    ''' The number of ordered pairs i!=j that match at all the keys '''
+    counts = np.bincount(_get_key_codes(*keys)).astype(np.int64)
+    return int(np.sum(counts*(counts-1)))
+
+class _ClusterGraph:
+    ''' Implicit representation of a cluster graph, where each clone is
+    connected to all the other clones in the same cluster, except the ones
+    in the same agroup or bgroup. This is never expanded into neighbor lists,
+    which are O(N^2) for big clusters
+    '''
+    def __init__(self, clusters, agroups, bgroups):
+        self.clusters = _get_key_codes(clusters)
+        self.agroups = np.asarray(agroups)
+        self.bgroups = np.asarray(bgroups)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def degrees(self):
+        ''' the number of nbrs of each clone (same as the indegree) '''
+        c, a, b = self.clusters, self.agroups, self.bgroups
+        degrees = np.zeros((len(c),), dtype=np.int64)
+        for sign, keys in [[1, [c]], [-1, [c,a]], [-1, [c,b]], [1, [c,a,b]]]:
+            codes = _get_key_codes(*keys)
+            degrees += sign * np.bincount(codes)[codes]
+        return degrees
+
+def _permuted_nbr_cluster_overlap(
+        nbr_rows,
+        nbr_cols,
+        clusters,
+        agroups,
+        bgroups,
+        permute_clusters,
+        p,
+):
+    ''' The number of shared edges between a nbr graph (given by the
+    nbr_rows and nbr_cols of its edges) and a _ClusterGraph, with the vertices
+    of one of them renumbered by the permutation p: the cluster graph if
+    permute_clusters, otherwise the nbr graph
+
+    The cost is linear in the number of nbr graph edges
+    '''
+    if permute_clusters:
+        q = np.empty_like(p)
+        q[p] = np.arange(len(p))
+        # vertex u of the permuted cluster graph is vertex q[u]
+        clusters, agroups, bgroups = clusters[q], agroups[q], bgroups[q]
+    else:
+        nbr_rows, nbr_cols = p[nbr_rows], p[nbr_cols]
+    return int(np.sum((clusters[nbr_rows] == clusters[nbr_cols]) &
+                      (agroups[nbr_rows] != agroups[nbr_cols]) &
+                      (bgroups[nbr_rows] != bgroups[nbr_cols])))
+
+def _permuted_cluster_cluster_overlap(
+        gex_clusters,
+        gex_agroups,
+        gex_bgroups,
+        tcr_clusters,
+        tcr_agroups,
+        tcr_bgroups,
+        p,
+):
+    ''' The number of shared edges between two _ClusterGraphs, with the
+    vertices of the second renumbered by the permutation p
+
+    shared edges are pairs in the same cluster in both graphs but not in the
+    same agroup or bgroup in either graph. We count these by inclusion-
+    exclusion over the group equalities, using the cluster-cluster
+    contingency table refined by the group labels, so it's O(N)
+    '''
+    q = np.empty_like(p)
+    q[p] = np.arange(len(p))
+    tcr_clusters = tcr_clusters[q]
+    groups = [gex_agroups, gex_bgroups, tcr_agroups[q], tcr_bgroups[q]]
+    overlap = 0
+    for mask in range(16):
+        keys = [groups[i] for i in range(4) if mask & (1<<i)]
+        sign = -1 if len(keys)%2 else 1
+        overlap += sign * _count_same_key_pairs(gex_clusters, tcr_clusters,
+                                                *keys)
+    return overlap
+
+# set in each worker process by _init_graph_overlap_worker
+_graph_overlap_worker_data = None
+
+def _init_graph_overlap_worker(overlap_fn, N, overlap_fn_args):
+    global _graph_overlap_worker_data
+    _graph_overlap_worker_data = (overlap_fn, N, overlap_fn_args)
+
+def _graph_overlap_worker(seed_seq):
+    ''' Overlap for one random shuffle, using its own RNG stream '''
+    overlap_fn, N, overlap_fn_args = _graph_overlap_worker_data
+    p = np.random.default_rng(seed_seq).permutation(N)
+    return overlap_fn(*overlap_fn_args, p)
+
+def _run_graph_overlap_shuffles(
+        overlap_fn,
+        overlap_fn_args,
+        N,
+        o0,
+        num_random_repeats,
+        n_jobs = 1,
+        seed = None,
+        early_stopping = True,
+        min_random_repeats = 20,
+        batch_size = 10,
+        zscore_atol = 0.5,
+        zscore_rtol = 0.2,
+        verbose = False,
+):
+    ''' Returns the list of overlaps for up to num_random_repeats random
+    vertex shuffles, where overlap_fn(*overlap_fn_args, p) is the overlap
+    for the permutation p and o0 is the unshuffled overlap
+
+    each shuffle r uses its own RNG stream (spawned from seed), and the
+    shuffles are run in batches of batch_size (after the first
+    min_random_repeats), so the results only depend on seed, not on n_jobs
+
+    if early_stopping, we stop after a batch once the approximate 95%
+    confidence interval for the zscore (o0-mean)/sdev is narrower than
+    +/- max(zscore_atol, zscore_rtol*|zscore|)
+    '''
+    seed_seqs = np.random.SeedSequence(seed).spawn(num_random_repeats)
+
+    pool = None
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(
+            n_jobs, initializer=_init_graph_overlap_worker,
+            initargs=(overlap_fn, N, overlap_fn_args))
+    else:
+        _init_graph_overlap_worker(overlap_fn, N, overlap_fn_args)
+
+    overlaps = []
+    try:
+        while len(overlaps) < num_random_repeats:
+            start = len(overlaps)
+            stop = min(num_random_repeats,
+                       max(min_random_repeats, start+batch_size))
+            batch = seed_seqs[start:stop]
+            if pool is None:
+                overlaps.extend(_graph_overlap_worker(x) for x in batch)
+            else:
+                overlaps.extend(pool.map(_graph_overlap_worker, batch))
+            if verbose:
+                print(f'graph overlap shuffles: {len(overlaps):3d}',
+                      f'mean= {np.mean(overlaps):.2f}',
+                      f'sdev= {np.std(overlaps):.2f}')
+            n = len(overlaps)
+            s = np.std(overlaps)
+            if early_stopping and n >= min_random_repeats and n>1 and s>0:
+                z = (o0-np.mean(overlaps))/s
+                # delta method: var(mean)/s^2 + z^2 * var(s)/s^2
+                z_sdev = np.sqrt(1./n + z*z/(2.*(n-1)))
+                if 1.96*z_sdev <= max(zscore_atol, zscore_rtol*abs(z)):
+                    break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return overlaps
+
 def _compute_graph_overlap_stats(
         gex_nbrs,
         tcr_nbrs,
@@ -266,10 +521,19 @@ def _compute_graph_overlap_stats(
         verbose=False,
         swaptags=False,
         max_calculation_time=2000,# in seconds
+        n_jobs=1,
+        seed=None,
+        early_stopping=True,
 ):
     ''' Helper function for graph-graph overlap summary analysis
 
     see compute_graph_vs_graph_stats(...) function below
+
+    gex_nbrs and tcr_nbrs can be nbr arrays, lists of nbr arrays, or
+    _ClusterGraphs
+
+    the shuffles are run by _run_graph_overlap_shuffles, see that function
+    for n_jobs, seed, early_stopping
     '''
     starttime = time.time()
     gtag,ttag = 'gex','tcr'
@@ -278,30 +542,33 @@ def _compute_graph_overlap_stats(
     N = len(gex_nbrs)
     assert N == len(tcr_nbrs)
 
+    def get_degrees_and_indegrees(nbrs):
+        if isinstance(nbrs, _ClusterGraph):
+            degrees = nbrs.degrees()
+            return degrees, degrees # symmetric
+        _, cols = _make_graph_edge_arrays(nbrs)
+        return (np.diff(_make_nbrs_indptr(nbrs)),
+                np.bincount(cols, minlength=N))
+
+    gex_degrees, gex_indegrees = get_degrees_and_indegrees(gex_nbrs)
+    tcr_degrees, tcr_indegrees = get_degrees_and_indegrees(tcr_nbrs)
+
     ## if this will take too long, we may just estimate things
-    gex_edges = sum(len(x) for x in gex_nbrs)
-    tcr_edges = sum(len(x) for x in tcr_nbrs)
-    expected_overlap = (sum(len(x)*len(y) for x,y in zip(gex_nbrs, tcr_nbrs))/
+    gex_edges = int(np.sum(gex_degrees))
+    tcr_edges = int(np.sum(tcr_degrees))
+    expected_overlap = (np.sum(gex_degrees.astype(float)*tcr_degrees)/
                         (N-1))
 
     # compute the bias in the number of incoming edges in the gex graph
     expected_indegree = gex_edges/N
-    gex_counts = Counter()
-    for nbrs in gex_nbrs:
-        gex_counts.update(nbrs)
-    gex_indegree_bias = np.array([gex_counts[x]/expected_indegree
-                                  for x in range(N)])
+    gex_indegree_bias = gex_indegrees/expected_indegree
     gex_indegree_bias_stats = stats.describe(gex_indegree_bias)
     if verbose:
         print('gex_indegree_bias:', gex_indegree_bias_stats)
 
     # compute the bias in the number of incoming edges in the tcr graph
     expected_indegree = tcr_edges/N
-    tcr_counts = Counter()
-    for nbrs in tcr_nbrs:
-        tcr_counts.update(nbrs)
-    tcr_indegree_bias = np.array([tcr_counts[x]/expected_indegree
-                                  for x in range(N)])
+    tcr_indegree_bias = tcr_indegrees/expected_indegree
     tcr_indegree_bias_stats = stats.describe(tcr_indegree_bias)
     if verbose:
         print('tcr_indegree_bias:', tcr_indegree_bias_stats)
@@ -314,34 +581,50 @@ def _compute_graph_overlap_stats(
     # log10_gex_edges    0.958948
     # log10_tcr_edges    1.044386
     # this was fitted with num_random_repeats = 100
+    #
+    # the shuffling cost for cluster graphs is O(N), since they are implicit
+    gex_cost_edges = N if isinstance(gex_nbrs, _ClusterGraph) else gex_edges
+    tcr_cost_edges = N if isinstance(tcr_nbrs, _ClusterGraph) else tcr_edges
     estimated_log10_calculation_time = (-1.9147 * np.log10(N)
-                                        +0.9589 * np.log10(gex_edges)
-                                        +1.0444 * np.log10(tcr_edges)
+                                        +0.9589 * np.log10(gex_cost_edges)
+                                        +1.0444 * np.log10(tcr_cost_edges)
                                         -4.4533)
     estimated_calculation_time = (10**estimated_log10_calculation_time*
-                                  num_random_repeats/100.)
+                                  num_random_repeats/100./max(1, n_jobs))
+
+    # setup the overlap calculation for this kind of graph pair
+    if isinstance(gex_nbrs, _ClusterGraph) and isinstance(tcr_nbrs,
+                                                          _ClusterGraph):
+        overlap_fn = _permuted_cluster_cluster_overlap
+        overlap_fn_args = (gex_nbrs.clusters, gex_nbrs.agroups,
+                           gex_nbrs.bgroups, tcr_nbrs.clusters,
+                           tcr_nbrs.agroups, tcr_nbrs.bgroups)
+    elif isinstance(gex_nbrs, _ClusterGraph) or isinstance(tcr_nbrs,
+                                                            _ClusterGraph):
+        permute_clusters = isinstance(tcr_nbrs, _ClusterGraph)
+        cgraph, nbrs = ((tcr_nbrs, gex_nbrs) if permute_clusters else
+                        (gex_nbrs, tcr_nbrs))
+        overlap_fn = _permuted_nbr_cluster_overlap
+        overlap_fn_args = (*_make_graph_edge_arrays(nbrs), cgraph.clusters,
+                           cgraph.agroups, cgraph.bgroups, permute_clusters)
+    else:
+        tcr_csr = _make_csr_nbrs_fast(tcr_nbrs)
+        overlap_fn = _permuted_graph_overlap
+        overlap_fn_args = (_make_csr_nbrs_fast(gex_nbrs), tcr_csr.indptr,
+                           tcr_csr.indices, tcr_csr.data)
+    o0 = overlap_fn(*overlap_fn_args, np.arange(N))
+
+    num_shuffles = 0
     if estimated_calculation_time <= max_calculation_time:
-        M0 = _make_csr_nbrs(gex_nbrs)
-        M1 = _make_csr_nbrs(tcr_nbrs).tocoo()
-        M2 = M1.copy()
-        overlaps = []
-        for r in range(num_random_repeats+1):
-            if r:
-                p = np.random.permutation(N)
-            else:
-                p = np.arange(N)
-            M1.row = p[M2.row]
-            M1.col = p[M2.col]
-            overlap = M0.multiply(M1.tocsr()).sum()
-            if verbose and r%10==0:
-                print(f'{r:2d} {overlap:6d}')
-            overlaps.append(overlap)
-        o0 = overlaps[0]
-        m,s = np.mean(overlaps[1:]), np.std(overlaps[1:])
+        overlaps = _run_graph_overlap_shuffles(
+            overlap_fn, overlap_fn_args, N, o0,
+            num_random_repeats, n_jobs=n_jobs, seed=seed,
+            early_stopping=early_stopping, verbose=verbose)
+        num_shuffles = len(overlaps)
+        m,s = np.mean(overlaps), np.std(overlaps)
         zscore_source = 'shuffling'
     else:
         zscore_source = 'fitting'
-        o0 = _compute_nbr_overlap_slow(gex_nbrs, tcr_nbrs)
 
     ## params for log10_s determined with
     ## statsmodels.formula.api.ols(f'log10_overlap_sdev ~
@@ -376,6 +659,7 @@ def _compute_graph_overlap_stats(
         'overlap_zscore':z,
         'overlap_zscore_fitted':z_fitted,
         'overlap_zscore_source':zscore_source,
+        'num_shuffles':num_shuffles,
         'nodes':N,
         'calculation_time':total_seconds,
         'calculation_time_fitted':10**estimated_log10_calculation_time,
@@ -432,6 +716,9 @@ def compute_graph_vs_graph_stats(
         all_nbrs,
         num_random_repeats = 100,
         outfile_prefix = None,
+        n_jobs = 1, # number of processes for the shuffling
+        seed = None, # for the shuffling
+        early_stopping = True, # stop shuffling once the zscores are precise
 ):
     '''Here we are assessing overall graph-vs-graph correlation by looking at
     the shared edges between TCR and GEX neighbor graphs and comparing
@@ -445,6 +732,11 @@ def compute_graph_vs_graph_stats(
     by using a regression model for the
     standard deviation.
 
+    The shuffles can be run in n_jobs processes; for a given seed the results
+    don't depend on n_jobs. With early_stopping, shuffling stops before
+    num_random_repeats once the zscore is known well enough (see
+    _run_graph_overlap_shuffles)
+
     This is different from graph-vs-graph analysis which looks at graph
     overlap on a node-by-node basis
 
@@ -453,44 +745,46 @@ def compute_graph_vs_graph_stats(
     '''
 
 
-    num_clones = adata.shape[0]
     agroups, bgroups = preprocess.setup_tcr_groups(adata)
     clusters_gex = np.array(adata.obs['clusters_gex'])
     clusters_tcr = np.array(adata.obs['clusters_tcr'])
 
-    gex_cluster_nbrs = []
-    tcr_cluster_nbrs = []
+    # the cluster graphs are represented implicitly, by the cluster labels
+    gex_cluster_nbrs = _ClusterGraph(clusters_gex, agroups, bgroups)
+    tcr_cluster_nbrs = _ClusterGraph(clusters_tcr, agroups, bgroups)
 
-    for i in range(num_clones):
-        ag, bg = agroups[i], bgroups[i]
-        gc, tc = clusters_gex[i], clusters_tcr[i]
-        gex_cluster_nbrs.append(
-            np.nonzero((clusters_gex==gc)&(agroups!=ag)&(bgroups!=bg))[0])
-        tcr_cluster_nbrs.append(
-            np.nonzero((clusters_tcr==tc)&(agroups!=ag)&(bgroups!=bg))[0])
 
+    shuffle_args = dict(n_jobs=n_jobs, seed=seed,
+                        early_stopping=early_stopping)
 
     dfl = []
     for nbr_frac in all_nbrs:
         gex_nbrs, tcr_nbrs = all_nbrs[nbr_frac]
         stats = _compute_graph_overlap_stats(
-            gex_nbrs, tcr_nbrs, num_random_repeats)
+            gex_nbrs, tcr_nbrs, num_random_repeats, **shuffle_args)
         stats['nbr_frac'] = nbr_frac
         stats['graph_overlap_type'] = 'gex_nbr_vs_tcr_nbr'
         dfl.append(stats)
 
         stats = _compute_graph_overlap_stats(
-            gex_nbrs, tcr_cluster_nbrs, num_random_repeats)
+            gex_nbrs, tcr_cluster_nbrs, num_random_repeats, **shuffle_args)
         stats['nbr_frac'] = nbr_frac
         stats['graph_overlap_type'] = 'gex_nbr_vs_tcr_cluster'
         dfl.append(stats)
 
         stats = _compute_graph_overlap_stats(
-            tcr_nbrs, gex_cluster_nbrs, num_random_repeats, swaptags=True)
+            tcr_nbrs, gex_cluster_nbrs, num_random_repeats, swaptags=True,
+            **shuffle_args)
         stats['nbr_frac'] = nbr_frac
         stats['graph_overlap_type'] = 'gex_cluster_vs_tcr_nbr'
         dfl.append(stats)
 
+    stats = _compute_graph_overlap_stats(
+        gex_cluster_nbrs, tcr_cluster_nbrs, num_random_repeats, **shuffle_args)
+    stats['nbr_frac'] = np.nan
+    stats['graph_overlap_type'] = 'gex_cluster_vs_tcr_cluster'
+    dfl.append(stats)
+
     results = pd.DataFrame(dfl)
 
 
@@ -514,7 +808,8 @@ graphs in which each clonotype is connected to all the other clonotypes with
 the same (GEX or TCR) cluster assignment. For two K values (the default),
 this gives 2*3=6 comparisons: GEX KNN graph vs TCR KNN graph, GEX cluster
 graph vs TCR KNN graph, and GEX KNN graph vs TCR cluster graph, for each of the
-two K values (aka nbr_fracs).
+two K values (aka nbr_fracs), plus the GEX cluster graph vs TCR cluster graph
+comparison (nbr_frac is empty for that row).
 
 The column to look at is *overlap_zscore*. Higher values indicate more
 significant GEX/TCR covariation, with "interesting" levels starting around
@@ -852,6 +1147,143 @@ def _get_split_mean_var( X, X_sq, mask, mean, mean_sq ):
     return mean_fg, var_fg, mean_bg, var_bg
 
 
+def _make_nbrhood_matrix(nbrs):
+    ''' Returns the sparse num_clones x num_clones incidence matrix A where
+    row i is the indicator vector for the nbrhood of clone i, ie nbrs[i] plus
+    i itself. Rows for clones with empty nbrs are empty. The column indices
+    in each row are sorted.
+    '''
+    num_clones = len(nbrs)
+    rows, cols = _make_graph_edge_arrays(nbrs)
+    centers = np.array([ii for ii in range(num_clones) if len(nbrs[ii])],
+                       dtype=np.int32)
+    A = sps.csr_matrix(
+        (np.ones(len(rows)+len(centers)), (np.concatenate([rows, centers]),
+                                            np.concatenate([cols, centers]))),
+        shape=(num_clones, num_clones))
+    A.data[:] = 1. # in case of duplicates
+    A.sort_indices()
+    return A
+
+def _get_nbrhood_mask(A, ii):
+    ''' boolean mask for the nbrhood of clone ii, see _make_nbrhood_matrix '''
+    mask = np.full((A.shape[1],), False)
+    mask[A.indices[A.indptr[ii]:A.indptr[ii+1]]] = True
+    return mask
+
+def _get_nbrhood_block_size(num_features, max_block_entries=2000000):
+    ''' number of nbrhoods to process at once, to bound memory use '''
+    return max(1, max_block_entries//max(1, num_features))
+
+def _get_nbrhood_split_mean_var( A_block, X, X_sq, mean, mean_sq ):
+    ''' Vectorized version of _get_split_mean_var for a block of nbrhoods:
+    A_block is a set of rows from the nbrhood matrix (see
+    _make_nbrhood_matrix), all non-empty
+
+    The nbrhood totals are A_block @ X and A_block @ X_sq, and the
+    background stats come from the global totals minus the nbrhood totals
+
+    returns mean_fg, var_fg, mean_bg, var_bg, each (num_nbrhoods, num_features)
+    '''
+    N = A_block.shape[1]
+    assert X.shape[0] == N
+    num_fg = np.asarray(A_block.sum(axis=1))
+    wt_fg = num_fg / N
+    wt_bg = 1. - wt_fg
+    sum_fg = A_block @ X
+    sum_sq_fg = A_block @ X_sq
+    if sps.issparse(sum_fg):
+        sum_fg = sum_fg.toarray()
+        sum_sq_fg = sum_sq_fg.toarray()
+    mean_fg = sum_fg / num_fg
+    mean_sq_fg = sum_sq_fg / num_fg
+    mean_bg = (mean[None,:] - wt_fg*mean_fg)/wt_bg
+    mean_sq_bg = (mean_sq[None,:] - wt_fg*mean_sq_fg)/wt_bg
+    var_fg = (mean_sq_fg - mean_fg**2)
+    var_bg = (mean_sq_bg - mean_bg**2)
+    return mean_fg, var_fg, mean_bg, var_bg
+
+def _welch_ttest_scores( mean1, std1, nobs1, mean2, std2, nobs2 ):
+    ''' Just the t statistic from stats.ttest_ind_from_stats with
+    equal_var=False, same arithmetic. The pvalues (the student-t tail) are
+    most of the cost, so we only compute those where we need them
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (mean1 - mean2)/np.sqrt(std1**2/nobs1 + std2**2/nobs2)
+
+
+class _MannWhitneyRanks():
+    ''' Cached ranks for fast Mann-Whitney U tests of a subset of the rows of
+    X versus the rest, one feature (column) at a time. Same as
+
+    mannwhitneyu(X[subset,j], X[~subset,j], method='asymptotic')
+
+    but the tie-corrected ranks are computed once per feature, the first time
+    it is tested, and then each test is just a gather over the subset values.
+
+    For sparse X only the distinct stored values and their ranks are kept, so
+    all the zeros share a single tied rank
+    '''
+    def __init__(self, X):
+        self.N = X.shape[0]
+        self.X = X.tocsc() if sps.issparse(X) else np.asarray(X)
+        self._columns = {}
+
+    def _get_column(self, j):
+        ''' returns sorted distinct values, their average ranks, tie term '''
+        if j not in self._columns:
+            if sps.issparse(self.X):
+                start, stop = self.X.indptr[j], self.X.indptr[j+1]
+                vals = self.X.data[start:stop]
+                num_zeros = self.N - len(vals) # not counting explicit zeros
+                uvals, counts = np.unique(vals, return_counts=True)
+                if num_zeros:
+                    pos = np.searchsorted(uvals, 0.)
+                    if pos < len(uvals) and uvals[pos] == 0: # explicit zeros
+                        counts[pos] += num_zeros
+                    else:
+                        uvals = np.insert(uvals, pos, 0.)
+                        counts = np.insert(counts, pos, num_zeros)
+            else:
+                uvals, counts = np.unique(self.X[:,j], return_counts=True)
+            counts = counts.astype(float)
+            uranks = np.cumsum(counts) - 0.5*(counts-1)
+            tie_term = np.sum(counts**3 - counts)
+            self._columns[j] = (uvals, uranks, tie_term)
+        return self._columns[j]
+
+    def pvalue(self, j, fg_values, num_fg=None, alternative='two-sided'):
+        ''' fg_values are the values of feature j in the subset. For sparse
+        X these can be just the stored values, with num_fg the subset size
+        (the rest are zeros)
+
+        returns the pvalue for fg_values being larger ('greater'), smaller
+        ('less') or either ('two-sided') than the values outside the subset
+        '''
+        uvals, uranks, tie_term = self._get_column(j)
+        fg_values = np.asarray(fg_values).ravel()
+        n1 = len(fg_values) if num_fg is None else num_fg
+        n2 = self.N - n1
+        R1 = np.sum(uranks[np.searchsorted(uvals, fg_values)])
+        if n1 > len(fg_values): # implicit zeros
+            R1 += (n1-len(fg_values)) * uranks[np.searchsorted(uvals, 0.)]
+        U1 = R1 - n1*(n1+1)/2
+        U2 = n1*n2 - U1
+        if alternative == 'greater':
+            U, f = U1, 1
+        elif alternative == 'less':
+            U, f = U2, 1
+        else:
+            assert alternative == 'two-sided'
+            U, f = max(U1, U2), 2
+        # normal approximation w/ tie and continuity corrections, like scipy
+        N = self.N
+        s = np.sqrt(n1*n2/12 * ((N+1) - tie_term/(N*(N-1))))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (U - n1*n2/2 - 0.5)/s
+        return min(1., max(0., f * norm.sf(z)))
+
+
 
 def gex_nbrhood_rank_tcr_scores(
         adata,
@@ -900,103 +1332,113 @@ def gex_nbrhood_rank_tcr_scores(
     num_nonempty_nbrhoods = sum(1 for x in nbrs_gex if len(x)>0)
     pval_rescale = num_nonempty_nbrhoods * len(tcr_score_names)
 
-    nbrhood_mask = np.full( (num_clones,), False)
+    # the ttests for all the nbrhoods are computed in blocks, from the
+    #  nbrhood sums A @ score_table
+    A = _make_nbrhood_matrix(nbrs_gex)
+    all_num_fg = np.diff(A.indptr)
+    test_clones = np.nonzero(all_num_fg >= max(1, min_num_fg))[0]
+    block_size = _get_nbrhood_block_size(len(tcr_score_names))
+
+    # for the mannwhitneyu tests, ranks are computed once per score
+    mwu_ranks = _MannWhitneyRanks(score_table)
 
     results = []
 
-    for ii in range(num_clones):
-        if len(nbrs_gex[ii])==0:
-            continue
-        nbrhood_mask.fill(False)
-        nbrhood_mask[ nbrs_gex[ii] ] = True
-        nbrhood_mask[ ii ] = True
-        mean_fg, var_fg, mean_bg, var_bg = _get_split_mean_var(
-            score_table, score_table_sq, nbrhood_mask, mean, mean_sq)
-        num_fg = np.sum(nbrhood_mask)
-        if num_fg < min_num_fg:
-            continue
-        scores, pvals = stats.ttest_ind_from_stats(
-            mean1=mean_fg,
-            std1=np.sqrt(np.maximum(var_fg, 1e-12)),
-            nobs1=num_fg,
-            mean2=mean_bg,
-            std2=np.sqrt(np.maximum(var_bg, 1e-12)),
-            nobs2=num_clones-num_fg,
+    for b_start in range(0, len(test_clones), block_size):
+        block_clones = test_clones[b_start:b_start+block_size]
+        block_num_fg = all_num_fg[block_clones][:,None]
+        block_mean_fg, block_var_fg, block_mean_bg, block_var_bg = \
+            _get_nbrhood_split_mean_var(
+                A[block_clones], score_table, score_table_sq, mean, mean_sq)
+        block_scores, block_pvals = stats.ttest_ind_from_stats(
+            mean1=block_mean_fg,
+            std1=np.sqrt(np.maximum(block_var_fg, 1e-12)),
+            nobs1=block_num_fg,
+            mean2=block_mean_bg,
+            std2=np.sqrt(np.maximum(block_var_bg, 1e-12)),
+            nobs2=num_clones-block_num_fg,
             equal_var=False,  # Welch's
         )
 
-        scores[np.isnan(scores)] = 0
-        pvals[np.isnan(pvals)] = 1
+        block_scores[np.isnan(block_scores)] = 0
+        block_pvals[np.isnan(block_pvals)] = 1
 
         # crude bonferroni
-        pvals *= pval_rescale
-
-        nbrhood_clusters_gex, nbrhood_clusters_tcr = None,None # lazy
-
-        for ind in np.argsort(pvals):
-            pval = pvals[ind]
-
-            if pval>ttest_pval_threshold_for_mwu_calc:
-                continue
-
-            _,mwu_pval = mannwhitneyu(score_table[:,ind][nbrhood_mask],
-                                      score_table[:,ind][~nbrhood_mask],
-                                      alternative='two-sided',
-                                      **util.mannwhitneyu_kwargs)
-            mwu_pval_adj = mwu_pval * pval_rescale
-
-            # make more stringent
-            #if min(pval, mwu_pval_adj) <= pval_threshold:
-
-            if ((mwu_pval_adj <= pval_threshold) or
-                (pval <= pval_threshold and
-                 mwu_pval_adj <= 10*pval_threshold)):
-                if nbrhood_clusters_gex is None: # lazy
-                    nbrhood_clusters_gex = clusters_gex[nbrhood_mask]
-                    nbrhood_clusters_tcr = clusters_tcr[nbrhood_mask]
-                    nbrhood_is_mait = is_mait[nbrhood_mask]
-
-                # get info about the clones most contributing to this skewed
-                #  score
-                score_name = tcr_score_names[ind]
-                score = scores[ind] # ie the t-statistic
-
-                num_top = max(1,num_fg//4)
-                if score>0: # score is high
-                    top_indices = np.argpartition(
-                        score_table[:,ind][nbrhood_mask], -num_top)[-num_top:]
-                else: # score is low
-                    top_indices = np.argpartition(
-                        score_table[:,ind][nbrhood_mask], num_top-1)[:num_top]
-
-
-                gex_cluster = Counter( nbrhood_clusters_gex[ top_indices ])\
-                              .most_common(1)[0][0]
-                tcr_cluster = Counter( nbrhood_clusters_tcr[ top_indices ])\
-                              .most_common(1)[0][0]
-                mait_fraction = np.sum(nbrhood_is_mait[ top_indices ] )\
-                                /len(top_indices)
-
-                if verbose and mwu_pval_adj <= pval_threshold:
-                    print('gex_{}_score: {:9.2e} {:9.2e} {:7.2f} clp {:2d} {:2d} {:7.3f} {:7.3f} {:15s} {} {} mf: {:.3f} {}'\
-                          .format(prefix_tag, pval, mwu_pval_adj, score,
-                                  gex_cluster, tcr_cluster, mean_fg[ind],
-                                  mean_bg[ind], score_name,
-                                  ' '.join(tcrs[ii][0][:3]),
-                                  ' '.join(tcrs[ii][1][:3]),
-                                  mait_fraction, ii ))
-
-                results.append(dict(ttest_pvalue_adj=pval,
-                                    ttest_stat=score,
-                                    mwu_pvalue_adj=mwu_pval_adj,
-                                    gex_cluster=gex_cluster,
-                                    tcr_cluster=tcr_cluster,
-                                    num_fg=num_fg,
-                                    mean_fg=mean_fg[ind],
-                                    mean_bg=mean_bg[ind],
-                                    feature=score_name,
-                                    mait_fraction=mait_fraction,
-                                    clone_index=ii) )
+        block_pvals *= pval_rescale
+
+        for ib in np.nonzero(np.min(block_pvals, axis=1) <=
+                             ttest_pval_threshold_for_mwu_calc)[0]:
+            ii = block_clones[ib]
+            num_fg = all_num_fg[ii]
+            nbrhood_mask = _get_nbrhood_mask(A, ii)
+            nbrhood_indices = A.indices[A.indptr[ii]:A.indptr[ii+1]]
+            scores, pvals = block_scores[ib], block_pvals[ib]
+            mean_fg, mean_bg = block_mean_fg[ib], block_mean_bg[ib]
+
+            nbrhood_clusters_gex, nbrhood_clusters_tcr = None,None # lazy
+
+            for ind in np.argsort(pvals):
+                pval = pvals[ind]
+
+                if pval>ttest_pval_threshold_for_mwu_calc:
+                    continue
+
+                mwu_pval = mwu_ranks.pvalue(ind, score_table[nbrhood_indices,ind],
+                                            alternative='two-sided')
+                mwu_pval_adj = mwu_pval * pval_rescale
+
+                # make more stringent
+                #if min(pval, mwu_pval_adj) <= pval_threshold:
+
+                if ((mwu_pval_adj <= pval_threshold) or
+                    (pval <= pval_threshold and
+                     mwu_pval_adj <= 10*pval_threshold)):
+                    if nbrhood_clusters_gex is None: # lazy
+                        nbrhood_clusters_gex = clusters_gex[nbrhood_mask]
+                        nbrhood_clusters_tcr = clusters_tcr[nbrhood_mask]
+                        nbrhood_is_mait = is_mait[nbrhood_mask]
+
+                    # get info about the clones most contributing to this skewed
+                    #  score
+                    score_name = tcr_score_names[ind]
+                    score = scores[ind] # ie the t-statistic
+
+                    num_top = max(1,num_fg//4)
+                    if score>0: # score is high
+                        top_indices = np.argpartition(
+                            score_table[:,ind][nbrhood_mask], -num_top)[-num_top:]
+                    else: # score is low
+                        top_indices = np.argpartition(
+                            score_table[:,ind][nbrhood_mask], num_top-1)[:num_top]
+
+
+                    gex_cluster = Counter( nbrhood_clusters_gex[ top_indices ])\
+                                  .most_common(1)[0][0]
+                    tcr_cluster = Counter( nbrhood_clusters_tcr[ top_indices ])\
+                                  .most_common(1)[0][0]
+                    mait_fraction = np.sum(nbrhood_is_mait[ top_indices ] )\
+                                    /len(top_indices)
+
+                    if verbose and mwu_pval_adj <= pval_threshold:
+                        print('gex_{}_score: {:9.2e} {:9.2e} {:7.2f} clp {:2d} {:2d} {:7.3f} {:7.3f} {:15s} {} {} mf: {:.3f} {}'\
+                              .format(prefix_tag, pval, mwu_pval_adj, score,
+                                      gex_cluster, tcr_cluster, mean_fg[ind],
+                                      mean_bg[ind], score_name,
+                                      ' '.join(tcrs[ii][0][:3]),
+                                      ' '.join(tcrs[ii][1][:3]),
+                                      mait_fraction, ii ))
+
+                    results.append(dict(ttest_pvalue_adj=pval,
+                                        ttest_stat=score,
+                                        mwu_pvalue_adj=mwu_pval_adj,
+                                        gex_cluster=gex_cluster,
+                                        tcr_cluster=tcr_cluster,
+                                        num_fg=num_fg,
+                                        mean_fg=mean_fg[ind],
+                                        mean_bg=mean_bg[ind],
+                                        feature=score_name,
+                                        mait_fraction=mait_fraction,
+                                        clone_index=ii) )
 
         sys.stdout.flush()
     results_df = pd.DataFrame(results)
@@ -1094,7 +1536,9 @@ def tcr_nbrhood_rank_genes_fast(
     assert sps.issparse(X)
     assert X.shape[1] == len(genes)
 
-    X_csc = adata.raw.X.tocsc()
+    # for the mannwhitneyu tests, ranks are computed once per gene
+    mwu_ranks = _MannWhitneyRanks(X)
+    X_csr = X.tocsr()
 
     X_sq = X.multiply(X)
 
@@ -1117,6 +1561,7 @@ def tcr_nbrhood_rank_genes_fast(
                         np.log1p(np.argsort(-1*nndists_gex))]).transpose()
     assert X2.shape == (num_clones,len(genes2))
     X2_sq = X2*X2
+    mwu_ranks2 = _MannWhitneyRanks(X2)
     mean2 = X2.mean(axis=0)
     mean2_sq = X2_sq.mean(axis=0)
 
@@ -1140,129 +1585,164 @@ def tcr_nbrhood_rank_genes_fast(
     genes.extend(genes2) # since we are hstacking the vars, etc
     reference_indices = np.arange(len(genes), dtype=int)
 
-    for ii in range(num_clones):
-        if len(nbrs_tcr[ii])==0:
-            continue
-        nbrhood_mask = np.full( (num_clones,), False)
-        nbrhood_mask[ nbrs_tcr[ii] ] = True
-        nbrhood_mask[ ii ] = True
+    # the ttests for all the nbrhoods are computed in blocks of rows, from
+    #  the nbrhood sums A @ X and A @ X_sq
+    A = _make_nbrhood_matrix(nbrs_tcr)
+    all_num_fg = np.diff(A.indptr)
+    test_clones = np.nonzero(all_num_fg >= max(1, min_num_fg))[0]
+    block_size = _get_nbrhood_block_size(len(genes))
+
+    for b_start in range(0, len(test_clones), block_size):
+        block_clones = test_clones[b_start:b_start+block_size]
+        A_block = A[block_clones]
+        block_num_fg = all_num_fg[block_clones][:,None]
+
+        mean_fg, var_fg, mean_bg, var_bg = _get_nbrhood_split_mean_var(
+            A_block, X, X_sq, mean, mean_sq)
+        mean2_fg, var2_fg, mean2_bg, var2_bg = _get_nbrhood_split_mean_var(
+            A_block, X2, X2_sq, mean2, mean2_sq)
+
+        block_mean_fg = np.hstack([mean_fg, mean2_fg])
+        block_mean_bg = np.hstack([mean_bg, mean2_bg]) # note that we dont do the variances...
+        block_std_fg = np.sqrt(np.maximum(np.hstack([var_fg, var2_fg]),1e-12))
+        block_std_bg = np.sqrt(np.maximum(np.hstack([var_bg, var2_bg]), 1e-12))
+        del mean_fg, var_fg, mean_bg, var_bg
+        block_scores = _welch_ttest_scores(
+            block_mean_fg, block_std_fg, block_num_fg,
+            block_mean_bg, block_std_bg, num_clones-block_num_fg)
 
-        mean_fg, var_fg, mean_bg, var_bg = _get_split_mean_var(
-            X, X_sq, nbrhood_mask, mean, mean_sq)
-        mean2_fg, var2_fg, mean2_bg, var2_bg = _get_split_mean_var(
-            X2, X2_sq, nbrhood_mask, mean2, mean2_sq)
-
-        num_fg = np.sum(nbrhood_mask)
-        if num_fg < min_num_fg:
-            continue
-        mean_fg = np.hstack([mean_fg, mean2_fg])
-        mean_bg = np.hstack([mean_bg, mean2_bg]) # note that we dont do the variances...
-        scores, pvals = stats.ttest_ind_from_stats(
-            mean1=mean_fg,
-            std1=np.sqrt(np.maximum(np.hstack([var_fg, var2_fg]),1e-12)),
-            nobs1=num_fg,
-            mean2=mean_bg,
-            std2=np.sqrt(np.maximum(np.hstack([var_bg, var2_bg]), 1e-12)),
-            nobs2=num_clones-num_fg,
+        # scanpy code:
+        block_scores[np.isnan(block_scores)] = 0.
+
+        block_scores_sort = (np.abs(block_scores) if rankby_abs else
+                             block_scores)
+        block_partition = np.argpartition(
+            block_scores_sort, -top_n, axis=1)[:,-top_n:]
+
+        # only the top_n genes for each nbrhood are looked at, so only
+        #  compute pvals for those
+        def top(M):
+            return np.take_along_axis(M, block_partition, axis=1)
+        _, top_pvals = stats.ttest_ind_from_stats(
+            mean1=top(block_mean_fg),
+            std1=top(block_std_fg),
+            nobs1=block_num_fg,
+            mean2=top(block_mean_bg),
+            std2=top(block_std_bg),
+            nobs2=num_clones-block_num_fg,
             equal_var=False  # Welch's
         )
+        del block_std_fg, block_std_bg
+        top_pvals [np.isnan(top_pvals)] = 1.
+        top_pvals [bad_gene_mask[block_partition]] = 1.
+
+        top_pvals_adj = top_pvals * pval_rescale
+
+        # only the nbrhoods with a top_n gene that passes the ttest threshold
+        for ib in np.nonzero(np.min(top_pvals_adj, axis=1) <=
+                             ttest_pval_threshold_for_mwu_calc)[0]:
+            ii = block_clones[ib]
+            num_fg = all_num_fg[ii]
+            nbrhood_mask = _get_nbrhood_mask(A, ii)
+            nbrhood_indices = A.indices[A.indptr[ii]:A.indptr[ii+1]]
+            nbrhood_X = None # lazy
+            mean_fg, mean_bg = block_mean_fg[ib], block_mean_bg[ib]
+            logfoldchanges = np.log2((np.expm1(mean_fg) + 1e-9) /
+                                     (np.expm1(mean_bg) + 1e-9))
+            partition = block_partition[ib]
+            pvals_adj = np.ones(len(genes))
+            pvals_adj[partition] = top_pvals_adj[ib]
+
+            scores_sort = block_scores_sort[ib]
+            partial_indices = np.argsort(scores_sort[partition])[::-1]
+            global_indices = reference_indices[partition][partial_indices]
+
+            nbrhood_clusters_gex, nbrhood_clusters_tcr = None,None
+
+            for igene, ind in enumerate(global_indices):
+                gene = genes[ind]
+                if util.is_vdj_gene(gene, organism, include_constant_regions=True):
+                    continue
+                pval_adj = pvals_adj[ind]
+                log2fold= logfoldchanges[ind]
 
-        # scanpy code:
-        scores[np.isnan(scores)] = 0.
-        pvals [np.isnan(pvals)] = 1.
-        pvals [bad_gene_mask] = 1.
-        logfoldchanges = np.log2((np.expm1(mean_fg) + 1e-9) /
-                                 (np.expm1(mean_bg) + 1e-9))
-
-        pvals_adj = pvals * pval_rescale
-
-        scores_sort = np.abs(scores) if rankby_abs else scores
-        partition = np.argpartition(scores_sort, -top_n)[-top_n:]
-        partial_indices = np.argsort(scores_sort[partition])[::-1]
-        global_indices = reference_indices[partition][partial_indices]
-
-        nbrhood_clusters_gex, nbrhood_clusters_tcr = None,None
-
-        for igene, ind in enumerate(global_indices):
-            gene = genes[ind]
-            if util.is_vdj_gene(gene, organism, include_constant_regions=True):
-                continue
-            pval_adj = pvals_adj[ind]
-            log2fold= logfoldchanges[ind]
-
-            if pval_adj > ttest_pval_threshold_for_mwu_calc:
-                continue
-
-            is_real_gene = ind < num_real_genes
-            # here we are looking for genes (or clone_sizes/inverted nndists)
-            #  that are LARGER in the forground (fg)
-            if is_real_gene:
-                col = X_csc[:,ind][nbrhood_mask]
-                noncol = X_csc[:,ind][~nbrhood_mask]
-                _, mwu_pval = mannwhitneyu( col.toarray()[:,0], noncol.toarray()[:,0],
-                                            alternative='greater',
-                                            **util.mannwhitneyu_kwargs )
-            else:
-                col = X2[:,ind-num_real_genes][nbrhood_mask]
-                noncol = X2[:,ind-num_real_genes][~nbrhood_mask]
-                _, mwu_pval = mannwhitneyu(col, noncol, alternative='greater',
-                                           **util.mannwhitneyu_kwargs)
-            mwu_pval_adj = mwu_pval * pval_rescale
-
-            # 2021-06-28 make this more stringent: it used to be either/or
-            #if min(mwu_pval_adj, pval_adj) < pval_threshold:
-            #
-            # sometimes MWU seems a little wonky, so allow good ttests also
-            # if MWU is not terrible
-            if ((mwu_pval_adj < pval_threshold) or
-                (pval_adj < pval_threshold and
-                 mwu_pval_adj < 10*pval_threshold)):
-
-                if nbrhood_clusters_gex is None: # lazy
-                    nbrhood_clusters_gex = clusters_gex[nbrhood_mask]
-                    nbrhood_clusters_tcr = clusters_tcr[nbrhood_mask]
-                    nbrhood_is_mait = is_mait[nbrhood_mask]
-
-                # better annotation of the enriched tcrs...
-                num_top = num_fg//4
-                if is_real_gene: # col is sparse...
-                    if len(col.data)>num_top: # more than a quarter non-zero
-                        top_indices = col.indices[ np.argpartition(col.data, -num_top)[-num_top:] ]
-                        #bot_indices = col.indices[ np.argpartition(col.data, num_top-1)[:num_top] ]
-                        #assert np.mean(col[top_indices]) > np.mean(col[bot_indices])
-                    else:
-                        top_indices = col.indices
+                if pval_adj > ttest_pval_threshold_for_mwu_calc:
+                    continue
+
+                is_real_gene = ind < num_real_genes
+                # here we are looking for genes (or clone_sizes/inverted nndists)
+                #  that are LARGER in the forground (fg)
+                if is_real_gene:
+                    if nbrhood_X is None: # lazy
+                        nbrhood_X = X_csr[nbrhood_indices]
+                        nbrhood_X_rows = np.repeat(
+                            np.arange(num_fg), np.diff(nbrhood_X.indptr))
+                    # the nonzero values in the nbrhood, and their positions
+                    gene_mask = nbrhood_X.indices == ind
+                    col_data = nbrhood_X.data[gene_mask]
+                    col_rows = nbrhood_X_rows[gene_mask]
+                    mwu_pval = mwu_ranks.pvalue(ind, col_data, num_fg,
+                                                alternative='greater')
                 else:
-                    top_indices = np.argpartition(col, -num_top)[-num_top:]
-
-                #top_indices = np.nonzero(nbrhood_mask)[0][col_top_inds]
-
-                gex_cluster = Counter(
-                    nbrhood_clusters_gex[ top_indices ]).most_common(1)[0][0]
-                tcr_cluster = Counter(
-                    nbrhood_clusters_tcr[ top_indices ]).most_common(1)[0][0]
-                mait_fraction = (np.sum(nbrhood_is_mait[top_indices]) /
-                                 len(top_indices))
-
-                if verbose and mwu_pval_adj<=pval_threshold:
-                    print(f'tcr_{prefix_tag}_gene: {pval_adj:9.2e} '
-                          f'{mwu_pval_adj:9.2e} {log2fold:7.3f} clp '
-                          f'{gex_cluster:2d} {tcr_cluster:2d} {gene:8s} '
-                          f'{mean_fg[ind]:.4f} {mean_bg[ind]:.4f} {num_fg:4d} '
-                          f'{clone_display_names[ii]} mf: {mait_fraction:.3f} '
-                          f'{ii} {igene}')
-
-                results.append(dict(ttest_pvalue_adj=pval_adj,
-                                    mwu_pvalue_adj=mwu_pval_adj,
-                                    log2enr=log2fold,
-                                    gex_cluster=gex_cluster,
-                                    tcr_cluster=tcr_cluster,
-                                    feature=gene,
-                                    mean_fg=mean_fg[ind],
-                                    mean_bg=mean_bg[ind],
-                                    num_fg=num_fg,
-                                    clone_index=ii,
-                                    mait_fraction=mait_fraction))
+                    col = X2[nbrhood_indices, ind-num_real_genes]
+                    mwu_pval = mwu_ranks2.pvalue(ind-num_real_genes, col,
+                                                 alternative='greater')
+                mwu_pval_adj = mwu_pval * pval_rescale
+
+                # 2021-06-28 make this more stringent: it used to be either/or
+                #if min(mwu_pval_adj, pval_adj) < pval_threshold:
+                #
+                # sometimes MWU seems a little wonky, so allow good ttests also
+                # if MWU is not terrible
+                if ((mwu_pval_adj < pval_threshold) or
+                    (pval_adj < pval_threshold and
+                     mwu_pval_adj < 10*pval_threshold)):
+
+                    if nbrhood_clusters_gex is None: # lazy
+                        nbrhood_clusters_gex = clusters_gex[nbrhood_mask]
+                        nbrhood_clusters_tcr = clusters_tcr[nbrhood_mask]
+                        nbrhood_is_mait = is_mait[nbrhood_mask]
+
+                    # better annotation of the enriched tcrs...
+                    num_top = num_fg//4
+                    if is_real_gene: # col is sparse...
+                        if len(col_data)>num_top: # more than a quarter non-zero
+                            top_indices = col_rows[ np.argpartition(col_data, -num_top)[-num_top:] ]
+                            #bot_indices = col_rows[ np.argpartition(col_data, num_top-1)[:num_top] ]
+                            #assert np.mean(col[top_indices]) > np.mean(col[bot_indices])
+                        else:
+                            top_indices = col_rows
+                    else:
+                        top_indices = np.argpartition(col, -num_top)[-num_top:]
+
+                    #top_indices = np.nonzero(nbrhood_mask)[0][col_top_inds]
+
+                    gex_cluster = Counter(
+                        nbrhood_clusters_gex[ top_indices ]).most_common(1)[0][0]
+                    tcr_cluster = Counter(
+                        nbrhood_clusters_tcr[ top_indices ]).most_common(1)[0][0]
+                    mait_fraction = (np.sum(nbrhood_is_mait[top_indices]) /
+                                     len(top_indices))
+
+                    if verbose and mwu_pval_adj<=pval_threshold:
+                        print(f'tcr_{prefix_tag}_gene: {pval_adj:9.2e} '
+                              f'{mwu_pval_adj:9.2e} {log2fold:7.3f} clp '
+                              f'{gex_cluster:2d} {tcr_cluster:2d} {gene:8s} '
+                              f'{mean_fg[ind]:.4f} {mean_bg[ind]:.4f} {num_fg:4d} '
+                              f'{clone_display_names[ii]} mf: {mait_fraction:.3f} '
+                              f'{ii} {igene}')
+
+                    results.append(dict(ttest_pvalue_adj=pval_adj,
+                                        mwu_pvalue_adj=mwu_pval_adj,
+                                        log2enr=log2fold,
+                                        gex_cluster=gex_cluster,
+                                        tcr_cluster=tcr_cluster,
+                                        feature=gene,
+                                        mean_fg=mean_fg[ind],
+                                        mean_bg=mean_bg[ind],
+                                        num_fg=num_fg,
+                                        clone_index=ii,
+                                        mait_fraction=mait_fraction))
 
         sys.stdout.flush()
 
@@ -1393,13 +1873,13 @@ def run_graph_vs_features(
 
     ##
     ## now make another fake nbr graph defined by TCR gene segment usage
-    tcrs = preprocess.retrieve_tcrs_from_adata(adata)
+    tcr_table = preprocess.get_tcr_table(adata)
 
     tcr_genes_results = []
     for iab,ab in enumerate('AB'):
         for iseg,seg in enumerate('VJ'):
-            genes = [ x[iab][iseg] for x in tcrs ]
-            genes = np.array([ x[:x.index('*')] for x in genes ])
+            codes, alleles = tcr_table.gene_codes((seg+ab).lower())
+            genes = np.array([ x[:x.index('*')] for x in alleles ])[codes]
 
             # make some fake nbrs
             fake_nbrs_tcr = []
@@ -1529,42 +2009,30 @@ def find_hotspot_features(
     X_mean_sq = X_mean**2
     X_var = X_sq_mean - X_mean_sq
 
-    H = sps.csr_matrix( np.zeros((num_features,)) )
-    indegrees = np.zeros((num_clones,))
-
-    last_time = time.time()
-    for ii in range(num_clones):
-        if ii%1000==0:
-            elapsed_time = time.time() - last_time
-            if ii:
-                rate = 10*elapsed_time
-            else:
-                rate = 0
-            print(f'computing H matrix {ii:6d} {num_clones:6d} {rate:12.6f}',
-                  flush=True)
-            sys.stdout.flush()
-            last_time = time.time()
-        X_ii = X[ii,:]
-        ii_nbrs = nbrs[ii]
-        if len(ii_nbrs)==0:
-            continue
-        indegrees[ii_nbrs] += 1
-        H += X_ii.multiply( X[ii_nbrs,:].sum(axis=0) )
-
-    # multiply the indegree matrix by the raw X matrix by the means
-    indegrees_mat = sps.csr_matrix( indegrees[:, np.newaxis] )
-    assert indegrees_mat.shape == (num_clones,1)
-
-    X_mean_mat = sps.csr_matrix( X_mean )
-    assert X_mean_mat.shape == (1, num_features)
-
-    Y = X.multiply( indegrees_mat ).multiply( X_mean_mat ).sum(axis=0)
+    # W[i,j] = 1 if j is a nbr of i. Then
+    #  H = sum_i X[i,:] * sum_{j in nbrs[i]} X[j,:] = diag(X.T @ W @ X)
+    # which would be the same with the symmetrized W_sym/2 (see below), but
+    #  that has twice as many nonzeros
+    W = _make_csr_nbrs_fast(nbrs).astype(float)
+    indegrees = np.asarray(W.sum(axis=0)).ravel()
+
+    # do the X.T @ W @ X diagonal in chunks of feature columns, since
+    #  W @ X is a lot denser than X
+    X_csc = X.tocsc()
+    chunk_size = max(1, 10000000//num_clones)
+    H = np.zeros((num_features,))
+    for start in range(0, num_features, chunk_size):
+        stop = min(num_features, start+chunk_size)
+        X_chunk = X_csc[:,start:stop].tocsr()
+        H[start:stop] = np.asarray(
+            X_chunk.multiply(W @ X_chunk).sum(axis=0)).ravel()
+
+    # multiply the indegrees by the raw X matrix by the means
+    Y = X_mean * (X.T @ indegrees)
 
     assert H.shape == Y.shape
 
-    # Y is a numpy.matrix
-    #
-    H = (H-Y).A1
+    H = H-Y
     mask1 = (H==0)
     mask2 = (X_var==0)
     mask3 = mask2 & (~mask1) # H nonzero but stddev 0
@@ -1577,26 +2045,17 @@ def find_hotspot_features(
     inds = np.argsort(H)[::-1] # decreasing
 
     # the simple estimate for the variance of H is the total number of neighbors
-    # compute the variance
-    nbrs_sets = []
-    for ii in range(num_clones):
-        nbrs_sets.append( frozenset(nbrs[ii]) )
-
-    H_var = 0
-    #print('compute H_var')
-    for ii in range(num_clones):
-        for jj in nbrs[ii]:
-            if ii in nbrs_sets[jj]:
-                H_var += 2
-            else:
-                H_var += 1
+    #  with reciprocal nbr pairs counted twice, which is half the total of
+    #  W_sym**2 (W_sym is 2 for reciprocal nbrs, 1 for one-way nbrs)
+    W_sym = (W + W.T).tocsr()
+    H_var = 0.5 * np.sum(np.asarray(W_sym.multiply(W_sym).sum(axis=1)))
 
     H /= np.sqrt(H_var)
 
     results = []
     for ind in inds:
         feature = features[ind]
-        true_std = np.std(X[:,ind].toarray()[:,0])
+        true_std = np.std(X_csc[:,ind].toarray()[:,0])
         if true_std<1e-6:
             print('WHOAH var prob? {} {} =?= {}'\
                   .format(feature, X_var[ind], true_std**2))
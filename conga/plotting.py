@@ -3303,8 +3303,7 @@ def make_tcrdist_trees(
             cdists = preprocess.calc_tcrdist_matrix_cpp(
                 ctcrs, adata.uns['organism'])
         else:
-            cdists = np.array([tcrdister(x,y) for x in ctcrs for y in ctcrs])\
-                       .reshape(csize,csize)
+            cdists = tcrdister.pairwise(ctcrs)
 
         cmds = make_tcr_tree_svg_commands(
             ctcrs, organism, [x_offset,0], [width,height], cdists,
@@ -3388,8 +3387,7 @@ def make_tcrdist_tree_for_conga_score_threshold(
             ctcrs, adata.uns['organism'])
     else:
         print('computing tcrdist distances:', csize)
-        cdists = np.array([tcrdister(x,y) for x in ctcrs for y in ctcrs])\
-                   .reshape(csize,csize)
+        cdists = tcrdister.pairwise(ctcrs)
 
     width = 800
     height = 1000
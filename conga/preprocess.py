@@ -17,6 +17,8 @@ from scipy.sparse import issparse, csr_matrix
 from anndata import AnnData
 import sys
 import os
+import subprocess
+import hashlib
 from sys import exit
 from . import tcr_scoring
 from . import util
@@ -180,9 +182,94 @@ def store_tcrs_in_adata(adata, tcrs):
     adata.obs['cdr3a_nucseq'] = adata.obs.cdr3a_nucseq.str.lower()
     adata.obs['cdr3b_nucseq'] = adata.obs.cdr3b_nucseq.str.lower()
 
+    # the cached TcrTable would notice the new columns anyhow, but...
+    if hasattr(adata, TCR_TABLE_ATTR):
+        delattr(adata, TCR_TABLE_ATTR)
+
     return
 
 
+class TcrTable():
+    ''' Columnar version of the tcr info stored in adata.obs (see
+    store_tcrs_in_adata), with the nucseqs lower-cased like in
+    retrieve_tcrs_from_adata. Use get_tcr_table(adata) to get the cached one.
+
+    The columns are numpy object arrays, table.va, table.cdr3b, etc (or
+    table.column('cdr3b')), no copies. gene_codes gives integer codes for
+    the V and J genes. table.tuples is the old list of (atcr, btcr) tuples,
+    built the first time it's needed.
+    '''
+    gene_keys = ['va', 'ja', 'vb', 'jb']
+
+    def __init__(self, columns):
+        ''' columns is a dict from tcr_keys to arrays '''
+        self._columns = {}
+        for k in tcr_keys:
+            col = np.asarray(columns[k], dtype=object)
+            if k.endswith('_nucseq'):
+                col = pd.Series(col).str.lower().to_numpy(dtype=object)
+            self._columns[k] = col
+            setattr(self, k, col)
+        self._gene_codes = {}
+        self._tuples = None
+        self._hash = None
+
+    def __len__(self):
+        return len(self._columns['va'])
+
+    def column(self, key):
+        return self._columns[key]
+
+    def gene_codes(self, key):
+        ''' returns (codes, genes) where genes is the sorted array of the
+        distinct genes in column key and codes[i] is the index of clone i's
+        gene in genes
+        '''
+        assert key in self.gene_keys
+        if key not in self._gene_codes:
+            codes, genes = pd.factorize(self._columns[key], sort=True)
+            self._gene_codes[key] = (codes.astype(np.int32),
+                                     np.asarray(genes, dtype=object))
+        return self._gene_codes[key]
+
+    def content_hash(self):
+        ''' hex digest hash of all the tcr columns, computed once '''
+        if self._hash is None:
+            row_hashes = pd.util.hash_pandas_object(
+                pd.DataFrame(self._columns), index=False).values
+            self._hash = hashlib.sha1(row_hashes.tobytes()).hexdigest()
+        return self._hash
+
+    @property
+    def tuples(self):
+        ''' list of (atcr,btcr) tuples, atcr = (va,ja,cdr3a,cdr3a_nucseq) '''
+        if self._tuples is None:
+            cols = [self._columns[x] for x in tcr_keys]
+            self._tuples = [((va, ja, cdr3a, cdr3a_nucseq),
+                             (vb, jb, cdr3b, cdr3b_nucseq))
+                            for va, ja, cdr3a, cdr3a_nucseq,
+                                vb, jb, cdr3b, cdr3b_nucseq in zip(*cols)]
+        return self._tuples
+
+
+TCR_TABLE_ATTR = '_conga_tcr_table'
+
+def get_tcr_table(adata):
+    ''' Returns a TcrTable for the tcrs in adata.obs, cached on the adata
+    object. The cached table is rebuilt if any of the tcr columns in adata.obs
+    has been replaced (eg by store_tcrs_in_adata), but it won't notice
+    in-place edits to the column values.
+    '''
+    sources = [adata.obs[k].values for k in tcr_keys]
+    table = getattr(adata, TCR_TABLE_ATTR, None)
+    if (table is None or len(table) != adata.shape[0] or
+        any(x is not y for x,y in zip(sources, table._sources))):
+        table = TcrTable(dict(zip(tcr_keys, sources)))
+        table._sources = sources
+        setattr(adata, TCR_TABLE_ATTR, table)
+    return table
+
+
 def retrieve_tcrs_from_adata(adata, include_subject_id_if_present=False):
     ''' include_subject_id_if_present = True means that we add to the tcr-tuples the subject_id
     as given in the obs array. This will prevent clones from being condensed across individuals
@@ -196,10 +283,8 @@ def retrieve_tcrs_from_adata(adata, include_subject_id_if_present=False):
             tcrs.append(((va, ja, cdr3a, cdr3a_nucseq.lower(), subject_id),
                          (vb, jb, cdr3b, cdr3b_nucseq.lower(), subject_id)))
     else:
-        arrays = [ adata.obs[x] for x in tcr_keys ]
-        for va,ja,cdr3a,cdr3a_nucseq,vb,jb,cdr3b,cdr3b_nucseq in zip(*arrays):
-            tcrs.append(((va, ja, cdr3a, cdr3a_nucseq.lower()),
-                         (vb, jb, cdr3b, cdr3b_nucseq.lower()) ) )
+        # copy the list, in case the caller modifies it
+        tcrs = list(get_tcr_table(adata).tuples)
 
     return tcrs
 
@@ -234,6 +319,214 @@ def read_adata(
         adata = adata.copy()
     return adata
 
+
+CONGA_BUNDLE_VERSION = 3
+
+def get_conga_bundle_dir(clones_file):
+    ''' The binary bundle that read_dataset looks for next to clones_file
+    '''
+    return clones_file[:-4]+'_conga_bundle'
+
+def make_conga_bundle(
+        clones_file,
+        kpca_file = None, # default is clones_file[:-4]+'_AB.dist_50_kpcs'
+        bundle_dir = None, # default is get_conga_bundle_dir(clones_file)
+):
+    ''' Convert the clones file, the kpca file, and the barcode mapping file
+    into a directory of .npy files that read_dataset can memory-map instead of
+    parsing the text files. The kpca file is optional (see setup_10x_for_conga
+    --no_kpca).
+
+    bundle contents:
+      clones_columns.npy, clones_dtypes.npy, clones_column{i}*.npy: the
+         clones file table as typed columns (see util.dataframe_to_arrays),
+         which come back with the same dtypes and values as pd.read_csv
+      kpcs.npy: (num_clones, num_kpcs) float array, same row order as the
+         clones file (missing if there's no kpca file)
+      barcodes.npy, barcode_clones.npy: the barcodes and the clones file row
+         for each one
+
+    returns bundle_dir
+    '''
+    if kpca_file is None:
+        kpca_file = clones_file[:-4]+'_AB.dist_50_kpcs'
+    if bundle_dir is None:
+        bundle_dir = get_conga_bundle_dir(clones_file)
+    bcmap_file = clones_file+'.barcode_mapping.tsv'
+    for filename in [clones_file, bcmap_file]:
+        if not exists(filename):
+            print('ERROR make_conga_bundle:: missing file:', filename)
+            exit(1)
+
+    print('reading:', clones_file)
+    clones_df = pd.read_csv(clones_file, sep='\t')
+    if 'clone_id' not in clones_df.columns:
+        print('ERROR make_conga_bundle:: clones_file is missing the clone_id',
+              'column:', clones_file)
+        exit(1)
+    # like read_dataset, the last row wins if there are duplicate clone_ids
+    id2row = {str(x):i for i,x in enumerate(clones_df.clone_id)}
+
+    arrays = dict(version = np.array(CONGA_BUNDLE_VERSION))
+    arrays.update(util.dataframe_to_arrays(clones_df, prefix='clones_'))
+
+    if exists(kpca_file):
+        print('reading:', kpca_file)
+        kpcs = None
+        has_kpcs = np.zeros((clones_df.shape[0],), dtype=bool)
+        for line in open(kpca_file,'r'):
+            l = line.split()
+            assert l[0] == 'pc_comps:'
+            row = id2row[l[1]]
+            vals = [float(x) for x in l[2:] if x!='nan' ]
+            if kpcs is None:
+                kpcs = np.full((clones_df.shape[0], len(vals)), np.nan)
+            kpcs[row] = vals # fails if the number of kpcs is not constant
+            has_kpcs[row] = True
+    else:
+        print('WARNING make_conga_bundle:: missing kpca_file:', kpca_file)
+        kpcs = None
+
+    # barcode --> clones_df row; as in read_dataset, the last one wins
+    barcode2row = {}
+    for line in open(bcmap_file,'r'):
+        l = line[:-1].split('\t')
+        if l[0] == 'clone_id': continue # header line
+        if not l[1]: continue
+        if l[0] not in id2row: continue # maybe short cdr3?
+        row = id2row[l[0]]
+        for bc in l[1].split(','):
+            barcode2row[bc] = row
+    arrays['barcodes'] = np.array(list(barcode2row.keys()), dtype=str)
+    arrays['barcode_clones'] = np.array(list(barcode2row.values()), dtype=int)
+
+    if kpcs is not None:
+        missing = ~has_kpcs[arrays['barcode_clones']]
+        if np.any(missing):
+            print('ERROR make_conga_bundle::', np.sum(missing), 'barcodes',
+                  'have clones that are missing from kpca_file:', kpca_file)
+            exit(1)
+        arrays['kpcs'] = kpcs
+
+    # write to a temporary directory first, so a partial bundle never gets read
+    tmpdir = bundle_dir.rstrip('/')+'.tmp'
+    os.makedirs(tmpdir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmpdir, name+'.npy'), array, allow_pickle=False)
+    if os.path.isdir(bundle_dir):
+        for filename in os.listdir(bundle_dir):
+            os.remove(os.path.join(bundle_dir, filename))
+        os.rmdir(bundle_dir)
+    os.rename(tmpdir, bundle_dir)
+    print(f'make_conga_bundle:: wrote {clones_df.shape[0]} clones and',
+          f'{len(barcode2row)} barcodes to {bundle_dir}')
+    return bundle_dir
+
+
+def read_conga_bundle(bundle_dir, mmap_mode='r'):
+    ''' Returns clones_df, kpcs, barcodes, barcode_clones from a bundle made
+    by make_conga_bundle; kpcs is None if the bundle doesn't have them
+
+    kpcs, barcodes, and barcode_clones are memory-mapped (unless mmap_mode
+    is None), so only the rows that get used are read from disk
+    '''
+    def load(name, mmap_mode=None):
+        return np.load(os.path.join(bundle_dir, name+'.npy'),
+                       mmap_mode=mmap_mode, allow_pickle=False)
+
+    if int(load('version')) != CONGA_BUNDLE_VERSION:
+        print('ERROR read_conga_bundle:: bundle is from a different version',
+              'of make_conga_bundle, please rebuild it:', bundle_dir)
+        exit(1)
+
+    clones_df = util.dataframe_from_arrays(
+        {x[:-4]:load(x[:-4]) for x in os.listdir(bundle_dir)
+         if x.startswith('clones_')}, prefix='clones_')
+
+    if exists(os.path.join(bundle_dir, 'kpcs.npy')):
+        kpcs = load('kpcs', mmap_mode)
+    else:
+        kpcs = None
+    return (clones_df, kpcs, load('barcodes', mmap_mode),
+            load('barcode_clones', mmap_mode))
+
+
+def _find_conga_bundle(clones_file, kpca_file):
+    ''' Returns the bundle directory that read_dataset should use instead of
+    the text files, or None
+    '''
+    if os.path.isdir(clones_file):
+        return clones_file # clones_file is itself a bundle
+    if kpca_file is not None:
+        return None # non-default kpca_file; use the text files
+    bundle_dir = get_conga_bundle_dir(clones_file)
+    version_file = os.path.join(bundle_dir, 'version.npy')
+    if not exists(version_file):
+        return None
+    # dont use the bundle if any of the text files have changed since
+    bundle_time = os.path.getmtime(version_file)
+    for filename in [clones_file, clones_file+'.barcode_mapping.tsv',
+                     clones_file[:-4]+'_AB.dist_50_kpcs']:
+        if exists(filename) and os.path.getmtime(filename) > bundle_time:
+            print('WARNING: ignoring conga bundle', bundle_dir, 'since',
+                  filename, 'is newer')
+            return None
+    return bundle_dir
+
+
+def _read_dataset_tcrs_from_bundle(adata, bundle_dir, allow_missing_kpca_file):
+    ''' The read_dataset steps for a conga bundle: subset adata to the barcodes
+    with tcrs, store the tcrs and the kpcs. Returns adata
+    '''
+    print('reading:', bundle_dir)
+    clones_df, kpcs, barcodes, barcode_clones = read_conga_bundle(bundle_dir)
+
+    # allow use of either 'va' or 'va_gene' as column header
+    for vj in 'vj':
+        for ab in 'ab':
+            tag = f'{vj}{ab}_gene'
+            alt_tag = f'{vj}{ab}'
+            if tag not in clones_df.columns and alt_tag in clones_df.columns:
+                clones_df.rename(columns={alt_tag:tag}, inplace=True)
+
+    for colname in CLONES_FILE_REQUIRED_COLUMNS:
+        if colname not in clones_df.columns:
+            print('ERROR conga bundle is missing required clones column:',
+                  colname)
+            print('Required columns:', CLONES_FILE_REQUIRED_COLUMNS)
+            print('bundle_dir:', bundle_dir)
+            sys.exit()
+
+    if kpcs is None:
+        if not allow_missing_kpca_file:
+            print('ERROR: conga bundle has no kpcs:', bundle_dir)
+            sys.exit(1)
+        print('WARNING: conga bundle has no kpcs:', bundle_dir)
+        print('WARNING: X_tcr_pca will be empty')
+
+    cell_rows = pd.Index(barcodes).get_indexer(adata.obs.index)
+    mask = cell_rows >= 0
+
+    print(f'Reducing to the {np.sum(mask)} barcodes (out of {adata.shape[0]})'
+          ' with paired TCR sequence data')
+    adata = adata[mask].copy()
+    adata.uns['conga_stats']['num_cells_w_tcr'] = adata.shape[0]
+
+    if np.sum(mask)==0:
+        return adata
+
+    rows = np.asarray(barcode_clones[cell_rows[mask]])
+    if kpcs is not None:
+        adata.obsm['X_pca_tcr'] = np.array(kpcs[rows])
+
+    cols = [clones_df[x].values[rows] for x in
+            'va_gene ja_gene cdr3a cdr3a_nucseq vb_gene jb_gene cdr3b cdr3b_nucseq'.split()]
+    tcrs = [(x[:4], x[4:]) for x in zip(*cols)]
+    store_tcrs_in_adata( adata, tcrs )
+
+    return adata
+
+
 def read_dataset(
         gex_data,
         gex_data_type,
@@ -253,6 +546,11 @@ def read_dataset(
     if clones_file is None, gex_data_type must be 'h5ad' and the tcr info
       must already be in the AnnData object (ie adata) when we load it
 
+    if there's an up-to-date conga bundle next to clones_file (see
+      make_conga_bundle), and kpca_file is None, the tcrs and kpcs are read
+      from the bundle rather than the text files. clones_file can also be
+      the bundle directory itself
+
     '''
 
     include_tcr_nucseq = True
@@ -281,6 +579,13 @@ def read_dataset(
     if make_var_names_unique:
         adata.var_names_make_unique() # added
 
+    if clones_file is not None:
+        bundle_dir = _find_conga_bundle(clones_file, kpca_file)
+        if bundle_dir is not None:
+            print('total barcodes:', adata.shape[0], adata.shape)
+            return _read_dataset_tcrs_from_bundle( ########### EARLY RETURN
+                adata, bundle_dir, allow_missing_kpca_file)
+
     if clones_file is None:
         # adata should already contain the tcr information
         colnames = 'va ja cdr3a cdr3a_nucseq vb jb cdr3b cdr3b_nucseq'.split()
@@ -829,6 +1134,78 @@ def filter_and_scale(
     return adata
 
 
+def _clone_indicator_matrix(clone_ids, num_clones):
+    ''' sparse (num_clones, num_cells) one-hot matrix, so that
+    indicator @ X sums the rows of X over the cells in each clone
+    '''
+    num_cells = len(clone_ids)
+    return csr_matrix((np.ones(num_cells), (clone_ids, np.arange(num_cells))),
+                      shape=(num_clones, num_cells))
+
+def _clone_means(indicator, X, clone_sizes):
+    ''' per-clone average of the rows of X (dense or sparse), same type as X
+    (and same dtype, if X is floating point)
+    '''
+    dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+    sums = indicator @ X
+    if issparse(sums):
+        sums = csr_matrix(sums)
+        sums.data /= np.repeat(clone_sizes, np.diff(sums.indptr))
+        return sums.astype(dtype)
+    return (np.asarray(sums) / clone_sizes[:,None]).astype(dtype)
+
+def _find_clone_rep_cells(X_pca, clone_ids, clone_sizes, block_size=2000000):
+    ''' For each clone, the cell with the smallest summed distance to the
+    other cells in the clone, and the mean squared distance from that cell
+    to the clone's cells
+
+    smaller clones of the same size are handled together, in blocks of up to
+    about block_size distances/coordinates. Bigger clones are handled one at
+    a time, block_size//size rows of the distance matrix at a time, so memory
+    stays O(block_size) plus the clone's coordinates
+
+    returns rep_cell_indices, gex_var
+    '''
+    num_clones, dim = len(clone_sizes), X_pca.shape[1]
+    # cells sorted by clone, and by cell index within each clone
+    order = np.argsort(clone_ids, kind='stable')
+    starts = np.cumsum(clone_sizes) - clone_sizes
+    rep_cell_indices = order[starts] # correct for the singletons
+    gex_var = np.zeros((num_clones,))
+    sum_dtype = np.result_type(X_pca.dtype, np.float32)
+
+    for size in np.unique(clone_sizes[clone_sizes>1]):
+        clones = np.nonzero(clone_sizes==size)[0]
+        if size * max(size, dim) > block_size:
+            rows_per_block = max(1, block_size // size)
+            for c in clones:
+                cells = order[starts[c]:starts[c]+size]
+                X = X_pca[cells]
+                dist_sums = np.zeros((size,), dtype=sum_dtype)
+                for start in range(0, size, rows_per_block):
+                    dist_sums[start:start+rows_per_block] = cdist(
+                        X[start:start+rows_per_block], X).sum(axis=1)
+                rep_ind = np.argmin(dist_sums)
+                rep_cell_indices[c] = cells[rep_ind]
+                gex_var[c] = np.sum(cdist(X[rep_ind:rep_ind+1], X)**2)/size
+            continue
+        chunk = block_size // (size * max(size, dim))
+        for start in range(0, len(clones), chunk):
+            block = clones[start:start+chunk]
+            cells = order[starts[block][:,None] + np.arange(size)[None,:]]
+            X = X_pca[cells].astype(np.float64) # (num_clones, size, dim)
+            sqnorms = np.einsum('ijk,ijk->ij', X, X)
+            D = (sqnorms[:,:,None] + sqnorms[:,None,:] -
+                 2 * np.matmul(X, X.transpose(0,2,1)))
+            np.maximum(D, 0, out=D)
+            D[:, np.arange(size), np.arange(size)] = 0
+            D = np.sqrt(D)
+            rep_inds = np.argmin(D.sum(axis=2), axis=1)
+            inds = np.arange(len(block))
+            rep_cell_indices[block] = cells[inds, rep_inds]
+            gex_var[block] = np.sum(D[inds, rep_inds]**2, axis=1)/size
+    return rep_cell_indices, gex_var
+
 def reduce_to_single_cell_per_clone(
         adata,
         n_pcs=50,
@@ -877,17 +1254,14 @@ def reduce_to_single_cell_per_clone(
     if 'pmhc_var_names' in adata.uns_keys():
         pmhc_var_names = adata.uns['pmhc_var_names']
         X_pmhc = pmhc_scoring._get_X_pmhc(adata, pmhc_var_names)
-        new_X_pmhc = []
     else:
         pmhc_var_names = None
 
     if 'batch_keys' in adata.uns_keys():
-        clone_batch_counts = {}
         num_batch_key_choices = {}
         batch_keys = adata.uns['batch_keys']
         for k in batch_keys:
             assert k in adata.obs_keys()
-            clone_batch_counts[k] = []
             assert np.min(adata.obs[k]) >= 0
             max_val = np.max(adata.obs[k])
             if max_val==0: # we need at least two choices for obsm
@@ -901,68 +1275,45 @@ def reduce_to_single_cell_per_clone(
         batch_keys = None
 
     clone_ids = np.array( [ tcr2clone_id[x] for x in tcrs_with_duplicates ] )
+    clone_sizes = np.bincount(clone_ids, minlength=num_clones)
+    # (num_clones, num_cells) one-hot, for the per-clone sums and averages
+    clone_indicator = _clone_indicator_matrix(clone_ids, num_clones)
 
-    X_pca = adata.obsm[pca_tag]
-    clone_sizes = []
-    gex_var = []
-    batch_counts = []
-    rep_cell_indices = [] # parallel
-
-    ## only used if average_clone_gex is True
-    old_raw_X = adata.raw.X
-    new_X_rows = []
+    if batch_keys is not None:
+        # store the distribution of each clone across the different batches
+        clone_batch_counts = {}
+        for k in batch_keys:
+            counts = np.zeros((num_clones, num_batch_key_choices[k]), dtype=int)
+            np.add.at(counts, (clone_ids, np.array(adata.obs[k])), 1)
+            clone_batch_counts[k] = counts
 
     ## for each clone (tcr) we pick a single representative cell, stored in rep_cell_indices
     ## rep_cell_indices is parallel with and aligned to the tcrs list
-    for c in range(num_clones):
-        if c%1000==0:
-            print('choose representative cell for clone:', c, num_clones,
-                  adata.shape)
-            sys.stdout.flush()
-        clone_mask = clone_ids==c
-        clone_cells = np.nonzero(clone_mask)[0] #array( [ x for x,y in enumerate(clone_ids) if y==c] )
-        clone_size = clone_cells.shape[0]
-        clone_sizes.append( clone_size )
-        if batch_keys is not None:
-            # store the distribution of this clone across the different batches
-            for k in batch_keys:
-                counts = Counter(adata.obs[k][clone_mask])
-                counts = [counts[x] for x in range(num_batch_key_choices[k]) ]
-                clone_batch_counts[k].append(counts)
-
-        if clone_size==1:
-            rep_cell_index = clone_cells[0]
-            gex_var.append(0.0)
-        else:
-            X_pca_clone = X_pca[ clone_cells, : ]
-            #print('X_pca_clone:',X_pca_clone.shape)
-            assert X_pca_clone.shape[0] == clone_size
-            D_gex_clone = pairwise_distances( X_pca_clone, X_pca_clone )
-            assert D_gex_clone.shape  == ( clone_size,clone_size )
-            avgdist = D_gex_clone.sum(axis=1)
-            #print('min_avgdist', np.min(avgdist)/clone_size, clone_size, np.argmin(avgdist))
-            rep_ind = np.argmin( avgdist )
-            rep_cell_index = clone_cells[rep_ind]
-            gex_var.append(np.sum(D_gex_clone[rep_ind,:]**2)/clone_size)
-        rep_cell_indices.append(rep_cell_index)
-        if average_clone_gex:
-            if clone_size == 1:
-                new_X_rows.append(old_raw_X[clone_cells[0],:])
-            else:
-                new_X_rows.append(
-                    csr_matrix(old_raw_X[clone_cells,:].sum(axis=0)/clone_size))
-                adata.X[rep_cell_index,:] = adata.X[clone_cells,:].sum(axis=0)/clone_size
-        if pmhc_var_names:
-            new_X_pmhc.append( np.sum( X_pmhc[clone_cells,:], axis=0 ) / clone_size )
+    print('choose representative cells for', num_clones, 'clones', adata.shape)
+    sys.stdout.flush()
+    rep_cell_indices, gex_var = _find_clone_rep_cells(
+        adata.obsm[pca_tag], clone_ids, clone_sizes)
+
+    if average_clone_gex:
+        new_X = csr_matrix(_clone_means(
+            clone_indicator, adata.raw.X, clone_sizes))
+        # rep cells get the average of the normalized X, too
+        clone_means_X = _clone_means(clone_indicator, adata.X, clone_sizes)
 
-    rep_cell_indices = np.array(rep_cell_indices)
+    if pmhc_var_names:
+        new_X_pmhc = _clone_means(clone_indicator, X_pmhc, clone_sizes)
 
     print(f'reduce from {adata.shape[0]} cells to {len(rep_cell_indices)} cells (one per clonotype)')
     adata = adata[ rep_cell_indices, : ].copy() ## seems like we need to copy here, something to do with adata 'views'
-    adata.obs['clone_sizes'] = np.array( clone_sizes )
-    adata.obs['gex_variation'] = np.sqrt(np.array( gex_var ))
+    if average_clone_gex:
+        if issparse(adata.X):
+            adata.X = csr_matrix(clone_means_X, dtype=adata.X.dtype)
+        else:
+            adata.X = np.asarray(clone_means_X, dtype=adata.X.dtype)
+    adata.obs['clone_sizes'] = clone_sizes
+    adata.obs['gex_variation'] = np.sqrt(gex_var)
     adata.uns['conga_stats']['max_clonotype_size'] = np.max(clone_sizes)
-    adata.uns['conga_stats']['num_singleton_clonotypes'] = clone_sizes.count(1)
+    adata.uns['conga_stats']['num_singleton_clonotypes'] = np.sum(clone_sizes==1)
 
     ## rescale now that we have reduced to 1 cell per clone (NEW 2021-09-10)
     ## if we don't do this, in rare cases we get really wonky umaps/clusters
@@ -970,9 +1321,6 @@ def reduce_to_single_cell_per_clone(
     sc.pp.scale(adata, max_value=10)
 
     if average_clone_gex:
-        print('vstacking new_X_rows...'); sys.stdout.flush()
-        new_X = scipy.sparse.vstack(new_X_rows, format="csr")
-        print('DONE vstacking new_X_rows...'); sys.stdout.flush()
         assert new_X.shape == (adata.shape[0], adata.raw.X.shape[1])
 
         adata_new = AnnData( X = new_X, obs = adata.obs, var = adata.raw.var )
@@ -982,13 +1330,12 @@ def reduce_to_single_cell_per_clone(
 
     if batch_keys is not None:
         for k in batch_keys:
-            counts = np.array(clone_batch_counts[k])
+            counts = clone_batch_counts[k]
             assert counts.shape == (num_clones, num_batch_key_choices[k])
             adata.obsm[k] = counts
             print(f'storing clone batch info for key {k} with {num_batch_key_choices[k]} choices')
 
     if pmhc_var_names:
-        new_X_pmhc = np.array(new_X_pmhc)
         assert new_X_pmhc.shape == ( num_clones, len(pmhc_var_names))
         adata.obsm['X_pmhc'] = new_X_pmhc
 
@@ -1034,6 +1381,54 @@ def setup_tcr_groups( adata ):
     return setup_tcr_groups_for_tcrs(
         retrieve_tcrs_from_adata(adata, include_subject_id_if_present=True))
 
+def setup_tcr_group_index( groups ):
+    ''' returns (members, offsets), a CSR-style index from group number to
+    group members: the clones in group g are members[offsets[g]:offsets[g+1]]
+
+    groups is an integer array like the agroups/bgroups arrays returned by
+    setup_tcr_groups (values in range(num_groups))
+    '''
+    groups = np.asarray(groups)
+    members = np.argsort(groups, kind='stable').astype(np.int32)
+    counts = np.bincount(groups)
+    offsets = np.zeros((len(counts)+1,), dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return members, offsets
+
+def _get_group_member_pairs( row_indices, groups, group_index ):
+    ''' returns (rows, cols) such that cols[k] is a member of the group
+    containing clone row_indices[rows[k]]. rows index into row_indices
+    '''
+    members, offsets = group_index
+    row_groups = groups[row_indices]
+    starts = offsets[row_groups]
+    counts = offsets[row_groups+1] - starts
+    rows = np.repeat(np.arange(len(row_indices)), counts)
+    # position within the concatenated member lists, shifted to the start
+    #  of each row's group
+    shifts = np.repeat(starts - (np.cumsum(counts)-counts), counts)
+    cols = members[np.arange(rows.shape[0]) + shifts]
+    return rows, cols
+
+def _mask_same_group_nbrs(
+        D,
+        row_indices,
+        agroups,
+        bgroups,
+        agroup_index,
+        bgroup_index,
+        mask_value = 1e3,
+):
+    ''' sets D[i, j] = mask_value whenever clone row_indices[i] and clone j
+    are in the same agroup or bgroup (this includes j == row_indices[i])
+
+    modifies D in place
+    '''
+    for groups, group_index in [[agroups, agroup_index],
+                                [bgroups, bgroup_index]]:
+        rows, cols = _get_group_member_pairs(row_indices, groups, group_index)
+        D[rows, cols] = mask_value
+
 def _calc_nndists( D, nbrs ):
     batch_size, num_nbrs = nbrs.shape
     assert D.shape[0] == batch_size
@@ -1058,6 +1453,191 @@ def _calc_nndists_old( D, nbrs ):
     assert nndists.shape==(num_clones,)
     return nndists
 
+def _get_sorted_nbrs( D, num_neighbors ):
+    ''' returns (D.shape[0], num_neighbors) int32 array with the column
+    indices of the num_neighbors smallest values in each row of D, sorted by
+    increasing value
+    '''
+    nbrs = np.argpartition( D, num_neighbors-1 )[:,:num_neighbors]
+    ar = np.arange(D.shape[0])[:,None]
+    return nbrs[ar, np.argsort(D[ar, nbrs])].astype(np.int32)
+
+def _get_nbr_frac_views( nbrs, nbr_fracs, N ):
+    ''' nbrs is an (N, Kmax) array of sorted nbrs for the largest nbr_frac
+    returns dict mapping from nbr_frac to a view of the first
+    max(1, int(nbr_frac*N)) columns
+    '''
+    nbr_views = {}
+    for nbr_frac in nbr_fracs:
+        num_neighbors = max(1, int(nbr_frac*N))
+        assert num_neighbors <= nbrs.shape[1]
+        nbr_views[nbr_frac] = nbrs[:,:num_neighbors]
+    return nbr_views
+
+
+NBR_ENGINES = ['exact', 'kdtree', 'nndescent']
+
+def _find_nbrs_with_engine(
+        X,
+        num_neighbors,
+        agroups,
+        bgroups,
+        agroup_index,
+        bgroup_index,
+        nbr_engine,
+        random_state = 0,
+):
+    ''' returns nbrs, dists, each of shape (N, num_neighbors), sorted by
+    increasing distance
+
+    nbrs exclude self and any clones in same atcr group or btcr group
+
+    We ask the engine for num_neighbors plus the largest agroup and bgroup
+    sizes, so that dropping the same-group hits still leaves num_neighbors
+    candidates. Rows that come up short anyway are recomputed exactly.
+    '''
+    N = X.shape[0]
+    max_agroup_size = np.max(np.diff(agroup_index[1]))
+    max_bgroup_size = np.max(np.diff(bgroup_index[1]))
+    num_fetch = min(N, num_neighbors + max_agroup_size + max_bgroup_size)
+
+    print(f'find_nbrs_with_engine: {nbr_engine} N= {N} num_neighbors=',
+          num_neighbors, 'num_fetch=', num_fetch)
+    if nbr_engine == 'kdtree':
+        from sklearn.neighbors import NearestNeighbors
+        knn = NearestNeighbors(n_neighbors=num_fetch, algorithm='kd_tree')
+        knn.fit(X)
+        cand_dists, cands = knn.kneighbors(X)
+    elif nbr_engine == 'nndescent':
+        from pynndescent import NNDescent # installed along with umap-learn
+        index = NNDescent(X, n_neighbors=num_fetch, random_state=random_state)
+        cands, cand_dists = index.neighbor_graph
+    else:
+        print('ERROR unrecognized nbr_engine:', nbr_engine, 'options:',
+              NBR_ENGINES)
+        exit(1)
+
+    # nndescent may fail to fill a row, in which case the index is -1
+    bad = ((cands < 0) |
+           (agroups[cands] == agroups[:,None]) |
+           (bgroups[cands] == bgroups[:,None]))
+    # stable sort puts the allowed candidates first, still sorted by distance
+    order = np.argsort(bad, axis=1, kind='stable')[:,:num_neighbors]
+    ar = np.arange(N)[:,None]
+    nbrs = cands[ar, order].astype(np.int32)
+    dists = cand_dists[ar, order]
+
+    short_rows = np.nonzero(np.any(bad[ar, order], axis=1))[0]
+    if short_rows.shape[0]:
+        print('find_nbrs_with_engine: exact recalc for', short_rows.shape[0],
+              'rows with too few candidates')
+        D = cdist(X[short_rows], X)
+        _mask_same_group_nbrs(D, short_rows, agroups, bgroups,
+                              agroup_index, bgroup_index)
+        row_nbrs = _get_sorted_nbrs(D, num_neighbors)
+        sr = np.arange(short_rows.shape[0])[:,None]
+        nbrs[short_rows] = row_nbrs
+        dists[short_rows] = D[sr, row_nbrs]
+
+    return nbrs, dists
+
+
+def calc_nbrs_with_engine(
+        adata,
+        nbr_fracs,
+        obsm_tag_gex = 'X_pca_gex',
+        obsm_tag_tcr = 'X_pca_tcr', # set to None to skip tcr calc
+        also_calc_nndists = False,
+        nbr_frac_for_nndists = None,
+        nbr_engine = 'kdtree',
+        use_exact_tcrdist_nbrs = False,
+        tmpfile_prefix = None, # only used if use_exact_tcrdist_nbrs and CPP
+):
+    ''' returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
+
+    like calc_nbrs, but uses a tree-based or approximate nearest neighbor
+    search (see NBR_ENGINES) in place of the full distance matrix
+
+    nbrs are sorted by increasing distance
+
+    nbrs exclude self and any clones in same atcr group or btcr group
+    '''
+    if also_calc_nndists:
+        assert nbr_frac_for_nndists in nbr_fracs
+
+    if use_exact_tcrdist_nbrs:
+        obsm_tag_tcr = None # dont do the standard calculation
+
+    if obsm_tag_tcr is not None and obsm_tag_tcr not in adata.obsm_keys():
+        print('calc_nbrs_with_engine: obsm_tag_tcr not present in adata.obsm'
+              ' calculating exact tcrdist nbrs')
+        obsm_tag_tcr = None
+        use_exact_tcrdist_nbrs = True
+
+    N = adata.shape[0]
+    max_num_neighbors = max(1, int(max(nbr_fracs)*N))
+
+    agroups, bgroups = setup_tcr_groups(adata)
+    agroup_index = setup_tcr_group_index(agroups)
+    bgroup_index = setup_tcr_group_index(bgroups)
+
+    all_nbrs = {}
+    for nbr_frac in nbr_fracs:
+        all_nbrs[nbr_frac] = [ None, None ]
+    nndists = [ None, None ]
+
+    for itag, (tag, obsm_tag) in enumerate([['gex', obsm_tag_gex],
+                                            ['tcr', obsm_tag_tcr]]):
+        if obsm_tag is None:
+            print('skipping', tag, 'nbr calc:', obsm_tag)
+            continue
+
+        nbrs, dists = _find_nbrs_with_engine(
+            adata.obsm[obsm_tag], max_num_neighbors, agroups, bgroups,
+            agroup_index, bgroup_index, nbr_engine)
+
+        # since they are sorted already:
+        for nbr_frac, nbrs_view in _get_nbr_frac_views(
+                nbrs, nbr_fracs, N).items():
+            all_nbrs[nbr_frac][itag] = nbrs_view
+
+        if also_calc_nndists:
+            num_neighbors = max(1, int(nbr_frac_for_nndists*N))
+            wts = np.linspace(1.0, 1.0/num_neighbors, num_neighbors)
+            wts /= np.sum(wts)
+            nndists[itag] = np.sum(
+                dists[:,:num_neighbors] * wts[np.newaxis,:], axis=1)
+
+    if use_exact_tcrdist_nbrs:
+        tcr_nbrs, tcr_nndists = calculate_tcrdist_nbrs(
+            adata, nbr_fracs, nbr_frac_for_nndists,
+            tmpfile_prefix=tmpfile_prefix)
+        for nbr_frac in nbr_fracs:
+            nbrs_gex,_ = all_nbrs[nbr_frac]
+            all_nbrs[nbr_frac] = [nbrs_gex, tcr_nbrs[nbr_frac]]
+        nndists[1] = tcr_nndists
+
+    if also_calc_nndists:
+        return all_nbrs, nndists[0], nndists[1]
+    else:
+        return all_nbrs
+
+
+def calc_nbr_recall( nbrs, exact_nbrs ):
+    ''' returns the recall@k for each clone, ie the fraction of the
+    exact_nbrs[ii] that are also in nbrs[ii]
+
+    nbrs and exact_nbrs are (N,K) arrays
+    '''
+    N, K = exact_nbrs.shape
+    assert nbrs.shape == (N,K)
+    rows = np.repeat(np.arange(N), K)
+    exact = csr_matrix((np.ones(N*K), (rows, exact_nbrs.ravel())), shape=(N,N))
+    other = csr_matrix((np.ones(N*K), (rows, nbrs.ravel())), shape=(N,N))
+    overlaps = np.asarray(exact.multiply(other).sum(axis=1)).ravel()
+    return overlaps / K
+
+
 def calc_nbrs_batched(
         adata,
         nbr_fracs,
@@ -1071,6 +1651,10 @@ def calc_nbrs_batched(
 ):
     ''' returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
 
+    nbrs are sorted by increasing distance. The nbrs arrays for the
+    different nbr_fracs are views into a single (N, Kmax) int32 array, where
+    Kmax is the number of nbrs for the largest nbr_frac
+
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
     if also_calc_nndists:
@@ -1092,19 +1676,21 @@ def calc_nbrs_batched(
     num_batches = (N-1)//batch_size + 1
 
     agroups, bgroups = setup_tcr_groups(adata)
-
-    all_nbrs = {}
-    for nbr_frac in nbr_fracs:
-        num_neighbors = max(1, int(nbr_frac*N))
-        all_nbrs[nbr_frac] = []
-        for (tag, obsm_tag) in [['gex', obsm_tag_gex], ['tcr', obsm_tag_tcr]]:
-            if obsm_tag is None:
-                all_nbrs[nbr_frac].append(None)
-                continue
-            print(f'allocating memory for {N*num_neighbors} {tag} nbrs')
-            all_nbrs[nbr_frac].append(np.zeros((N,num_neighbors), dtype=np.int32))
-            print(f'allocated {all_nbrs[nbr_frac][-1].nbytes} bytes memory id=',
-                  id(all_nbrs[nbr_frac][-1]))
+    agroup_index = setup_tcr_group_index(agroups)
+    bgroup_index = setup_tcr_group_index(bgroups)
+
+    # the nbrs for all the nbr_fracs are prefixes of the sorted nbrs for
+    #  the largest nbr_frac
+    max_num_neighbors = max(1, int(max(nbr_fracs)*N))
+    full_nbrs = [None, None]
+    for itag, (tag, obsm_tag) in enumerate([['gex', obsm_tag_gex],
+                                            ['tcr', obsm_tag_tcr]]):
+        if obsm_tag is None:
+            continue
+        print(f'allocating memory for {N*max_num_neighbors} {tag} nbrs')
+        full_nbrs[itag] = np.zeros((N,max_num_neighbors), dtype=np.int32)
+        print(f'allocated {full_nbrs[itag].nbytes} bytes memory id=',
+              id(full_nbrs[itag]))
 
     nndists = [ [], [] ]
 
@@ -1126,28 +1712,26 @@ def calc_nbrs_batched(
             # note that a clonotype is not included in its own neighbors:
             # nor will it be nbrs with any clonotypes having an identical nucleotide
             # sequence tcr chain (to be conservative about bad clonotype definitions)
-            for ii in batch_indices:
-                D[ii-b_start, (agroups==agroups[ii]) ] = 1e3
-                D[ii-b_start, (bgroups==bgroups[ii]) ] = 1e3
-
-            for nbr_frac in nbr_fracs:
-                num_neighbors = max(1, int(nbr_frac*N))
-                print(f'argpartitions: {tag} batch= {bb} nbr_frac= {nbr_frac}')
-                full_nbrs = all_nbrs[nbr_frac][itag]
-                full_nbrs[b_start:b_stop,:] = np.argpartition(
-                    D, num_neighbors-1 )[:,:num_neighbors]
-                #print(f'full_nbrs_id {nbr_frac} {id(full_nbrs)}')
-                #assert nbrs.shape == (D.shape[0], num_neighbors)
-                #all_nbrs[nbr_frac][itag].append(nbrs)
+            _mask_same_group_nbrs(D, batch_indices, agroups, bgroups,
+                                  agroup_index, bgroup_index)
 
-                if also_calc_nndists and nbr_frac == nbr_frac_for_nndists:
-                    nndists[itag].append(
-                        _calc_nndists(D, full_nbrs[b_start:b_stop,:]))
+            print(f'argpartition: {tag} batch= {bb} num_nbrs= {max_num_neighbors}')
+            full_nbrs[itag][b_start:b_stop,:] = _get_sorted_nbrs(
+                D, max_num_neighbors)
 
+            if also_calc_nndists:
+                num_neighbors = max(1, int(nbr_frac_for_nndists*N))
+                nndists[itag].append(_calc_nndists(
+                    D, full_nbrs[itag][b_start:b_stop,:num_neighbors]))
 
-    # for nbr_frac in nbr_fracs:
-    #     nbrslist_gex, nbrslist_tcr = all_nbrs[nbr_frac]
-    #     all_nbrs[nbr_frac] = [ np.vstack(nbrslist_gex), None if obsm_tag_tcr is None else np.vstack(nbrslist_tcr) ]
+    all_nbrs = {}
+    for nbr_frac in nbr_fracs:
+        all_nbrs[nbr_frac] = [ None, None ]
+    for itag in range(2):
+        if full_nbrs[itag] is not None:
+            for nbr_frac, nbrs_view in _get_nbr_frac_views(
+                    full_nbrs[itag], nbr_fracs, N).items():
+                all_nbrs[nbr_frac][itag] = nbrs_view
 
     if use_exact_tcrdist_nbrs:
         tcr_nbrs, tcr_nndists = calculate_tcrdist_nbrs(
@@ -1179,13 +1763,28 @@ def calc_nbrs(
         target_N_for_batching = 8192,
         use_exact_tcrdist_nbrs = False,
         tmpfile_prefix = None, # only used if use_exact_tcrdist_nbrs and CPP
-        sort_nbrs = False,
+        sort_nbrs = False, # no longer needed, nbrs are always sorted
+        nbr_engine = 'exact', # see NBR_ENGINES
 ):
     ''' returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
 
     nbrs exclude self and any clones in same atcr group or btcr group
+
+    nbrs are sorted by increasing distance. The nbrs arrays for the
+    different nbr_fracs are views into a single (N, Kmax) int32 array, where
+    Kmax is the number of nbrs for the largest nbr_frac
+
+    nbr_engine='exact' computes all the pairwise distances; the other
+    engines ('kdtree', 'nndescent') avoid that, see calc_nbrs_with_engine
     '''
-    if adata.shape[0] > 1.25*target_N_for_batching and not sort_nbrs: ## EARLY RETURN
+    if nbr_engine != 'exact': ## EARLY RETURN
+        return calc_nbrs_with_engine(
+            adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
+            nbr_frac_for_nndists, nbr_engine,
+            use_exact_tcrdist_nbrs=use_exact_tcrdist_nbrs,
+            tmpfile_prefix=tmpfile_prefix)
+
+    if adata.shape[0] > 1.25*target_N_for_batching: ## EARLY RETURN
         return calc_nbrs_batched(
             adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
             nbr_frac_for_nndists, target_N_for_batching,
@@ -1210,6 +1809,8 @@ def calc_nbrs(
     nndists = [ None, None ]
 
     agroups, bgroups = setup_tcr_groups(adata)
+    agroup_index = setup_tcr_group_index(agroups)
+    bgroup_index = setup_tcr_group_index(bgroups)
     for itag, (tag, obsm_tag) in enumerate([['gex', obsm_tag_gex], ['tcr', obsm_tag_tcr]]):
         if obsm_tag is None:
             print('skipping', tag, 'nbr calc:', obsm_tag)
@@ -1217,30 +1818,25 @@ def calc_nbrs(
 
         print('compute D', tag, adata.shape[0])
         D = pairwise_distances( adata.obsm[obsm_tag], metric='euclidean' )
-        for ii,(a,b) in enumerate(zip(agroups, bgroups)):
-            D[ii, (agroups==a) ] = 1e3
-            D[ii, (bgroups==b) ] = 1e3
-
-        for nbr_frac in nbr_fracs:
-            num_neighbors = max(1, int(nbr_frac*adata.shape[0]))
-            print('argpartitions:', nbr_frac, adata.shape[0], tag)
-            nbrs = np.argpartition( D, num_neighbors-1 )[:,:num_neighbors] # will NOT include self in there
-            if sort_nbrs:
-                ar = np.arange(adata.shape[0])[:,None]
-                inds = np.argsort(D[ar, nbrs])
-                nbrs = nbrs[ar, inds]
-                # hacking:
-                # d0 = D[np.arange(adata.shape[0]), nbrs[:,0]]
-                # d1 = D[np.arange(adata.shape[0]), nbrs[:,-1]]
-                # assert all(d0 <= d1)
-                # print('yay!')
-            assert nbrs.shape == (adata.shape[0], num_neighbors)
-            all_nbrs[nbr_frac][itag] = nbrs
-
-            if also_calc_nndists and nbr_frac == nbr_frac_for_nndists:
-                print('calculate nndists:', tag, nbr_frac)
-                nndists[itag] = _calc_nndists( D, nbrs )
-                print('DONE calculating nndists:', tag, nbr_frac)
+        _mask_same_group_nbrs(D, np.arange(adata.shape[0]), agroups, bgroups,
+                              agroup_index, bgroup_index)
+
+        # one argpartition for the largest nbr_frac; the smaller nbr_fracs
+        #  are prefixes of these sorted nbrs
+        N = adata.shape[0]
+        max_num_neighbors = max(1, int(max(nbr_fracs)*N))
+        print('argpartition:', max_num_neighbors, N, tag)
+        nbrs = _get_sorted_nbrs( D, max_num_neighbors ) # will NOT include self
+        assert nbrs.shape == (N, max_num_neighbors)
+        for nbr_frac, nbrs_view in _get_nbr_frac_views(
+                nbrs, nbr_fracs, N).items():
+            all_nbrs[nbr_frac][itag] = nbrs_view
+
+        if also_calc_nndists:
+            print('calculate nndists:', tag, nbr_frac_for_nndists)
+            nndists[itag] = _calc_nndists(
+                D, all_nbrs[nbr_frac_for_nndists][itag])
+            print('DONE calculating nndists:', tag, nbr_frac_for_nndists)
 
 
     if use_exact_tcrdist_nbrs:
@@ -1264,7 +1860,7 @@ def calculate_tcrdist_nbrs(
         nbr_fracs,
         nbr_frac_for_nndists = None, # if not None, calculate nndists at this nbr fraction
         tmpfile_prefix = None,
-        sort_nbrs = False,
+        sort_nbrs = False, # no longer needed, nbrs are always sorted
 ):
     ''' returns all_nbrs, nndists
 
@@ -1274,9 +1870,12 @@ def calculate_tcrdist_nbrs(
 
     this is a wrapper function around the c++ or python routines
 
+    nbrs are sorted by increasing distance; the nbrs for the smaller
+    nbr_fracs are views into the array for the largest nbr_frac
+
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
-    if util.tcrdist_cpp_available() or sort_nbrs: # tmp hack for sort_nbrs
+    if util.tcrdist_cpp_available():
         return calculate_tcrdist_nbrs_cpp(
             adata, nbr_fracs, nbr_frac_for_nndists,
             tmpfile_prefix=tmpfile_prefix,
@@ -1296,9 +1895,14 @@ def calculate_tcrdist_nbrs_python(
 
     nndists=None if nbr_frac_for_nndists is None
 
+    nbrs are sorted by increasing distance; the nbrs for the smaller
+    nbr_fracs are views into the array for the largest nbr_frac
+
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
     agroups, bgroups = setup_tcr_groups(adata)
+    agroup_index = setup_tcr_group_index(agroups)
+    bgroup_index = setup_tcr_group_index(bgroups)
 
     tcrs = retrieve_tcrs_from_adata(adata)
 
@@ -1306,49 +1910,129 @@ def calculate_tcrdist_nbrs_python(
 
     num_clones = adata.shape[0]
 
-    all_nbrs = {}
-    for nbr_frac in nbr_fracs:
-        all_nbrs[nbr_frac] = []
+    # the nbrs for all the nbr_fracs are prefixes of the sorted nbrs for
+    #  the largest nbr_frac
+    max_num_neighbors = max(1, int(max(nbr_fracs)*num_clones))
+    knn_indices = np.zeros((num_clones, max_num_neighbors), dtype=np.int32)
 
     nndists = []
 
-    for ii in range(num_clones):
-        if ii%1000==0:
-            print('recalculate_tcrdist_nbrs:', ii, num_clones)
-            sys.stdout.flush()
-        ii_tcr = tcrs[ii]
-        dists = np.array([ tcrdister(ii_tcr, x) for x in tcrs])
-        dists[ agroups==agroups[ii] ] = 1e3
-        dists[ bgroups==bgroups[ii] ] = 1e3
-        for nbr_frac in nbr_fracs: # could do this more efficiently by going in decreasing order, saving partitions...
-            num_neighbors = max(1, int(nbr_frac*num_clones))
-            ii_nbrs = np.argpartition(dists, num_neighbors-1 )[:num_neighbors]
-            all_nbrs[nbr_frac].append(ii_nbrs)
+    # blocks of rows of the tcrdist matrix
+    for b_start, b_stop, D in tcrdister.pairwise_chunks(tcrs, chunk_size=500):
+        print('recalculate_tcrdist_nbrs:', b_start, num_clones)
+        sys.stdout.flush()
+        _mask_same_group_nbrs(D, np.arange(b_start, b_stop), agroups, bgroups,
+                              agroup_index, bgroup_index)
+        knn_indices[b_start:b_stop] = _get_sorted_nbrs(D, max_num_neighbors)
         if nbr_frac_for_nndists is not None:
-            num_neighbors = max(1, int(nbr_frac_for_nndists*num_clones))
-            lowdists = np.sort( np.partition(dists, num_neighbors-1 )[:num_neighbors] )
+            num_nbrs = max(1, int(nbr_frac_for_nndists*num_clones))
+            ar = np.arange(b_stop-b_start)[:,None]
+            lowdists = D[ar, knn_indices[b_start:b_stop, :num_nbrs]]
             wts = np.linspace(1.0, 1.0/num_nbrs, num_nbrs)
-            nndists.append(np.sum( lowdists * wts )/np.sum(wts))
+            nndists.append(np.sum( lowdists * wts[None,:], axis=1)/np.sum(wts))
 
-    for nbr_frac in nbr_fracs:
-        num_neighbors = max(1, int(nbr_frac*num_clones))
-        all_nbrs[nbr_frac] = np.vstack(all_nbrs[nbr_frac])
-        assert all_nbrs[nbr_frac].shape == (num_clones, num_neighbors)
+    all_nbrs = _get_nbr_frac_views(knn_indices, nbr_fracs, num_clones)
 
     if nbr_frac_for_nndists is None:
         nndists = None
     else:
-        assert len(nndists) == num_clones
-        nndists = np.array(nndists)
+        nndists = np.hstack(nndists)
+        assert nndists.shape == (num_clones,)
 
     return all_nbrs, nndists
 
+def _read_exactly( fileobj, num_bytes ):
+    ''' read num_bytes from fileobj (which may be a pipe) '''
+    chunks = []
+    while num_bytes > 0:
+        chunk = fileobj.read(num_bytes)
+        if not chunk:
+            print('ERROR unexpected end of find_neighbors binary output')
+            exit(1)
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b''.join(chunks)
+
+def read_tcrdist_cpp_binary_output( fileobj, num_rows_per_chunk = 1024 ):
+    ''' Read the output of find_neighbors --binary (see tcrdist_cpp/src/io.hh)
+    from fileobj, which can be an open file or a pipe
+
+    returns knn_indices (int32), knn_distances (uint16) for knn output or
+    the uint16 distance matrix for --only_tcrdists output
+
+    rows are read in chunks so we never hold more than one copy of the data
+    '''
+    header = _read_exactly(fileobj, 12)
+    tag = header[:4]
+    num_rows, num_cols = np.frombuffer(header[4:], dtype='<u4')
+    if tag == b'TDKN':
+        row_dtype = np.dtype([('indices', '<i4', (num_cols,)),
+                              ('distances', '<u2', (num_cols,))])
+        knn_indices = np.zeros((num_rows, num_cols), dtype=np.int32)
+        knn_distances = np.zeros((num_rows, num_cols), dtype=np.uint16)
+    elif tag == b'TDMX':
+        row_dtype = np.dtype(('<u2', (num_cols,)))
+        D = np.zeros((num_rows, num_cols), dtype=np.uint16)
+    else:
+        print('ERROR bad find_neighbors binary output header:', header)
+        exit(1)
+
+    for start in range(0, num_rows, num_rows_per_chunk):
+        stop = min(num_rows, start+num_rows_per_chunk)
+        rows = np.frombuffer(
+            _read_exactly(fileobj, (stop-start)*row_dtype.itemsize),
+            dtype=row_dtype)
+        if tag == b'TDKN':
+            knn_indices[start:stop] = rows['indices']
+            knn_distances[start:stop] = rows['distances']
+        else:
+            D[start:stop] = rows
+
+    if tag == b'TDKN':
+        return knn_indices, knn_distances
+    else:
+        return D
+
+def run_tcrdist_cpp_binary( exe, args, outprefix, verbose = False ):
+    ''' Run find_neighbors (exe) in --binary mode with the list of
+    commandline arguments in args (should include either -n or
+    --only_tcrdists but not -o) and return the parsed output, see
+    read_tcrdist_cpp_binary_output
+
+    On posix systems the output is streamed through a pipe, otherwise it goes
+    through the file <outprefix>_knn.bin or <outprefix>_tcrdists.bin
+    '''
+    args = [str(exe)] + [str(x) for x in args] + ['-o', str(outprefix)]
+    if os.name == 'posix':
+        args.append('--stdout')
+        if verbose:
+            print('run_tcrdist_cpp_binary: cmd=', ' '.join(args))
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        result = read_tcrdist_cpp_binary_output(proc.stdout)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            print('find_neighbors failed:', ' '.join(args))
+            exit(1)
+    else:
+        args.append('--binary')
+        util.run_command(' '.join(args), verbose=verbose)
+        suffix = '_tcrdists.bin' if '--only_tcrdists' in args else '_knn.bin'
+        binfile = str(outprefix) + suffix
+        if not exists(binfile):
+            print('find_neighbors failed, missing', binfile)
+            exit(1)
+        with open(binfile, 'rb') as data:
+            result = read_tcrdist_cpp_binary_output(data)
+        os.remove(binfile)
+    return result
+
+
 def calculate_tcrdist_nbrs_cpp(
         adata,
         nbr_fracs,
         nbr_frac_for_nndists = None,
         tmpfile_prefix = None,
-        sort_nbrs = False,
+        sort_nbrs = False, # no longer needed, nbrs are always sorted
 ):
     ''' returns all_nbrs, nndists
 
@@ -1356,6 +2040,9 @@ def calculate_tcrdist_nbrs_cpp(
 
     nndists=None if nbr_frac_for_nndists is None
 
+    nbrs are sorted by increasing distance; the nbrs for the smaller
+    nbr_fracs are views into the array for the largest nbr_frac
+
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
     if tmpfile_prefix is None:
@@ -1395,82 +2082,29 @@ def calculate_tcrdist_nbrs_cpp(
 
     outprefix = str(tmpfile_prefix) +'_calc_tcrdist'
 
-    cmd = '{} -f {} -n {} -d {} -o {} -a {} -b {}'\
-          .format(exe, tcrs_filename, num_nbrs, db_filename, outprefix,
-                  agroups_filename, bgroups_filename)
-
-    util.run_command(cmd, verbose=True)
-
-    knn_indices_filename = outprefix+'_knn_indices.txt'
-    knn_distances_filename = outprefix+'_knn_distances.txt'
-
-    if not exists(knn_indices_filename) or not exists(knn_distances_filename):
-        print('find_neighbors failed:', exists(knn_indices_filename),
-              exists(knn_distances_filename))
-        exit(1)
-
     # try to conserve memory here. The distances are actually ints
-    # in the [0,1000] (probably mostly [0,500])
-    print(f'reading array of size {N}x{num_nbrs} from {knn_indices_filename}')
-    knn_indices = np.loadtxt(knn_indices_filename, dtype=np.int32)
-    print(f'reading array of size {N}x{num_nbrs} from {knn_distances_filename}')
-    knn_distances = np.loadtxt(knn_distances_filename, dtype=np.float32)
-
-    if knn_indices.shape == (N,):
-        assert num_nbrs==1
-        knn_indices = knn_indices[:,None]
-    if knn_distances.shape == (N,):
-        assert num_nbrs==1
-        knn_distances = knn_distances[:,None]
+    # in the [0,1000] (probably mostly [0,500]) so they come back as uint16
+    print(f'reading arrays of size {N}x{num_nbrs} from find_neighbors')
+    knn_indices, knn_distances = run_tcrdist_cpp_binary(
+        exe, ['-f', tcrs_filename, '-n', num_nbrs, '-d', db_filename,
+              '-a', agroups_filename, '-b', bgroups_filename],
+        outprefix, verbose=True)
 
     assert knn_indices.shape == (N,num_nbrs)
     assert knn_distances.shape == (N,num_nbrs)
 
-    if sort_nbrs:
-        print('argsort!')
-        inds = np.argsort(knn_distances)#axis is -1 by default
-        ar = np.arange(N)[:,None]
-        knn_indices   = knn_indices  [ar, inds]
-        knn_distances = knn_distances[ar, inds]
+    # sort once; the nbrs for the smaller nbr_fracs are prefixes of these.
+    # find_neighbors shuffles tied nbrs, so use a stable sort to keep that
+    print('argsort!')
+    inds = np.argsort(knn_distances, kind='stable') #axis is -1 by default
+    ar = np.arange(N)[:,None]
+    knn_indices   = knn_indices  [ar, inds]
+    knn_distances = knn_distances[ar, inds]
 
-    all_nbrs = {}
-    all_nbrs[max_nbr_frac] = knn_indices
-    # probably paranoid here, but I don't like the full argpartition below
-    if N<1000:
-        num_batches = 1
-        batch_size = N
-    else:
-        num_batches = 4
-        batch_size = (N-1)//num_batches + 1
+    all_nbrs = _get_nbr_frac_views(knn_indices, nbr_fracs, N)
+    print(f'all_nbrs tcrdist using {knn_indices.nbytes} bytes')
 
-    for nbr_frac in nbr_fracs:
-        if nbr_frac == max_nbr_frac:
-            print(f'all_nbrs tcrdist using {all_nbrs[nbr_frac].nbytes} bytes',
-                  f'nbr_frac= {nbr_frac}')
-            continue
-        num_nbrs = max(1, int(nbr_frac*N))
-        assert num_nbrs <= knn_indices.shape[1]
-        if sort_nbrs:
-            # since they are sorted already:
-            all_nbrs[nbr_frac] = knn_indices[:,:num_nbrs]
-        else:
-            # use argpartition instead
-            all_nbrs[nbr_frac] = np.zeros((N,num_nbrs), dtype=np.int32)
-
-            print(f'all_nbrs tcrdist using {all_nbrs[nbr_frac].nbytes} bytes',
-                  f'nbr_frac= {nbr_frac}')
-            for bb in range(num_batches):
-                b_start = bb*batch_size
-                b_stop = min(N, (bb+1)*batch_size)
-                #batch_indices = np.arange(b_start, b_stop)
-                inds = np.argpartition(
-                    knn_distances[b_start:b_stop,:], num_nbrs-1)[:,:num_nbrs]
-                ar = np.arange(b_start,b_stop)[:,np.newaxis]
-                all_nbrs[nbr_frac][b_start:b_stop,:] = knn_indices[ar,inds]
-
-
-    for filename in [tcrs_filename, agroups_filename, bgroups_filename,
-                     knn_indices_filename, knn_distances_filename]:
+    for filename in [tcrs_filename, agroups_filename, bgroups_filename]:
         os.remove(filename)
 
     if nbr_frac_for_nndists is None:
@@ -1478,7 +2112,7 @@ def calculate_tcrdist_nbrs_cpp(
     else:
         num_nbrs = max(1, int(nbr_frac_for_nndists*adata.shape[0]))
         assert num_nbrs <= knn_indices.shape[1]
-        dists = np.sort( np.partition( knn_distances, num_nbrs-1)[:,:num_nbrs], axis=1)
+        dists = knn_distances[:,:num_nbrs] # already sorted
         wts = np.linspace(1.0, 1.0/num_nbrs, num_nbrs)
         wts /= np.sum(wts)
         nndists = np.sum( dists * wts[np.newaxis,:], axis=1)
@@ -1539,6 +2173,288 @@ def setup_tcr_cluster_names(adata):
     adata.uns['clusters_tcr_names'] = names
 
 
+def compact_tcrdist_matrix(
+        D,
+        max_value = None,
+        block_size = 1000,
+):
+    ''' Returns a copy of the tcrdist matrix D rounded to integers and stored
+    as uint16, or as uint8 if all the values are <= 255. If max_value is not
+    None the values are capped at max_value first, which is fine for uses
+    that don't distinguish between distances above a threshold.
+
+    The conversion is done in blocks of rows to avoid float temporaries
+    '''
+    dmax = D.max() if max_value is None else min(D.max(), max_value)
+    assert dmax < 65536
+    dtype = np.uint8 if dmax <= 255 else np.uint16
+    if D.dtype == dtype:
+        return D
+    D_compact = np.zeros(D.shape, dtype=dtype)
+    for start in range(0, D.shape[0], block_size):
+        block = D[start:start+block_size]
+        if max_value is not None:
+            block = np.minimum(block, max_value)
+        if block.dtype.kind == 'f':
+            block = np.rint(block)
+        D_compact[start:start+block_size] = block
+    return D_compact
+
+def calc_tcrdist_matrix_python(
+        tcrs,
+        organism,
+        compact = True,
+        target_tcrs = None,
+):
+    ''' returns the full tcrdist matrix computed with the python
+    TcrDistCalculator, as uint16 if compact (see compact_tcrdist_matrix)
+
+    if target_tcrs is not None, returns the len(tcrs) x len(target_tcrs)
+    matrix of distances from tcrs to target_tcrs
+    '''
+    tcrdist_calculator = TcrDistCalculator(organism)
+    if not compact:
+        return tcrdist_calculator.pairwise(tcrs, target_tcrs)
+    num_cols = len(tcrs) if target_tcrs is None else len(target_tcrs)
+    D = np.zeros((len(tcrs), num_cols), dtype=np.uint16)
+    for start, stop, D_chunk in tcrdist_calculator.pairwise_chunks(
+            tcrs, target_tcrs):
+        D[start:stop] = np.rint(D_chunk)
+    return D
+
+def calc_tcrdist_kernel_gram(
+        D,
+        kernel = None, # either None (-->default) or 'gaussian'
+        Dmax = None, # only used if kernel is None, default is D.max()
+        gaussian_kernel_sdev = 100.0, #unused unless kernel=='gaussian'
+        block_size = 1000,
+):
+    ''' Returns the float64 kernel matrix for KernelPCA. D can be compact
+    (see compact_tcrdist_matrix); rows are converted to float one block at a
+    time
+    '''
+    if kernel is None:
+        if Dmax is None:
+            Dmax = D.max()
+    elif kernel != 'gaussian':
+        print('conga.preprocess.calc_tcrdist_kernel_gram:',
+              'unrecognized kernel:', kernel)
+        sys.exit(1)
+
+    gram = np.zeros(D.shape)
+    for start in range(0, D.shape[0], block_size):
+        block = D[start:start+block_size].astype(float)
+        if kernel is None:
+            gram[start:start+block_size] = np.maximum(0.0, 1 - ( block / Dmax ))
+        else:
+            gram[start:start+block_size] = np.exp(
+                -0.5 * (block/gaussian_kernel_sdev)**2 )
+    return gram
+
+
+KPCA_SOLVERS = ['exact', 'randomized', 'nystroem']
+
+def calc_tcrdist_block(
+        tcrs,
+        target_tcrs,
+        organism,
+        compact = True,
+):
+    ''' returns the len(tcrs) x len(target_tcrs) matrix of tcrdists, using
+    the C++ calculator if it's available
+    '''
+    if tcrdist_cpp_available():
+        return calc_tcrdist_matrix_cpp(tcrs, organism, compact=compact,
+                                       target_tcrs=target_tcrs)
+    else:
+        return calc_tcrdist_matrix_python(tcrs, organism, compact=compact,
+                                          target_tcrs=target_tcrs)
+
+def calc_nystroem_tcrdist_kpcs(
+        tcrs,
+        organism,
+        n_components = 50,
+        num_landmarks = 2000,
+        kernel = None, # either None (-->default) or 'gaussian'
+        gaussian_kernel_sdev = 100.0, #unused unless kernel=='gaussian'
+        force_Dmax = None,
+        random_state = 0,
+        verbose = False,
+        return_model = False,
+):
+    ''' Approximate TCRdist kernel PCs from a Nystroem (landmark)
+    approximation of the kernel matrix
+
+    Only the len(tcrs) x num_landmarks block of tcrdists is computed, so
+    memory and time are linear in the number of clones. The landmarks are a
+    random subset of the clones (chosen with random_state).
+
+    Each clone is mapped to the feature vector K_nm U S^{-1/2}, where
+    U S U^T is the eigendecomposition of the landmark kernel matrix K_mm, and
+    then we do ordinary (centered) PCA on these features. This is exact
+    kernel PCA for the kernel matrix K_nm K_mm^-1 K_mn
+
+    if kernel is None and force_Dmax is None, Dmax is the largest distance
+    in the clones x landmarks block
+
+    returns xy, the n_components PCs (num_clones x n_components), or
+    xy, model if return_model (see project_clones_onto_tcrdist_kpca)
+    '''
+    num_clones = len(tcrs)
+    num_landmarks = min(num_landmarks, num_clones)
+    n_components = min(n_components, num_landmarks)
+
+    rng = np.random.default_rng(random_state)
+    landmarks = np.sort(rng.choice(num_clones, num_landmarks, replace=False))
+    landmark_tcrs = [tcrs[x] for x in landmarks]
+
+    print(f'calc_nystroem_tcrdist_kpcs: compute tcrdists from {num_clones}',
+          f'clonotypes to {num_landmarks} landmarks')
+    D = calc_tcrdist_block(tcrs, landmark_tcrs, organism)
+    if kernel is None and force_Dmax is None:
+        force_Dmax = D.max()
+
+    K_nm = calc_tcrdist_kernel_gram(
+        D, kernel=kernel, Dmax=force_Dmax,
+        gaussian_kernel_sdev=gaussian_kernel_sdev)
+    del D
+    K_mm = K_nm[landmarks]
+
+    # the 1-D/Dmax kernel is not always positive semi-definite; drop the
+    #  negative and tiny eigenvalues
+    evals, evecs = np.linalg.eigh(K_mm)
+    mask = evals > 1e-8 * evals.max()
+    if verbose:
+        print('calc_nystroem_tcrdist_kpcs: num_dropped_landmark_evals=',
+              np.sum(~mask))
+    feature_map = evecs[:,mask] / np.sqrt(evals[mask])[None,:]
+    features = K_nm @ feature_map
+    del K_nm
+    feature_means = features.mean(axis=0)
+    features -= feature_means[None,:]
+
+    U, S, Vt = np.linalg.svd(features, full_matrices=False)
+    xy = U[:,:n_components] * S[None,:n_components]
+
+    if verbose: #show the eigenvalues
+        for ii in range(n_components):
+            print( 'eigenvalue: {:3d} {:.3f}'.format( ii, S[ii]**2))
+
+    if not return_model:
+        return xy
+
+    # xy = (K_nm @ feature_map - feature_means) @ V
+    components = feature_map @ Vt[:n_components].T
+    model = make_tcrdist_kpca_model(
+        landmark_tcrs, organism, components, S[:n_components]**2, kernel,
+        force_Dmax, gaussian_kernel_sdev, center_kernel_rows=False,
+        offset=feature_means @ Vt[:n_components].T)
+    return xy, model
+
+
+def make_tcrdist_kpca_model(
+        reference_tcrs,
+        organism,
+        components,
+        eigenvalues,
+        kernel,
+        Dmax,
+        gaussian_kernel_sdev,
+        center_kernel_rows,
+        offset,
+):
+    ''' The information needed to project new clonotypes into the space of a
+    fitted TCRdist kernel PCA, as a dict. The projection of a set of tcrs is
+
+      K = kernel matrix of tcrdists from tcrs to reference_tcrs
+      if center_kernel_rows: K -= row means of K
+      xy = K @ components - offset
+
+    for exact kernel PCA the reference_tcrs are all the fitted clones,
+    components are the eigenvectors divided by sqrt(eigenvalues), and offset
+    comes from the kernel centering terms. For the Nystroem approximation
+    the reference_tcrs are the landmarks
+    '''
+    return dict(
+        organism = organism,
+        reference_tcrs = [(tuple(x[0][:3]), tuple(x[1][:3]))
+                          for x in reference_tcrs],
+        components = np.asarray(components, dtype=float),
+        eigenvalues = np.asarray(eigenvalues, dtype=float),
+        kernel = kernel,
+        Dmax = None if Dmax is None else float(Dmax),
+        gaussian_kernel_sdev = float(gaussian_kernel_sdev),
+        center_kernel_rows = bool(center_kernel_rows),
+        offset = np.asarray(offset, dtype=float),
+    )
+
+def save_tcrdist_kpca_model( model, filename ):
+    ''' Save the output of make_tcrdist_kpca_model to a .npz file
+    '''
+    tcrs = model['reference_tcrs']
+    np.savez(
+        filename,
+        organism = model['organism'],
+        reference_tcrs = np.array([x[0]+x[1] for x in tcrs], dtype=str),
+        components = model['components'],
+        eigenvalues = model['eigenvalues'],
+        kernel = '' if model['kernel'] is None else model['kernel'],
+        Dmax = np.nan if model['Dmax'] is None else model['Dmax'],
+        gaussian_kernel_sdev = model['gaussian_kernel_sdev'],
+        center_kernel_rows = model['center_kernel_rows'],
+        offset = model['offset'],
+    )
+
+def load_tcrdist_kpca_model( filename ):
+    ''' Load a model saved with save_tcrdist_kpca_model
+    '''
+    with np.load(filename) as data:
+        kernel = str(data['kernel'])
+        Dmax = float(data['Dmax'])
+        return make_tcrdist_kpca_model(
+            [(tuple(x[:3]), tuple(x[3:])) for x in data['reference_tcrs']],
+            str(data['organism']), data['components'], data['eigenvalues'],
+            kernel if kernel else None, None if np.isnan(Dmax) else Dmax,
+            float(data['gaussian_kernel_sdev']),
+            bool(data['center_kernel_rows']), data['offset'])
+
+def project_clones_onto_tcrdist_kpca(
+        tcrs,
+        model,
+        block_size = 5000,
+):
+    ''' Project new clonotypes into an existing TCRdist kernel PC space,
+    without refitting
+
+    model is the output of make_tcrdist_kpca_model or a filename for
+    load_tcrdist_kpca_model (see the model_file argument to
+    make_tcrdist_kernel_pcs_file_from_clones_file)
+
+    only the tcrs x reference_tcrs block of tcrdists is computed, one block
+    of block_size tcrs at a time
+
+    returns xy, shape (len(tcrs), num_components)
+    '''
+    if not isinstance(model, dict):
+        model = load_tcrdist_kpca_model(model)
+
+    reference_tcrs = model['reference_tcrs']
+    xy = np.zeros((len(tcrs), model['components'].shape[1]))
+    for start in range(0, len(tcrs), block_size):
+        stop = min(len(tcrs), start+block_size)
+        print('project_clones_onto_tcrdist_kpca:', start, len(tcrs),
+              'num_reference_tcrs:', len(reference_tcrs))
+        D = calc_tcrdist_block(tcrs[start:stop], reference_tcrs,
+                               model['organism'])
+        K = calc_tcrdist_kernel_gram(
+            D, kernel=model['kernel'], Dmax=model['Dmax'],
+            gaussian_kernel_sdev=model['gaussian_kernel_sdev'])
+        if model['center_kernel_rows']:
+            K -= K.mean(axis=1)[:,None]
+        xy[start:stop] = K @ model['components'] - model['offset'][None,:]
+    return xy
+
+
 def make_tcrdist_kernel_pcs_file_from_clones_file(
         clones_file,
         organism,
@@ -1553,7 +2469,30 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
         force_tcrdist_cpp = False,
         tcrs = None,
         return_pcs = False, # default is to write to a file
+        compact_tcrdists = True, # store distances as uint16/uint8, not float
+        kpca_solver = 'exact', # see KPCA_SOLVERS
+        num_landmarks = 2000, # unused unless kpca_solver=='nystroem'
+        random_state = 0, # unused if kpca_solver=='exact'
+        model_file = None, # if not None, save fitted model here (.npz)
 ):
+    ''' Compute TCRdist kernel PCs for the clonotypes in clones_file (or
+    in tcrs, if not None)
+
+    kpca_solver can be
+      'exact': full tcrdist matrix, dense eigendecomposition
+      'randomized': full tcrdist matrix, randomized eigensolver for the top
+         n_components eigenvectors (faster for large numbers of clones)
+      'nystroem': only distances to num_landmarks random clonotypes, see
+         calc_nystroem_tcrdist_kpcs (linear rather than quadratic memory)
+
+    if model_file is not None, the fitted model is saved there so that new
+    clonotypes can be added later with project_clones_onto_tcrdist_kpca
+    '''
+    if kpca_solver not in KPCA_SOLVERS:
+        print('conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file::',
+              'unrecognized kpca_solver:', kpca_solver)
+        sys.exit(1)
+
     if (not return_pcs) and outfile is None:
         # this is the name expected by read_dataset above
         #  (with n_components_in==50)
@@ -1568,49 +2507,93 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
                  (l.vb_gene, l.jb_gene, l.cdr3b)) for l in df.itertuples()]
         ids = [l.clone_id for l in df.itertuples()]
 
-
-    if input_distfile is None: ## tcr distances
+    if kpca_solver == 'nystroem':
+        if input_distfile is not None or output_distfile is not None:
+            print('conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file::',
+                  'input_distfile/output_distfile not compatible with',
+                  'nystroem kpca_solver')
+            sys.exit(1)
+        xy, model = calc_nystroem_tcrdist_kpcs(
+            tcrs, organism, n_components=n_components_in,
+            num_landmarks=num_landmarks, kernel=kernel,
+            gaussian_kernel_sdev=gaussian_kernel_sdev, force_Dmax=force_Dmax,
+            random_state=random_state, verbose=verbose, return_model=True)
+        num_clones, n_components = xy.shape
+
+    elif input_distfile is None: ## tcr distances
         print(f'compute tcrdist distance matrix for {len(tcrs)} clonotypes')
 
         if tcrdist_cpp_available():
             print('Using C++ TCRdist calculator')
-            D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile)
+            D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile,
+                                        compact=compact_tcrdists)
         else:
             print('Using Python TCRdist calculator. Consider compiling',
                   'C++ calculator for faster perfomance.')
-            tcrdist_calculator = TcrDistCalculator(organism)
-            D = np.array([tcrdist_calculator(x,y) for x in tcrs for y in tcrs])\
-                  .reshape((len(tcrs), len(tcrs)))
+            D = calc_tcrdist_matrix_python(tcrs, organism,
+                                           compact=compact_tcrdists)
     else:
         print(f'reload tcrdist distance matrix for {len(tcrs)} clonotypes')
         D = np.loadtxt(input_distfile)
+        if compact_tcrdists:
+            D = compact_tcrdist_matrix(D)
 
-    if output_distfile is not None:
-        np.savetxt( output_distfile, D.astype(float), fmt='%.1f')
+    if kpca_solver != 'nystroem':
+        if output_distfile is not None:
+            np.savetxt( output_distfile, D, fmt='%.1f')
 
-    n_components = min( n_components_in, D.shape[0] )
+        num_clones = D.shape[0]
+        n_components = min( n_components_in, num_clones )
 
-    print(f'running KernelPCA with {kernel} kernel distance matrix',
-          f'shape= {D.shape} D.max()= {D.max()} force_Dmax= {force_Dmax}')
+        print(f'running KernelPCA with {kernel} kernel distance matrix',
+              f'shape= {D.shape} dtype= {D.dtype} D.max()= {D.max()}',
+              f'force_Dmax= {force_Dmax} kpca_solver= {kpca_solver}')
 
-    pca = KernelPCA(kernel='precomputed', n_components=n_components)
+        if (compact_tcrdists and kernel is None and force_Dmax is not None and
+            force_Dmax <= 255):
+            # distances beyond force_Dmax all have kernel value 0, so cap them
+            D = compact_tcrdist_matrix(D, max_value=int(np.ceil(force_Dmax)))
 
-    if kernel is None:
-        if force_Dmax is None:
-            force_Dmax = D.max()
-        gram = np.maximum(0.0, 1 - ( D / force_Dmax ))
-    elif kernel == 'gaussian':
-        gram = np.exp(-0.5 * (D/gaussian_kernel_sdev)**2 )
-    else:
-        print('conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file:',
-              'unrecognized kernel:', kernel)
-        sys.exit(1)
+        if kpca_solver == 'randomized':
+            pca = KernelPCA(kernel='precomputed', n_components=n_components,
+                            eigen_solver='randomized',
+                            random_state=random_state)
+        else:
+            pca = KernelPCA(kernel='precomputed', n_components=n_components)
 
-    xy = pca.fit_transform(gram)
+        if kernel is None and force_Dmax is None:
+            force_Dmax = D.max()
 
-    if verbose: #show the eigenvalues
-        for ii in range(n_components):
-            print( 'eigenvalue: {:3d} {:.3f}'.format( ii, pca.lambdas_[ii]))
+        gram = calc_tcrdist_kernel_gram(
+            D, kernel=kernel, Dmax=force_Dmax,
+            gaussian_kernel_sdev=gaussian_kernel_sdev)
+        del D # free up memory before the eigendecomposition
+
+        if model_file is not None:
+            # kernel centering terms; KernelPCA may center gram in place
+            K_fit_rows = gram.mean(axis=0)
+            K_fit_all = K_fit_rows.mean()
+
+        xy = pca.fit_transform(gram)
+
+        if verbose: #show the eigenvalues
+            for ii in range(n_components):
+                print( 'eigenvalue: {:3d} {:.3f}'.format( ii, pca.eigenvalues_[ii]))
+
+        if model_file is not None:
+            lambdas = pca.eigenvalues_
+            components = np.zeros(pca.eigenvectors_.shape)
+            nonzero = lambdas > 0
+            components[:,nonzero] = (pca.eigenvectors_[:,nonzero] /
+                                     np.sqrt(lambdas[nonzero])[None,:])
+            model = make_tcrdist_kpca_model(
+                tcrs, organism, components, lambdas, kernel, force_Dmax,
+                gaussian_kernel_sdev, center_kernel_rows=True,
+                offset=(K_fit_rows - K_fit_all) @ components)
+
+    if model_file is not None:
+        print('writing TCRdist kPCA model to', model_file)
+        save_tcrdist_kpca_model(model, model_file)
 
     if return_pcs:
         return xy ######################### NOTE EARLY RETURN
@@ -1621,7 +2604,7 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
         print( 'writing TCRdist kernel PCs to outfile:', outfile)
         out = open(outfile,'w')
 
-        for ii in range(D.shape[0]):
+        for ii in range(num_clones):
             out.write('pc_comps: {} {}\n'\
                       .format(ids[ii], ' '.join('{:.6f}'.format(xy[ii,j])
                                                 for j in range(n_components))))
@@ -1635,7 +2618,8 @@ def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
         tcrdist_threshold,
         organism,
         output_distfile=None,
-        force_tcrdist_cpp=False
+        force_tcrdist_cpp=False,
+        compact_tcrdists=True, # store distances as uint16, not float
 ):
 
     df = pd.read_csv(old_clones_file, sep='\t')
@@ -1732,10 +2716,11 @@ def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
         print(f'compute tcrdist distance matrix for {len(tcrs)} clonotypes')
         sys.stdout.flush()
         if force_tcrdist_cpp or (util.tcrdist_cpp_available() and N>5000):
-            D = calc_tcrdist_matrix_cpp(tcrs, organism)
+            D = calc_tcrdist_matrix_cpp(tcrs, organism,
+                                        compact=compact_tcrdists)
         else:
-            tcrdist_calculator = TcrDistCalculator(organism)
-            D = np.array( [ tcrdist_calculator(x,y) for x in tcrs for y in tcrs ] ).reshape( (len(tcrs), len(tcrs)) )
+            D = calc_tcrdist_matrix_python(tcrs, organism,
+                                           compact=compact_tcrdists)
 
         DT = squareform(D, force='tovector')
 
@@ -1791,7 +2776,7 @@ def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
 
     if output_distfile is not None:
         new_D = D[cluster_centers,:][:,cluster_centers]
-        np.savetxt( output_distfile, new_D.astype(float), fmt='%.1f')
+        np.savetxt( output_distfile, new_D, fmt='%.1f')
 
 
 def calc_tcrdist_nbrs_umap_clusters_cpp(
@@ -1844,22 +2829,11 @@ def calc_tcrdist_nbrs_umap_clusters_cpp(
         #  to component_layout
         #
         # compute the tcrdist neighbors
-        cmd = '{} -f {} -n {} -d {} -o {}'.format(
-            exe, tcrs_filename, num_nbrs, db_filename, outprefix)
-
-        util.run_command(cmd, verbose=True)
-
-        knn_indices_filename = outprefix+'_knn_indices.txt'
-        knn_distances_filename = outprefix+'_knn_distances.txt'
-
-        if (not exists(knn_indices_filename) or
-            not exists(knn_distances_filename)):
-            print('find_neighbors failed:', exists(knn_indices_filename),
-                  exists(knn_distances_filename))
-            exit(1)
-
-        knn_indices = np.loadtxt(knn_indices_filename, dtype=int)
-        knn_distances = np.loadtxt(knn_distances_filename, dtype=float)
+        knn_indices, knn_distances = run_tcrdist_cpp_binary(
+            exe, ['-f', tcrs_filename, '-n', num_nbrs, '-d', db_filename],
+            outprefix, verbose=True)
+        knn_indices = knn_indices.astype(int)
+        knn_distances = knn_distances.astype(float)
 
         #distances=sc.neighbors.get_sparse_matrix_from_indices_distances_numpy(
         #     knn_indices, knn_distances, adata.shape[0], num_nbrs)
@@ -1950,25 +2924,37 @@ def calc_tcrdist_nbrs_umap_clusters_cpp(
     del adata.obsm['X_umap'] # delete the extra umap copy
 
     # cleanup the tmpfiles
-    for filename in [knn_indices_filename,
-                     knn_distances_filename,
-                     tcrs_filename]:
-        os.remove(filename)
+    os.remove(tcrs_filename)
 
 def calc_tcrdist_matrix_cpp(
         tcrs,
         organism,
         tmpfile_prefix = None,
         verbose=False,
+        compact=False,
+        target_tcrs=None,
 ):
+    ''' returns the full tcrdist matrix, as a float array or as a uint16
+    array if compact is True (see compact_tcrdist_matrix)
+
+    if target_tcrs is not None, returns the len(tcrs) x len(target_tcrs)
+    matrix of distances from tcrs to target_tcrs
+    '''
     if tmpfile_prefix is None:
         tmpfile_prefix = Path('./tmp_tcrdists{}'.format(random.randrange(1,10000)))
 
     tcrs_filename = str(tmpfile_prefix) +'_tcrs.tsv'
+    target_tcrs_filename = str(tmpfile_prefix) +'_target_tcrs.tsv'
 
-    df = pd.DataFrame(dict(va=[x[0][0] for x in tcrs], cdr3a=[x[0][2] for x in tcrs],
-                           vb=[x[1][0] for x in tcrs], cdr3b=[x[1][2] for x in tcrs]))
-    df.to_csv(tcrs_filename, sep='\t', index=False)
+    for filename, ftcrs in [[tcrs_filename, tcrs],
+                            [target_tcrs_filename, target_tcrs]]:
+        if ftcrs is None:
+            continue
+        df = pd.DataFrame(dict(va=[x[0][0] for x in ftcrs],
+                               cdr3a=[x[0][2] for x in ftcrs],
+                               vb=[x[1][0] for x in ftcrs],
+                               cdr3b=[x[1][2] for x in ftcrs]))
+        df.to_csv(filename, sep='\t', index=False)
 
     if os.name == 'posix':
         exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
@@ -1985,20 +2971,16 @@ def calc_tcrdist_matrix_cpp(
         print('need to create database file:', db_filename)
         exit(1)
 
-    cmd = '{} -f {} --only_tcrdists -d {} -o {}'.format(exe, tcrs_filename, db_filename, tmpfile_prefix)
-
-    util.run_command(cmd, verbose=verbose)
-
-    tcrdist_matrix_filename = str(tmpfile_prefix) +'_tcrdists.txt'
-
-    if not exists(tcrdist_matrix_filename):
-        print('find_neighbors failed, missing', tcrdist_matrix_filename)
-        exit(1)
-
-    D = np.loadtxt(tcrdist_matrix_filename).astype(float)
+    cmd_args = ['-f', tcrs_filename, '--only_tcrdists', '-d', db_filename]
+    if target_tcrs is not None:
+        cmd_args.extend(['-g', target_tcrs_filename])
+    D = run_tcrdist_cpp_binary(exe, cmd_args, tmpfile_prefix, verbose=verbose)
+    if not compact:
+        D = D.astype(float)
 
-    for filename in [tcrs_filename, tcrdist_matrix_filename]:
-        os.remove(filename)
+    os.remove(tcrs_filename)
+    if target_tcrs is not None:
+        os.remove(target_tcrs_filename)
 
     return D
 
@@ -2225,8 +3207,7 @@ def make_tcrdist_kernel_pcs_file_from_clones_file_V2(
         D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile)
     else:
         print('Using Python TCRdist calculator. Consider compiling C++ calculator for faster perfomance.')
-        tcrdist_calculator = TcrDistCalculator(organism)
-        D = np.array( [ tcrdist_calculator(x,y) for x in tcrs for y in tcrs ] ).reshape( (len(tcrs), len(tcrs)) )
+        D = TcrDistCalculator(organism).pairwise(tcrs)
 
     n_components = min( n_components_in, D.shape[0] )
 
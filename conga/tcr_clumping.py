@@ -18,14 +18,68 @@ from statsmodels.stats.multitest import multipletests
 # from anndata import AnnData
 import sys
 import os
+import hashlib
 from sys import exit
 from . import util
 from . import preprocess
 from .tags import *
 from .tcrdist import tcr_sampler
+from .tcrdist.tcr_distances import (
+    TcrDistCalculator, encode_cdr3s, aa_codes, make_distance_lookup_table,
+    weighted_cdr3_distances_paired, GAP_PENALTY_CDR3_REGION)
 import random
 
 
+def _get_background_cachefile(
+        background_cache_dir,
+        organism,
+        tcrs,
+        tcrs_for_background_generation,
+        num_random_samples,
+        preserve_vj_pairings,
+        seed,
+):
+    ''' Returns the Path of the .npz background counts file for these args,
+    see estimate_background_tcrdist_distributions
+    '''
+    h = hashlib.sha1()
+    # the sampler tag changes the key when the resampling code changes
+    h.update(repr(('numpy_sampler', organism, num_random_samples,
+                   bool(preserve_vj_pairings), seed)).encode())
+    for tcrs_list in [tcrs, tcrs_for_background_generation]:
+        h.update(b'|')
+        if tcrs_list is not None:
+            h.update('\n'.join(repr(x) for x in tcrs_list).encode())
+    return Path(background_cache_dir) / \
+        f'tcrdist_background_{organism}_{h.hexdigest()[:20]}.npz'
+
+def _read_background_cachefile(cachefile, max_dist):
+    ''' returns counts, n_bg_pairs with counts.shape[1] == max_dist+1
+    or None, None if the file doesnt exist or doesnt go out to max_dist
+    '''
+    if not exists(cachefile):
+        return None, None
+    with np.load(cachefile) as data:
+        counts, n_bg_pairs = data['counts'], int(data['n_bg_pairs'])
+    if counts.shape[1] < max_dist+1:
+        return None, None
+    return counts[:,:max_dist+1], n_bg_pairs
+
+def _write_background_cachefile(cachefile, counts, n_bg_pairs):
+    ''' dont overwrite a file with counts out to a larger max_dist '''
+    old_counts, _ = _read_background_cachefile(cachefile, counts.shape[1]-1)
+    if old_counts is not None:
+        return
+    os.makedirs(cachefile.parent, exist_ok=True)
+    # write to a tmpfile and rename, in case another run is reading it
+    tmpfile = cachefile.parent / f'{cachefile.stem}_{os.getpid()}_tmp.npz'
+    np.savez_compressed(tmpfile, counts=counts.astype(np.int64),
+                        n_bg_pairs=n_bg_pairs)
+    os.replace(tmpfile, cachefile)
+    print('estimate_background_tcrdist_distributions: saved background',
+          'counts to', cachefile)
+
+
 def estimate_background_tcrdist_distributions(
         organism,
         tcrs,
@@ -39,13 +93,42 @@ def estimate_background_tcrdist_distributions(
         preserve_vj_pairings = False,
         save_unpaired_dists = False, # tell C++ code to save to files (dev feature)
         nocleanup = False,
+        seed = None, # for the shuffled chain resampling
+        background_cache_dir = None, # see below
+        n_jobs = 1, # for junction parsing and resampling, doesnt change results
 ):
     ''' Returns a numpy float matrix P of shape (len(tcrs), max_dist+1)
 
     the (i,j) entry in P is an estimate of the probability of seeing a paired tcrdist
     score <= j for tcr #i.
 
+    If background_cache_dir and seed are both given (and the background
+    chains are not), the cumulative background counts are saved to (and
+    reused from) a compressed .npz file in background_cache_dir. The file is
+    keyed by the organism, the tcrs, tcrs_for_background_generation,
+    num_random_samples, preserve_vj_pairings and seed. Counts saved for a
+    larger max_dist are reused for smaller ones.
     '''
+    max_dist = int(0.1+max_dist) ## need an integer
+
+    cachefile = None
+    if (background_cache_dir is not None and background_alpha_chains is None
+        and background_beta_chains is None):
+        if seed is None:
+            print('WARNING estimate_background_tcrdist_distributions:',
+                  'not using background_cache_dir since seed is None')
+        else:
+            cachefile = _get_background_cachefile(
+                background_cache_dir, organism, tcrs,
+                tcrs_for_background_generation, num_random_samples,
+                preserve_vj_pairings, seed)
+            counts, n_bg_pairs = _read_background_cachefile(cachefile, max_dist)
+            if counts is not None:
+                assert counts.shape == (len(tcrs), max_dist+1)
+                print('estimate_background_tcrdist_distributions: reusing',
+                      'background counts from', cachefile)
+                return np.maximum(pseudocount, counts.astype(float))/n_bg_pairs
+
     if not util.tcrdist_cpp_available():
         print('conga.tcr_clumping.estimate_background_tcrdist_distributions:: need to compile the C++ tcrdist executables')
         exit(1)
@@ -55,6 +138,8 @@ def estimate_background_tcrdist_distributions(
     else:
         tmpfile_prefix = Path(tmpfile_prefix)
 
+    # separate RNG streams for the alpha and beta chains
+    aseed, bseed = np.random.SeedSequence(seed).spawn(2)
 
     if tcrs_for_background_generation is None:
         # only used when background_alpha_chains and/or background_beta_chains is None
@@ -64,21 +149,22 @@ def estimate_background_tcrdist_distributions(
         tcrs_for_background_generation = tcr_sampler.find_alternate_alleles_for_tcrs(
             organism, tcrs, verbose=False)
 
-    max_dist = int(0.1+max_dist) ## need an integer
-
     if background_alpha_chains is None or background_beta_chains is None:
         # parse the V(D)J junction regions of the tcrs to define split-points for shuffling
-        junctions_df = tcr_sampler.parse_tcr_junctions(organism, tcrs_for_background_generation)
+        junctions_df = tcr_sampler.parse_tcr_junctions(
+            organism, tcrs_for_background_generation, n_jobs=n_jobs)
 
         # resample shuffled single-chain tcrs
         if background_alpha_chains is None:
             background_alpha_chains = tcr_sampler.resample_shuffled_tcr_chains(
                 organism, num_random_samples, 'A', junctions_df,
-                preserve_vj_pairings = preserve_vj_pairings)
+                preserve_vj_pairings = preserve_vj_pairings, seed = aseed,
+                n_jobs = n_jobs)
         if background_beta_chains is None:
             background_beta_chains  = tcr_sampler.resample_shuffled_tcr_chains(
                 organism, num_random_samples, 'B', junctions_df,
-                preserve_vj_pairings = preserve_vj_pairings)
+                preserve_vj_pairings = preserve_vj_pairings, seed = bseed,
+                n_jobs = n_jobs)
 
     # save all tcrs to files
     achains_file = str(tmpfile_prefix) + '_bg_achains.tsv'
@@ -130,6 +216,9 @@ def estimate_background_tcrdist_distributions(
     n_bg_pairs = len(background_alpha_chains) * len(background_beta_chains)
     tcrdist_freqs = np.maximum(pseudocount, counts.astype(float))/n_bg_pairs
 
+    if cachefile is not None:
+        _write_background_cachefile(cachefile, counts, n_bg_pairs)
+
     if not nocleanup:
         for filename in [achains_file, bchains_file, tcrs_file, outfile]:
             os.remove(filename)
@@ -138,6 +227,53 @@ def estimate_background_tcrdist_distributions(
 
 # not to be confused with assess_tcr_clumping which takes in an adata
 # and is basically a wrapper around this function
+def _get_group_sizes(*labels):
+    ''' For each item, the number of items with the same labels in all of the
+    label arrays
+    '''
+    keys = np.stack([np.unique(x, return_inverse=True)[1].reshape(-1)
+                     for x in labels], axis=1)
+    _, inverse, counts = np.unique(
+        keys, axis=0, return_inverse=True, return_counts=True)
+    return counts[inverse.reshape(-1)]
+
+def _count_nbrs_within_radii(nbr_rows, nbr_distances, radii, num_clones):
+    ''' Returns an int array of shape (num_clones, len(radii)) with the
+    number of nbrs of each clone within each radius, given the flattened
+    nbr lists (row index and tcrdist for each nbr)
+    '''
+    order = np.lexsort((nbr_distances, nbr_rows))
+    rows, dists = nbr_rows[order], nbr_distances[order]
+    # search the sorted distances of each clone with a single searchsorted,
+    #  by offsetting each clone's distances past the previous clone's
+    offset = max(max(radii), np.max(dists, initial=0)) + 1
+    keys = rows*offset + dists
+    bounds = (np.arange(num_clones)*offset)[:,None]
+    starts = np.searchsorted(keys, bounds, side='left')
+    ends = np.searchsorted(keys, bounds + np.array(radii)[None,:],
+                           side='right')
+    return ends - starts
+
+def _union_find_clusters(num_nodes, edges_i, edges_j):
+    ''' Single-linkage clusters from a list of edges, by union-find with path
+    compression. Returns an array with the smallest member of each node's
+    cluster
+    '''
+    parent = list(range(num_nodes))
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root: # path compression
+            parent[x], x = root, parent[x]
+        return root
+    for i, j in zip(edges_i.tolist(), edges_j.tolist()):
+        ri, rj = find(i), find(j)
+        if ri != rj: # keep the smaller index as the root
+            parent[max(ri,rj)] = min(ri,rj)
+    return np.array([find(x) for x in range(num_nodes)], dtype=int)
+
+
 def find_tcr_clumping(
         tcrs,
         organism,
@@ -149,6 +285,9 @@ def find_tcr_clumping(
         clusters_gex=None, # if passed, will look for clumps within clusters
         preserve_vj_pairings = False,
         bg_tcrs = None, # usually better to leave this None
+        seed = None, # for the background resampling
+        background_cache_dir = None, # see estimate_background_tcrdist_distributions
+        n_jobs = 1,
 ):
     ''' Returns a pandas dataframe with the following columns:
     - clone_index
@@ -185,6 +324,9 @@ def find_tcr_clumping(
         tmpfile_prefix=outprefix,
         preserve_vj_pairings=preserve_vj_pairings,
         tcrs_for_background_generation=bg_tcrs,
+        seed=seed,
+        background_cache_dir=background_cache_dir,
+        n_jobs=n_jobs,
     )
 
     tcrs_file = outprefix +'_tcrs.tsv'
@@ -232,196 +374,132 @@ def find_tcr_clumping(
               exists(nbr_distances_filename))
         exit(1)
 
-    all_nbrs = []
-    all_distances = []
+    nbr_rows, all_nbrs, all_distances = [], [], []
     for line1, line2 in zip(open(nbr_indices_filename,'r'),
                             open(nbr_distances_filename,'r')):
         l1 = line1.split()
         l2 = line2.split()
         assert len(l1) == len(l2)
-        #ii = len(all_nbrs)
-        all_nbrs.append([int(x) for x in l1])
-        all_distances.append([int(x) for x in l2])
-    assert len(all_nbrs) == num_clones
+        nbr_rows.append(len(l1))
+        all_nbrs.extend(l1)
+        all_distances.extend(l2)
+    assert len(nbr_rows) == num_clones
+    # flat edge arrays: clone nbr_rows[k] has nbr all_nbrs[k] at all_distances[k]
+    nbr_rows = np.repeat(np.arange(num_clones), nbr_rows)
+    all_nbrs = np.array(all_nbrs, dtype=int)
+    all_distances = np.array(all_distances, dtype=int)
 
     # cleanup the tmpfiles
     for tmpfile in tmpfiles:
         if exists(tmpfile):
             os.remove(tmpfile)
 
-    # we were printing this out in verbose mode...
-    #clone_sizes = adata.obs['clone_sizes']
-
     # use poisson to find nbrhoods with more tcrs than expected;
     #  have to handle agroups/bgroups
-    dfl = []
+    # the possible nbrs of ii are the clones that share neither agroup nor
+    # bgroup with ii
+    max_nbrs = (num_clones - _get_group_sizes(agroups) -
+                _get_group_sizes(bgroups) + _get_group_sizes(agroups, bgroups))
 
-    is_clumped = np.full((num_clones,), False)
-
-    n_bg_pairs = num_random_samples * num_random_samples
+    # (num_clones, len(radii)) arrays
+    num_nbrs = _count_nbrs_within_radii(
+        nbr_rows, all_distances, radii, num_clones)
+    bg_freqs = bg_freqs[:, radii]
+    mu = max_nbrs[:,None] * bg_freqs
 
     all_raw_pvalues = np.full((num_clones, len(radii)), 1.0)
+    mask = num_nbrs>=1
+    all_raw_pvalues[mask] = poisson.sf(num_nbrs[mask]-1, mu[mask])
+    # adjust for number of tests
+    all_pvals = all_raw_pvalues * (len(radii) * num_clones)
+    hits = [('global', mask & (all_pvals <= pvalue_threshold),
+             num_nbrs, mu, all_pvals)]
+
+    if clusters_gex is not None:
+        # look for clumping within the GEX cluster containing each clone
+        clusters_gex = np.asarray(clusters_gex)
+        same_cluster = clusters_gex[all_nbrs] == clusters_gex[nbr_rows]
+        intra_num_nbrs = _count_nbrs_within_radii(
+            nbr_rows[same_cluster], all_distances[same_cluster], radii,
+            num_clones)
+        intra_max_nbrs = (
+            _get_group_sizes(clusters_gex) -
+            _get_group_sizes(clusters_gex, agroups) -
+            _get_group_sizes(clusters_gex, bgroups) +
+            _get_group_sizes(clusters_gex, agroups, bgroups))
+        intra_mu = intra_max_nbrs[:,None] * bg_freqs
+        intra_mask = mask & (intra_num_nbrs>=1)
+        intra_pvals = np.full((num_clones, len(radii)), np.inf)
+        intra_pvals[intra_mask] = (len(radii) * num_clones * poisson.sf(
+            intra_num_nbrs[intra_mask]-1, intra_mu[intra_mask]))
+        hits.append(('intra_gex_cluster', intra_pvals <= pvalue_threshold,
+                     intra_num_nbrs, intra_mu, intra_pvals))
+
+    # one row per (clone, radius, clump_type) hit, ordered by clone, then
+    # radius, then clump_type
+    dfl = []
+    n_bg_pairs = num_random_samples * num_random_samples
+    for itype, (clump_type, hit_mask, hit_num_nbrs, hit_mu, hit_pvals) in \
+        enumerate(hits):
+        inds, irads = np.nonzero(hit_mask)
+        dfl.append(pd.DataFrame(OrderedDict(
+            clump_type=clump_type,
+            clone_index=inds,
+            nbr_radius=np.array(radii)[irads],
+            pvalue_adj=hit_pvals[inds, irads],
+            num_nbrs=hit_num_nbrs[inds, irads],
+            expected_num_nbrs=hit_mu[inds, irads],
+            # count might just be pseudocount
+            raw_count=bg_freqs[inds, irads]*n_bg_pairs,
+            _order=(inds*len(radii) + irads)*len(hits) + itype,
+        )))
+    results_df = (pd.concat(dfl).sort_values('_order')
+                  .drop(columns='_order').reset_index(drop=True))
 
-    for ii in range(num_clones):
-        ii_freqs = bg_freqs[ii]
-        ii_dists = all_distances[ii]
-        for irad, radius in enumerate(radii):
-            num_nbrs = sum(x<=radius for x in ii_dists)
-            if num_nbrs<1:
-                continue # NOTE: OK since wont have intra-cluster nbrs either
-            max_nbrs = np.sum((agroups!=agroups[ii]) & (bgroups!=bgroups[ii]))
-            # adjust for number of tests
-            mu = max_nbrs * ii_freqs[radius]
-            pval = poisson.sf(num_nbrs-1, mu)
-            all_raw_pvalues[ii, irad] = pval
-            pval *= len(radii) * num_clones # simple multiple test correction
-            if pval <= pvalue_threshold:
-                is_clumped[ii] = True
-                # count might just be pseudocount
-                raw_count = ii_freqs[radius]*n_bg_pairs
-                if verbose:
-                    atcr_str = ' '.join(tcrs[ii][0][:3])
-                    btcr_str = ' '.join(tcrs[ii][1][:3])
-                    print(f'tcr_nbrs_global: {num_nbrs:2d} {mu:9.6f}',
-                          f'radius: {radius:2d} pval: {pval:9.1e}',
-                          f'{raw_count:9.1f} tcr: {atcr_str} {btcr_str}')
-
-                dfl.append( OrderedDict(
-                    clump_type='global',
-                    clone_index=ii,
-                    nbr_radius=radius,
-                    pvalue_adj=pval,
-                    num_nbrs=num_nbrs,
-                    expected_num_nbrs=mu,
-                    raw_count=raw_count,
-                    va   =tcrs[ii][0][0],
-                    ja   =tcrs[ii][0][1],
-                    cdr3a=tcrs[ii][0][2],
-                    vb   =tcrs[ii][1][0],
-                    jb   =tcrs[ii][1][1],
-                    cdr3b=tcrs[ii][1][2],
-                ))
-            if clusters_gex is not None:
-                # look for clumping within the GEX cluster containing ii
-                ii_nbrs = all_nbrs[ii]
-                ii_cluster = clusters_gex[ii]
-                ii_cluster_mask = (clusters_gex==ii_cluster)
-                num_nbrs = sum((x<=radius and
-                                clusters_gex[y]==ii_cluster)
-                               for x,y in zip(ii_dists, ii_nbrs))
-                if num_nbrs<1:
-                    continue ## NOTE-- continue
-                max_nbrs = np.sum((agroups!=agroups[ii]) &
-                                  (bgroups!=bgroups[ii]) &
-                                  ii_cluster_mask)
-                mu = max_nbrs * ii_freqs[radius]
-                pval = (len(radii) * num_clones *
-                        poisson.sf(num_nbrs-1, mu ))
-                if pval <= pvalue_threshold:
-                    is_clumped[ii] = True
-                    # if count was 0, will be pseudocount
-                    raw_count = ii_freqs[radius]*n_bg_pairs
-                    if verbose:
-                        atcr_str = ' '.join(tcrs[ii][0][:3])
-                        btcr_str = ' '.join(tcrs[ii][1][:3])
-                        print(f'tcr_nbrs_intra: {num_nbrs:2d} {mu:9.6f}',
-                              f'radius: {radius:2d} pval: {pval:9.1e}',
-                              f'{raw_count:9.1f} tcr: {atcr_str} {btcr_str}')
-                    dfl.append( OrderedDict(
-                        clump_type='intra_gex_cluster',
-                        clone_index=ii,
-                        nbr_radius=radius,
-                        pvalue_adj=pval,
-                        num_nbrs=num_nbrs,
-                        expected_num_nbrs=mu,
-                        raw_count=raw_count,
-                        va   =tcrs[ii][0][0],
-                        ja   =tcrs[ii][0][1],
-                        cdr3a=tcrs[ii][0][2],
-                        vb   =tcrs[ii][1][0],
-                        jb   =tcrs[ii][1][1],
-                        cdr3b=tcrs[ii][1][2],
-                    ))
-
-    results_df = pd.DataFrame(dfl)
     if results_df.shape[0] == 0:
-        return results_df ## NOTE EARLY RETURN #########################
+        return pd.DataFrame() ## NOTE EARLY RETURN #########################
+
+    for ab, chain in [('a',0), ('b',1)]:
+        for ii, tag in enumerate(['v', 'j', 'cdr3']):
+            results_df[tag+ab] = [tcrs[x][chain][ii]
+                                  for x in results_df.clone_index]
+
+    if verbose:
+        for l in results_df.itertuples():
+            tag = 'global' if l.clump_type=='global' else 'intra'
+            print(f'tcr_nbrs_{tag}: {l.num_nbrs:2d} {l.expected_num_nbrs:9.6f}',
+                  f'radius: {l.nbr_radius:2d} pval: {l.pvalue_adj:9.1e}',
+                  f'{l.raw_count:9.1f} tcr: {l.va} {l.ja} {l.cdr3a}',
+                  f'{l.vb} {l.jb} {l.cdr3b}')
 
     # compute FDR values in addition to the simple adjusted pvalues
     _, fdr_values, _, _ = multipletests(
         all_raw_pvalues.reshape(-1), alpha=0.05, method='fdr_bh')
     fdr_values = fdr_values.reshape((num_clones, len(radii))).min(axis=1)
     # right now we don't assign fdr values for intra-gex cluster clumping
-    fdr_column = [fdr_values[x.clone_index] if x.clump_type=='global'
-                  else np.nan for x in results_df.itertuples()]
-    results_df['clonotype_fdr_value'] = fdr_column
-
-    # identify groups of related hits?
-    all_clumped_nbrs = {}
-    for l in results_df.itertuples():
-        ii = l.clone_index
-        radius = l.nbr_radius
-        clumped_nbrs = set(x for x,y in zip(all_nbrs[ii], all_distances[ii])
-                           if y<= radius and is_clumped[x])
-        clumped_nbrs.add(ii)
-        if ii in all_clumped_nbrs:
-            all_clumped_nbrs[ii] = all_clumped_nbrs[ii] | clumped_nbrs
-        else:
-            all_clumped_nbrs[ii] = clumped_nbrs
-
-
-    clumped_inds = sorted(all_clumped_nbrs.keys())
-    assert len(clumped_inds) == np.sum(is_clumped)
-
-    # make nbrs symmetric
-    for ii in clumped_inds:
-        for nbr in all_clumped_nbrs[ii]:
-            assert nbr in all_clumped_nbrs
-            all_clumped_nbrs[nbr].add(ii)
-
-    all_smallest_nbr = {}
-    for ii in clumped_inds:
-        all_smallest_nbr[ii] = min(all_clumped_nbrs[ii])
-
-    while True:
-        updated = False
-        for ii in clumped_inds:
-            nbr = all_smallest_nbr[ii]
-            new_nbr = min(nbr, np.min([all_smallest_nbr[x]
-                                       for x in all_clumped_nbrs[ii]]))
-            if nbr != new_nbr:
-                all_smallest_nbr[ii] = new_nbr
-                updated = True
-        if not updated:
-            break
-
-    # define clusters, choose cluster centers
-    clusters = np.array([0]*num_clones) # 0 if not clumped
-
-    cluster_number=0
-    cluster_sizes = Counter()
-    for ii in clumped_inds:
-        nbr = all_smallest_nbr[ii]
-        if ii==nbr:
-            cluster_number += 1
-            members = [ x for x,y in all_smallest_nbr.items() if y==nbr]
-            clusters[members] = cluster_number
-            cluster_sizes[cluster_number] = len(members)
-
-    for ii, nbrs in all_clumped_nbrs.items():
-        for nbr in nbrs:
-            # confirm single-linkage clusters
-            assert clusters[ii] == clusters[nbr]
-
-    assert not np.any(clusters[is_clumped]==0)
-    assert np.all(clusters[~is_clumped]==0)
-
-    # reorder the clumping groups by size
-    remap = {x[0]:i+1 for i,x in enumerate(cluster_sizes.most_common())}
-    remap[0] = 0
-
-    results_df['clumping_group'] = [ remap[clusters[x.clone_index]]
-                                     for x in results_df.itertuples()]
+    results_df['clonotype_fdr_value'] = np.where(
+        results_df.clump_type=='global',
+        fdr_values[results_df.clone_index], np.nan)
+
+    # identify groups of related hits: clumped clonotypes within each
+    #  other's significant nbr_radii are linked (single linkage)
+    is_clumped = np.full((num_clones,), False)
+    is_clumped[results_df.clone_index] = True
+    hit_radius = np.full((num_clones,), -1)
+    np.maximum.at(hit_radius, results_df.clone_index.values,
+                  results_df.nbr_radius.values)
+    edge_mask = ((all_distances <= hit_radius[nbr_rows]) &
+                 is_clumped[all_nbrs])
+    clusters = _union_find_clusters(
+        num_clones, nbr_rows[edge_mask], all_nbrs[edge_mask])
+
+    # number the clumping groups by size, ties broken by smallest member
+    clusters[~is_clumped] = -1
+    cluster_sizes = Counter(clusters[is_clumped])
+    remap = {x[0]:i+1 for i,x in enumerate(
+        sorted(cluster_sizes.items(), key=lambda x:(-x[1], x[0])))}
+    results_df['clumping_group'] = [remap[clusters[x]]
+                                    for x in results_df.clone_index]
 
     results_df.sort_values('pvalue_adj', inplace=True)
 
@@ -440,6 +518,9 @@ def assess_tcr_clumping(
         #radii = [24, 48, 72, 96],
         #num_random_samples = 50000,
         #pvalue_threshold = 1.0,
+        #seed = None,
+        #background_cache_dir = None,
+        #n_jobs = 1,
 ):
     ''' This is a wrapper around find_tcr_clumping that takes an AnnData
 
@@ -541,6 +622,269 @@ def tcrs_from_dataframe_helper(df, add_j_and_nucseq=False):
         return [ ( (x.va, None, x.cdr3a), (x.vb, None, x.cdr3b) )
                  for x in df.itertuples() ]
 
+TCR_DB_INDEX_VERSION = 3
+
+def _get_v_family(v_gene):
+    ''' eg TRBV12-3*01 --> TRBV12
+    '''
+    return v_gene.split('*')[0].split('-')[0]
+
+def _read_tcr_db_tsvfile(db_tcrs_tsvfile):
+    ''' Read the db tcrs into a DataFrame, handling legacy column names
+    '''
+    db_tcrs_df = pd.read_csv(db_tcrs_tsvfile, sep='\t')
+
+    # possibly swap legacy column names
+    if 'va' not in db_tcrs_df.columns and 'va_gene' in db_tcrs_df.columns:
+        db_tcrs_df['va'] = db_tcrs_df['va_gene']
+    if 'vb' not in db_tcrs_df.columns and 'vb_gene' in db_tcrs_df.columns:
+        db_tcrs_df['vb'] = db_tcrs_df['vb_gene']
+    return db_tcrs_df
+
+def build_tcr_db_index(
+        db_tsv,
+        organism = 'human',
+        index_file = None, # default is db_tsv + '.tcrdist_index.npz'
+):
+    ''' Reads and validates the paired tcrs in db_tsv (columns va cdr3a vb
+    cdr3b, minimally) and saves them to a compressed .npz index file for
+    match_adata_tcrs_to_db_tcrs(db_index_file=...), so the tsvfile doesn't
+    have to be re-read and the queries don't have to be compared to every
+    db tcr.
+
+    The db tcrs are bucketed by CDR3a length, CDR3b length, V-alpha family
+    and V-beta family, and the CDR3s are stored integer-encoded. A query only
+    scans the buckets whose tcrdist lower bound (the CDR3 length-gap
+    penalties plus the smallest V distances from its V genes to the bucket
+    families) is under the matching threshold. The V-region distances are
+    saved too, since they are slow to compute.
+
+    returns index_file
+    '''
+    if index_file is None:
+        index_file = str(db_tsv) + '.tcrdist_index.npz'
+
+    db_tcrs_df = _read_tcr_db_tsvfile(db_tsv)
+    tcrdist_calculator = TcrDistCalculator(organism)
+
+    # the same checks that the C++ tcrdist code does on its input
+    for ab in 'ab':
+        for col in [f'v{ab}', f'cdr3{ab}']:
+            if col not in db_tcrs_df.columns:
+                print(f'ERROR build_tcr_db_index:: db_tsv is missing {col}',
+                      'column')
+                exit(1)
+        for ii, (v, cdr3) in enumerate(zip(db_tcrs_df['v'+ab],
+                                           db_tcrs_df['cdr3'+ab])):
+            if v not in tcrdist_calculator.v_codes:
+                print(f'ERROR build_tcr_db_index:: bad v{ab} in row {ii}:', v)
+                exit(1)
+            if (not isinstance(cdr3, str) or len(cdr3)<5 or
+                any(x not in aa_codes for x in cdr3)):
+                print(f'ERROR build_tcr_db_index:: bad cdr3{ab} in row {ii}:',
+                      cdr3)
+                exit(1)
+
+    v_genes = sorted(tcrdist_calculator.v_codes,
+                     key=tcrdist_calculator.v_codes.get)
+    families = sorted(set(_get_v_family(x) for x in v_genes))
+    family_codes = {x:i for i,x in enumerate(families)}
+
+    arrays = dict(
+        version = TCR_DB_INDEX_VERSION,
+        organism = organism,
+        db_tsv = str(db_tsv),
+        v_genes = np.array(v_genes),
+        v_dists = tcrdist_calculator.v_dists,
+        v_gene_families = np.array([family_codes[_get_v_family(x)]
+                                    for x in v_genes]),
+    )
+
+    # the full table, for the db_ columns in the results, as typed columns
+    # that come back with the same dtypes and values as reading db_tsv
+    arrays.update(util.dataframe_to_arrays(db_tcrs_df, prefix='db_'))
+
+    bucket_keys = []
+    for ab in 'ab':
+        vcodes = np.array([tcrdist_calculator.v_codes[x]
+                           for x in db_tcrs_df['v'+ab]], dtype=int)
+        lens, nterm_codes, cterm_codes = encode_cdr3s(list(db_tcrs_df['cdr3'+ab]))
+        arrays[f'v{ab}_codes'] = vcodes
+        arrays[f'cdr3{ab}_lens'] = lens
+        arrays[f'cdr3{ab}_nterm_codes'] = nterm_codes
+        arrays[f'cdr3{ab}_cterm_codes'] = cterm_codes
+        bucket_keys.append(lens)
+    for ab in 'ab':
+        bucket_keys.append(arrays['v_gene_families'][arrays[f'v{ab}_codes']])
+    bucket_keys = np.stack(bucket_keys, axis=1).reshape((-1, 4))
+
+    # db rows sorted by bucket: bucket_order[bucket_starts[i]:bucket_starts[i+1]]
+    keys, inverse = np.unique(bucket_keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    arrays['bucket_keys'] = keys
+    arrays['bucket_order'] = np.argsort(inverse, kind='stable')
+    arrays['bucket_starts'] = np.concatenate(
+        [[0], np.cumsum(np.bincount(inverse, minlength=keys.shape[0]))])
+
+    np.savez_compressed(index_file, **arrays)
+    print(f'build_tcr_db_index:: saved {db_tcrs_df.shape[0]} tcrs in',
+          f'{keys.shape[0]} buckets to {index_file}')
+    return index_file
+
+
+class TcrDbIndex:
+    ''' The paired db tcrs from an index file made by build_tcr_db_index
+
+    db_tcrs_df is the db table, as read from the original tsvfile
+    '''
+    def __init__(self, index_file):
+        with np.load(index_file) as npz:
+            if int(npz['version']) != TCR_DB_INDEX_VERSION:
+                print('ERROR TcrDbIndex:: index_file is from a different',
+                      'version of build_tcr_db_index, please rebuild it:',
+                      index_file)
+                exit(1)
+            self.organism = str(npz['organism'])
+            self.db_tsv = str(npz['db_tsv'])
+            self.v_codes = {x:i for i,x in enumerate(npz['v_genes'])}
+            self.v_dists = npz['v_dists']
+            self.v_gene_families = npz['v_gene_families']
+            self.db_tcrs_df = util.dataframe_from_arrays(npz, prefix='db_')
+            # [(vcodes, (lens, nterm_codes, cterm_codes)), ...] for a and b
+            self.db_chains = [
+                (npz[f'v{ab}_codes'],
+                 tuple(npz[f'cdr3{ab}_{x}'] for x in
+                       ['lens', 'nterm_codes', 'cterm_codes']))
+                for ab in 'ab']
+            self.bucket_keys = npz['bucket_keys']
+            self.bucket_order = npz['bucket_order']
+            self.bucket_starts = npz['bucket_starts']
+
+    def find_matches(self, query_tcrs_df, max_dist, chunk_size=1000000):
+        ''' Returns a DataFrame with all the (query, db) pairs with
+        tcrdist <= max_dist, like the C++ find_paired_matches output:
+        columns tcrdist, index1 (query), index2 (db), cdr3b1, cdr3b2
+
+        the candidate pairs are scored in chunks of chunk_size
+        '''
+        num_genes, num_families = len(self.v_codes), self.v_gene_families.max()+1
+        # min V distance from each gene to each family
+        gene_family_dists = np.full((num_genes, num_families), np.inf)
+        np.minimum.at(gene_family_dists, (np.arange(num_genes)[:,None],
+                                          self.v_gene_families[None,:]),
+                      self.v_dists)
+        distance_table = make_distance_lookup_table()
+
+        query_chains = []
+        for ab in 'ab':
+            vcodes = np.array([self.v_codes[x] for x in query_tcrs_df['v'+ab]],
+                              dtype=int)
+            query_chains.append(
+                (vcodes, encode_cdr3s(list(query_tcrs_df['cdr3'+ab]))))
+
+        # group the queries by CDR3 lengths and V genes
+        query_keys = np.stack(
+            [query_chains[0][1][0], query_chains[1][1][0],
+             query_chains[0][0], query_chains[1][0]], axis=1).reshape((-1,4))
+        keys, inverse = np.unique(query_keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        query_order = np.argsort(inverse, kind='stable')
+        query_starts = np.concatenate(
+            [[0], np.cumsum(np.bincount(inverse, minlength=keys.shape[0]))])
+
+        def score_candidates(candidates):
+            ''' exact tcrdists for the (query_inds, db_inds) blocks in
+            candidates, same as TcrDistCalculator.pairwise
+            '''
+            qinds = np.concatenate([np.repeat(q, len(d)) for q, d in candidates])
+            dbinds = np.concatenate([np.tile(d, len(q)) for q, d in candidates])
+            D = None
+            for (qvcodes, qcdr3s), (dbvcodes, dbcdr3s) in zip(query_chains,
+                                                              self.db_chains):
+                vdists = self.v_dists[qvcodes[qinds], dbvcodes[dbinds]]
+                D = vdists if D is None else D + vdists
+                D += weighted_cdr3_distances_paired(
+                    tuple(x[qinds] for x in qcdr3s),
+                    tuple(x[dbinds] for x in dbcdr3s),
+                    distance_table)
+            mask = D <= threshold
+            return pd.DataFrame(dict(
+                tcrdist=np.rint(D[mask]).astype(int),
+                index1=qinds[mask],
+                index2=dbinds[mask],
+            ))
+
+        threshold = max_dist + 0.5 # tcrdists are integers
+        bk = self.bucket_keys
+        (db_va, (db_lena, _, _)), (db_vb, (db_lenb, _, _)) = self.db_chains
+        dfl = []
+        candidates, num_candidates = [], 0
+        for ii, (len_a, len_b, va, vb) in enumerate(keys):
+            # lower bound on the tcrdist for each db bucket
+            min_dists = (GAP_PENALTY_CDR3_REGION * (np.abs(bk[:,0] - len_a) +
+                                                    np.abs(bk[:,1] - len_b)) +
+                         gene_family_dists[va, bk[:,2]] +
+                         gene_family_dists[vb, bk[:,3]])
+            buckets = np.nonzero(min_dists <= threshold)[0]
+            if len(buckets) == 0:
+                continue
+            starts = self.bucket_starts[buckets]
+            sizes = self.bucket_starts[buckets+1] - starts
+            offsets = np.cumsum(sizes) - sizes
+            db_inds = self.bucket_order[
+                np.repeat(starts - offsets, sizes) + np.arange(sizes.sum())]
+
+            # now the exact V distances + CDR3 length penalties
+            min_dists = (self.v_dists[va, db_va[db_inds]] +
+                         self.v_dists[vb, db_vb[db_inds]] +
+                         GAP_PENALTY_CDR3_REGION * (
+                             np.abs(db_lena[db_inds] - len_a) +
+                             np.abs(db_lenb[db_inds] - len_b)))
+            db_inds = db_inds[min_dists <= threshold]
+            if len(db_inds) == 0:
+                continue
+            query_inds = query_order[query_starts[ii]:query_starts[ii+1]]
+            candidates.append((query_inds, db_inds))
+            num_candidates += len(query_inds) * len(db_inds)
+            if num_candidates >= chunk_size:
+                dfl.append(score_candidates(candidates))
+                candidates, num_candidates = [], 0
+        if candidates:
+            dfl.append(score_candidates(candidates))
+
+        if dfl:
+            df = pd.concat(dfl)
+        else:
+            df = pd.DataFrame(dict(tcrdist=[], index1=[], index2=[]), dtype=int)
+        # same order as find_paired_matches
+        df = df.sort_values(['index1', 'index2']).reset_index(drop=True)
+        df['cdr3b1'] = query_tcrs_df.cdr3b.values[df.index1]
+        df['cdr3b2'] = self.db_tcrs_df.cdr3b.values[df.index2]
+        return df
+
+
+def _fdr_bh_with_implicit_ones(raw_pvalues, num_tests):
+    ''' Benjamini-Hochberg FDR values for raw_pvalues, as if they were
+    part of num_tests tests where all the other pvalues are 1.0
+
+    Same as multipletests(method='fdr_bh') on the padded array, but memory
+    is proportional to len(raw_pvalues): the padding pvalues only add
+    adjusted values >= 1, and the adjusted values are clipped at 1 anyway
+    '''
+    raw_pvalues = np.asarray(raw_pvalues, dtype=float)
+    num_hits = raw_pvalues.shape[0]
+    assert num_hits <= num_tests
+    order = np.argsort(raw_pvalues)
+    # raw * num_tests / rank, computed the same way statsmodels does it
+    ecdffactor = np.arange(1, num_hits+1) / float(num_tests)
+    fdr_values_sorted = np.minimum.accumulate(
+        (raw_pvalues[order] / ecdffactor)[::-1])[::-1]
+    fdr_values_sorted[fdr_values_sorted>1] = 1
+    fdr_values = np.empty_like(fdr_values_sorted)
+    fdr_values[order] = fdr_values_sorted
+    return fdr_values
+
+
 def find_significant_tcrdist_matches(
         query_tcrs_df,
         db_tcrs_df,
@@ -551,6 +895,7 @@ def find_significant_tcrdist_matches(
         num_random_samples_for_bg_freqs = 50000,
         nocleanup=False,
         fixup_allele_assignments_in_background_tcrs_df=True,
+        db_index=None, # TcrDbIndex for db_tcrs_df, see build_tcr_db_index
 ):
     ''' Computes paired tcrdist distances between query_tcrs_df and
     db_tcrs_df and converts them to
@@ -575,6 +920,9 @@ def find_significant_tcrdist_matches(
        db_tcrs_df
        db_tcrs_tsvfile
 
+    If db_index is given, the matches are found by scanning its buckets
+    instead of the all-vs-all C++ comparison
+
     '''
     if tmpfile_prefix is None:
         tmpfile_prefix = 'tmpfile{}'.format(random.randrange(1,10000))
@@ -628,95 +976,84 @@ def find_significant_tcrdist_matches(
     print(f'find_significant_tcrdist_matches:: max_dist: {max_dist}',
           f'max_dist_for_matching: {max_dist_for_matching}')
 
-    # now run C++ matching code
-    query_tcrs_file = tmpfile_prefix+'temp_query_tcrs.tsv'
-    db_tcrs_file = tmpfile_prefix+'temp_db_tcrs.tsv'
-    query_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(query_tcrs_file, sep='\t',
-                                                      index=False)
-    db_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(db_tcrs_file, sep='\t',
-                                                   index=False)
-
-    if os.name == 'posix':
-        exe = Path(util.path_to_tcrdist_cpp_bin) / 'find_paired_matches'
+    if db_index is not None:
+        df = db_index.find_matches(query_tcrs_df, max_dist_for_matching)
     else:
-        exe = Path(util.path_to_tcrdist_cpp_bin) / 'find_paired_matches.exe'
-
-    if not exists(exe):
-        print(f'ERROR: find_paired_matches:: tcrdist_cpp executable {exe}',
-              'is missing')
-        print('ERROR: see instructions in github repository README for',
-              'compiling tcrdist_cpp (tldr: type make in conga/tcrdist_cpp/')
-        return
-
-    db_filename = (Path(util.path_to_tcrdist_cpp_db) /
-                   f'tcrdist_info_{organism}.txt')
-
-    outfilename = tmpfile_prefix+'temp_tcr_matching.tsv'
-
-    cmd = '{} -i {} -j {} -t {} -d {} -o {}'\
-          .format(exe, query_tcrs_file, db_tcrs_file, max_dist_for_matching,
-                  db_filename, outfilename)
-
-    util.run_command(cmd, verbose=True)
-
-    df = pd.read_csv(outfilename, sep='\t')
-
-    num_matches = df.shape[0]
-    raw_pvalues = [bg_freqs[x.index1][x.tcrdist] for x in df.itertuples()]
-    raw_pvalues_argsort = np.argsort(raw_pvalues)
-    raw_pvalues_sorted = np.concatenate(
-        [np.sort(raw_pvalues), np.full((num_comparisons - num_matches,), 1.0)])
-    assert raw_pvalues_sorted.shape[0] == num_comparisons #BIG
-    # the alpha setting here does not matter for method='fdr_bh'
-    _, fdr_values_sorted, _, _ = multipletests(
-        raw_pvalues_sorted, alpha=0.05, is_sorted=True, method='fdr_bh')
-    fdr_values = fdr_values_sorted[np.argsort(raw_pvalues_argsort)]
-
-    dfl = []
-    for l, fdr_value in zip(df.itertuples(), fdr_values):
-        i = l.index1
-        j = l.index2
-        pvalue_adj = num_comparisons * bg_freqs[i][l.tcrdist]
-        if pvalue_adj > adjusted_pvalue_threshold:
-            continue
-        query_row = query_tcrs_df.iloc[i]
-        db_row = db_tcrs_df.iloc[j]
-        assert query_row.cdr3b == l.cdr3b1 # sanity check
-        assert db_row.cdr3b == l.cdr3b2 # ditto
-        D = OrderedDict(tcrdist= l.tcrdist,
-                        pvalue_adj=pvalue_adj,
-                        fdr_value=fdr_value, # Benjamini-Hochberg
-                        query_index= i,
-                        db_index= j,
-                        va= query_row.va,
-                        #ja= query_row.ja,
-                        cdr3a= query_row.cdr3a,
-                        vb= query_row.vb,
-                        #jb= query_row.jb,
-                        cdr3b= query_row.cdr3b)
-        if 'ja' in query_row:
-            D['ja'] = query_row.ja
-        if 'jb' in query_row:
-            D['jb'] = query_row.jb
-        for tag in db_row.index:
-            D['db_'+tag] = db_row[tag]
-        dfl.append(D)
-
-    if not nocleanup:
-        os.remove(outfilename)
-        os.remove(query_tcrs_file)
-        os.remove(db_tcrs_file)
-
-    results_df = pd.DataFrame(dfl)
-    if dfl:
-        results_df.sort_values('pvalue_adj', inplace=True)
-        for col in results_df.columns:
-            # object columns with missing values cause problems in h5 writing
-            if (np.sum(results_df[col].isna()) and
-                results_df[col].dtype is np.dtype('O')):
-                print('replacing nans in object column that has missing values',
-                      col)
-                results_df[col] = results_df[col].fillna('').astype(str)
+        # now run C++ matching code
+        query_tcrs_file = tmpfile_prefix+'temp_query_tcrs.tsv'
+        db_tcrs_file = tmpfile_prefix+'temp_db_tcrs.tsv'
+        query_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(query_tcrs_file, sep='\t',
+                                                          index=False)
+        db_tcrs_df['va cdr3a vb cdr3b'.split()].to_csv(db_tcrs_file, sep='\t',
+                                                       index=False)
+
+        if os.name == 'posix':
+            exe = Path(util.path_to_tcrdist_cpp_bin) / 'find_paired_matches'
+        else:
+            exe = Path(util.path_to_tcrdist_cpp_bin) / 'find_paired_matches.exe'
+
+        if not exists(exe):
+            print(f'ERROR: find_paired_matches:: tcrdist_cpp executable {exe}',
+                  'is missing')
+            print('ERROR: see instructions in github repository README for',
+                  'compiling tcrdist_cpp (tldr: type make in conga/tcrdist_cpp/')
+            return
+
+        db_filename = (Path(util.path_to_tcrdist_cpp_db) /
+                       f'tcrdist_info_{organism}.txt')
+
+        outfilename = tmpfile_prefix+'temp_tcr_matching.tsv'
+
+        cmd = '{} -i {} -j {} -t {} -d {} -o {}'\
+              .format(exe, query_tcrs_file, db_tcrs_file, max_dist_for_matching,
+                      db_filename, outfilename)
+
+        util.run_command(cmd, verbose=True)
+
+        df = pd.read_csv(outfilename, sep='\t')
+        if not nocleanup:
+            os.remove(outfilename)
+            os.remove(query_tcrs_file)
+            os.remove(db_tcrs_file)
+
+    if df.shape[0] == 0: # header-only C++ output has object-dtype columns
+        return pd.DataFrame()
+
+    # Benjamini-Hochberg over all num_comparisons, most of which are not
+    # matches (pvalue 1.0), without allocating the full array
+    raw_pvalues = bg_freqs[df.index1.values, df.tcrdist.values]
+    fdr_values = _fdr_bh_with_implicit_ones(raw_pvalues, num_comparisons)
+    pvalues_adj = num_comparisons * raw_pvalues
+
+    mask = pvalues_adj <= adjusted_pvalue_threshold
+    if not np.any(mask):
+        return pd.DataFrame()
+    hits = df[mask]
+    query_rows = query_tcrs_df.iloc[hits.index1.values]
+    db_rows = db_tcrs_df.iloc[hits.index2.values]
+    assert np.all(query_rows.cdr3b.values == hits.cdr3b1.values) # sanity check
+    assert np.all(db_rows.cdr3b.values == hits.cdr3b2.values) # ditto
+
+    cols = OrderedDict(tcrdist= hits.tcrdist.values,
+                       pvalue_adj= pvalues_adj[mask],
+                       fdr_value= fdr_values[mask], # Benjamini-Hochberg
+                       query_index= hits.index1.values,
+                       db_index= hits.index2.values)
+    for tag in 'va cdr3a vb cdr3b ja jb'.split():
+        if tag in query_rows.columns:
+            cols[tag] = query_rows[tag].values
+    for tag in db_rows.columns:
+        cols['db_'+tag] = db_rows[tag].values
+
+    results_df = pd.DataFrame(cols)
+    results_df.sort_values('pvalue_adj', inplace=True)
+    for col in results_df.columns:
+        # object columns with missing values cause problems in h5 writing
+        if (np.sum(results_df[col].isna()) and
+            results_df[col].dtype is np.dtype('O')):
+            print('replacing nans in object column that has missing values',
+                  col)
+            results_df[col] = results_df[col].fillna('').astype(str)
 
 
     return results_df
@@ -732,6 +1069,7 @@ def match_adata_tcrs_to_db_tcrs(
         num_random_samples_for_bg_freqs = 50000,
         nocleanup=False,
         fixup_allele_assignments_in_background_tcrs_df=True,
+        db_index_file=None, # made by build_tcr_db_index, replaces db_tcrs_tsvfile
 ):
     ''' Find significant tcrdist matches between tcrs in adata and tcrs
     in db_tcrs_tsvfile
@@ -749,9 +1087,23 @@ def match_adata_tcrs_to_db_tcrs(
     NOTE: reported pvalues are adjusted for sizes of both adata and
        db_tcrs_tsvfile
 
+    if db_index_file is given, the db tcrs are loaded from there instead
+    and matched using its index (see build_tcr_db_index), which is much
+    faster for big databases
+
     '''
 
-    if db_tcrs_tsvfile is None:
+    db_index = None
+    if db_index_file is not None:
+        db_index = TcrDbIndex(db_index_file)
+        if db_index.organism != adata.uns['organism']:
+            print('ERROR: match_adata_tcrs_to_db_tcrs db_index_file organism',
+                  db_index.organism, 'does not match adata organism',
+                  adata.uns['organism'])
+            exit(1)
+        db_tcrs_tsvfile = db_index.db_tsv
+
+    elif db_tcrs_tsvfile is None:
         if adata.uns['organism'] != 'human':
             print('ERROR: match_adata_tcrs_to_db_tcrs db_tcrs_tsvfile is None')
             print('but we only have built-in database for organism=human')
@@ -766,13 +1118,10 @@ def match_adata_tcrs_to_db_tcrs(
     print('Matching to paired tcrs in', db_tcrs_tsvfile)
 
     query_tcrs_df = adata.obs['va ja cdr3a vb jb cdr3b'.split()].copy()
-    db_tcrs_df = pd.read_csv(db_tcrs_tsvfile, sep='\t')
-
-    # possibly swap legacy column names
-    if 'va' not in db_tcrs_df.columns and 'va_gene' in db_tcrs_df.columns:
-        db_tcrs_df['va'] = db_tcrs_df['va_gene']
-    if 'vb' not in db_tcrs_df.columns and 'vb_gene' in db_tcrs_df.columns:
-        db_tcrs_df['vb'] = db_tcrs_df['vb_gene']
+    if db_index is None:
+        db_tcrs_df = _read_tcr_db_tsvfile(db_tcrs_tsvfile)
+    else:
+        db_tcrs_df = db_index.db_tcrs_df
 
     if tcrs_for_background_generation is None:
         background_tcrs_df = adata.obs['va ja cdr3a cdr3a_nucseq vb jb cdr3b cdr3b_nucseq'.split()]\
@@ -793,6 +1142,7 @@ def match_adata_tcrs_to_db_tcrs(
         num_random_samples_for_bg_freqs=num_random_samples_for_bg_freqs,
         fixup_allele_assignments_in_background_tcrs_df=fixup_allele_assignments_in_background_tcrs_df,
         nocleanup=nocleanup,
+        db_index=db_index,
         )
 
     if not results.empty:
@@ -842,10 +1192,58 @@ db_XXX: where XXX is a field in the literature database
 
 
 
+def _cdr3_deletion_variants(cdr3):
+    ''' all the sequences made by deleting one position from cdr3
+    '''
+    return set(cdr3[:i]+cdr3[i+1:] for i in range(len(cdr3)))
+
+def _within_one_edit(a, b):
+    ''' True if a and b differ by at most one substitution, insertion, or
+    deletion
+    '''
+    if abs(len(a)-len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    # skip the common prefix, then the remainders have to match
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i+1:] == b[i+1:]
+    else:
+        return a[i:] == b[i+1:]
+
+def _single_chain_match_keys(df, ab, match_genes, max_cdr3_edits):
+    ''' returns DataFrame with columns key, row: the hash keys for the rows
+    of df that have a cdr3 (and genes, if match_genes)
+
+    the keys are the allele-trimmed genes in match_genes plus the cdr3, and
+    if max_cdr3_edits the cdr3 single-deletion variants too, so that cdr3s
+    one edit apart share a key
+    '''
+    cols = [f'v{ab}', f'j{ab}'][:len(match_genes)]
+    keys, rows = [], []
+    for ii, row in enumerate(zip(df['cdr3'+ab], *[df[x] for x in cols])):
+        if not all(isinstance(x, str) and x for x in row):
+            continue
+        cdr3 = row[0]
+        prefix = ''.join(x.split('*')[0]+':' for x in row[1:])
+        if max_cdr3_edits:
+            variants = _cdr3_deletion_variants(cdr3) | {cdr3}
+        else:
+            variants = [cdr3]
+        for variant in variants:
+            keys.append(prefix+variant)
+            rows.append(ii)
+    return pd.DataFrame(dict(key=keys, row=rows))
+
 def strict_single_chain_match_adata_tcrs_to_db_tcrs(
         adata,
         outfile_prefix=None,
         db_tcrs_tsvfile=None,
+        match_genes='',
+        max_cdr3_edits=0,
 ):
     ''' Find CDR3a and CDR3b matches between adata tcrs and tcrs in db_tcrs_tsvfile
     based on strictly matching amino acid sequences only
@@ -855,7 +1253,16 @@ def strict_single_chain_match_adata_tcrs_to_db_tcrs(
 
     db_tcrs_tsvfile has at a minimum the columns: cdr3a and cdr3b
 
+    match_genes='v' or 'vj' also requires the V (or V and J) genes to match,
+    ignoring alleles (needs the va/vb, ja/jb columns in db_tcrs_tsvfile)
+
+    max_cdr3_edits=1 also matches CDR3s that differ by one substitution,
+    insertion, or deletion. This uses single-deletion variants as extra hash
+    keys (symmetric-delete indexing), so it's still linear in the sizes
+
     '''
+    assert match_genes in ['', 'v', 'vj']
+    assert max_cdr3_edits in [0, 1]
 
     if db_tcrs_tsvfile is None:
         if adata.uns['organism'] == 'human':
@@ -867,48 +1274,62 @@ def strict_single_chain_match_adata_tcrs_to_db_tcrs(
     print('Matching to CDR3a and CDR3b sequences in', db_tcrs_tsvfile)
 
     query_tcrs_df = adata.obs['va ja cdr3a vb jb cdr3b'.split()].copy()
-    db_tcrs_df = pd.read_csv(db_tcrs_tsvfile, sep='\t')
-
-    # possibly swap legacy column names.
-    if 'va' not in db_tcrs_df.columns and 'va_gene' in db_tcrs_df.columns:
-        db_tcrs_df['va'] = db_tcrs_df['va_gene']
-    if 'vb' not in db_tcrs_df.columns and 'vb_gene' in db_tcrs_df.columns:
-        db_tcrs_df['vb'] = db_tcrs_df['vb_gene']
+    db_tcrs_df = _read_tcr_db_tsvfile(db_tcrs_tsvfile)
+    barcodes = np.array(adata.obs.index)
+    clusters_gex = np.array(adata.obs.clusters_gex.astype(str))
+    clusters_tcr = np.array(adata.obs.clusters_tcr.astype(str))
 
     # generate a list of df with database CDR3a or CDR3b matching to adata.obs
     matched_dfs = []
-    chains = ('cdr3a', 'cdr3b')
-    for i in range(len(chains)):
-
-        chain = chains[i]
-
-        matched_dfs.append( db_tcrs_df[ db_tcrs_df[chain].isin(query_tcrs_df[chain]) ].copy() )
-
-        matched_dfs[i] = matched_dfs[i].rename(columns = {'Unnamed: 0': 'db_index'})
-
-        if matched_dfs[i].empty:
+    for ab in 'ab':
+        chain = 'cdr3'+ab
+
+        # hash join on (genes, cdr3), or on (genes, cdr3 minus one position)
+        # for the edit-distance-1 neighborhood
+        pairs = _single_chain_match_keys(
+            db_tcrs_df, ab, match_genes, max_cdr3_edits).merge(
+                _single_chain_match_keys(
+                    query_tcrs_df, ab, match_genes, max_cdr3_edits),
+                on='key', suffixes=('_db', '_query'))
+        pairs = pairs[['row_db', 'row_query']].drop_duplicates()
+        if max_cdr3_edits:
+            # deletion variants can also match at edit distance 2
+            db_cdr3s = db_tcrs_df[chain].values
+            query_cdr3s = query_tcrs_df[chain].values
+            pairs = pairs[np.array(
+                [_within_one_edit(query_cdr3s[ii], db_cdr3s[jj])
+                 for jj, ii in zip(pairs.row_db, pairs.row_query)], dtype=bool)]
+        pairs = pairs.sort_values(['row_db', 'row_query'])
+
+        # list of (db row number, clone indices)
+        db_matches = [(jj, list(x.row_query))
+                      for jj, x in pairs.groupby('row_db', sort=True)]
+
+        matched_df = db_tcrs_df.iloc[[x[0] for x in db_matches]].copy()
+        matched_df = matched_df.rename(columns = {'Unnamed: 0': 'db_index'})
+
+        if matched_df.empty:
             print(f'No {chain} matches detected')
         else:
-            clones = []
-            gex_clusters = []
-            tcr_clusters = []
-
-            for (idx, row) in matched_dfs[i].iterrows():
-
-                clone_bc = adata.obs.index[adata.obs[chain] == row.loc[chain] ].to_list()
-                clone_gex = adata.obs.clusters_gex[adata.obs[chain] == row.loc[chain] ].astype(str).unique().tolist()
-                clone_tcr = adata.obs.clusters_tcr[adata.obs[chain] == row.loc[chain] ].astype(str).unique().tolist()
-
-                clones.append( ",".join(clone_bc) )
-                gex_clusters.append( ",".join(clone_gex) )
-                tcr_clusters.append( ",".join(clone_tcr) )
-
-            matched_dfs[i][f'{chain}_match_UMI'] = clones
-            matched_dfs[i][f'{chain}_match_gex_clusters'] = gex_clusters
-            matched_dfs[i][f'{chain}_match_tcr_clusters'] = tcr_clusters
+            # many db rows hit the same clones, so join the strings once
+            joined = {}
+            for _, matches in db_matches:
+                key = tuple(matches)
+                if key not in joined:
+                    joined[key] = (
+                        ",".join(barcodes[matches]),
+                        ",".join(pd.unique(clusters_gex[matches])),
+                        ",".join(pd.unique(clusters_tcr[matches])))
+            clones, gex_clusters, tcr_clusters = zip(
+                *[joined[tuple(x[1])] for x in db_matches])
+            matched_df[f'{chain}_match_UMI'] = clones
+            matched_df[f'{chain}_match_gex_clusters'] = gex_clusters
+            matched_df[f'{chain}_match_tcr_clusters'] = tcr_clusters
 
         if outfile_prefix is not None:
             csv_file = outfile_prefix + f'_single_chain_db_matches_{chain}.csv'
-            matched_dfs[i].to_csv(csv_file, index=False)
+            matched_df.to_csv(csv_file, index=False)
+
+        matched_dfs.append(matched_df)
 
     return matched_dfs
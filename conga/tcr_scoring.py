@@ -2,6 +2,7 @@
 import sys
 from sys import exit
 import math
+import hashlib
 from os.path import exists
 from pathlib import Path
 import pandas as pd
@@ -280,19 +281,117 @@ def property_score_tcr(
             beta_weight *property_score_cdr3(tcr[1][2], score_name, score_mode))
 
 
+TCR_SCORES_CACHE_KEY = 'X_tcr_scores_cache' # adata.obsm and adata.uns key
+
+_tcr_gene_columns = {} # organism -> (gene_columns, count_rep_columns)
+
+def _get_tcr_gene_columns(organism):
+    ''' returns two dicts, mapping gene names and gene count_reps to the
+    (i_ab, i_vj) position in the tcr tuples
+    '''
+    if organism in _tcr_gene_columns:
+        return _tcr_gene_columns[organism]
+    organism_genes = all_genes[organism]
+    gene_columns, count_rep_columns = {}, {}
+    for i_ab,ab in enumerate('AB'):
+        for i_vj,vj in enumerate('VJ'):
+            for x,y in organism_genes.items():
+                if y.chain==ab and y.region==vj:
+                    assert x not in gene_columns
+                    gene_columns[x] = (i_ab, i_vj)
+                    assert count_rep_columns.get(y.count_rep, (i_ab, i_vj)) \
+                        == (i_ab, i_vj)
+                    count_rep_columns[y.count_rep] = (i_ab, i_vj)
+    _tcr_gene_columns[organism] = (gene_columns, count_rep_columns)
+    return gene_columns, count_rep_columns
+
+def _is_cached_tcr_score(name, organism):
+    ''' The scores that only depend on the tcrs are cached, except for the
+    gene and count_rep indicators, which are cheap and numerous
+    '''
+    gene_columns, count_rep_columns = _get_tcr_gene_columns(organism)
+    return not (name.startswith('tcr_cluster') or
+                name in ['nndists_tcr', 'N_ins'] or
+                name in gene_columns or name in count_rep_columns)
+
+def _get_tcrs_hash(adata):
+    ''' hash of the tcr columns of adata.obs (and the organism), for
+    checking that the cached tcr scores are still valid
+    '''
+    tcrs_hash = preprocess.get_tcr_table(adata).content_hash()
+    return hashlib.sha1((tcrs_hash + adata.uns['organism']).encode()).hexdigest()
+
+def _get_cached_tcr_scores(adata, scorenames, verbose=False):
+    ''' Returns (names, table) where table has the cached tcr scores for
+    names, which includes scorenames. Scores not yet in the cache are computed
+    and added. The cache lives in adata.obsm[TCR_SCORES_CACHE_KEY] with the
+    names and the tcrs hash in adata.uns[TCR_SCORES_CACHE_KEY], and is thrown
+    away if the tcrs have changed
+    '''
+    tcrs_hash = _get_tcrs_hash(adata)
+    info = adata.uns.get(TCR_SCORES_CACHE_KEY, None)
+    if (info is None or info['tcrs_hash'] != tcrs_hash or
+        TCR_SCORES_CACHE_KEY not in adata.obsm_keys() or
+        adata.obsm[TCR_SCORES_CACHE_KEY].shape[1] != len(info['names'])):
+        names, table = [], np.zeros((adata.shape[0], 0))
+    else:
+        names = list(info['names'])
+        table = np.asarray(adata.obsm[TCR_SCORES_CACHE_KEY])
+
+    missing = [x for x in dict.fromkeys(scorenames) if x not in names]
+    if missing:
+        new_table = _make_tcr_score_table_uncached(adata, missing, verbose)
+        names += missing
+        table = np.hstack([table, new_table])
+        if not adata.is_view: # dont want to turn a view into a copy
+            adata.obsm[TCR_SCORES_CACHE_KEY] = table
+            adata.uns[TCR_SCORES_CACHE_KEY] = {
+                'tcrs_hash':tcrs_hash, 'names':names}
+    return names, table
+
+
 def make_tcr_score_table(adata, scorenames, verbose=False):
     ''' Returns a numpy array of the tcr scores with shape:
            (adata.shape[0], len(scorenames))
+
+    Scores that only depend on the tcrs are cached in adata, see
+    _get_cached_tcr_scores
     '''
+    organism = adata.uns['organism']
+    cached_names = [x for x in scorenames if _is_cached_tcr_score(x, organism)]
+    other_names = [x for x in scorenames if x not in cached_names]
+
+    table = np.zeros((adata.shape[0], len(scorenames)))
+    if cached_names:
+        names, cached_table = _get_cached_tcr_scores(
+            adata, cached_names, verbose)
+        cached_index = {x:i for i,x in enumerate(names)}
+        inds = [i for i,x in enumerate(scorenames) if x in cached_index]
+        table[:,inds] = cached_table[:,[cached_index[scorenames[i]]
+                                        for i in inds]]
+    if other_names:
+        inds = [i for i,x in enumerate(scorenames) if x in other_names]
+        table[:,inds] = _make_tcr_score_table_uncached(
+            adata, [scorenames[i] for i in inds], verbose)
+    return table
+
+
+def _make_tcr_score_table_uncached(adata, scorenames, verbose=False):
+    ''' see make_tcr_score_table '''
     global aa_props_df
     organism = adata.uns['organism']
 
-    tcrs = preprocess.retrieve_tcrs_from_adata(adata)
     clusters_tcr = None # might not exist
 
-    organism_genes = all_genes[organism]
-    genes = frozenset( organism_genes.keys())
-    count_reps = frozenset( [ x.count_rep for x in organism_genes.values() ] )
+    gene_columns, count_rep_columns = _get_tcr_gene_columns(organism)
+    needs_tcrs = any(_is_cached_tcr_score(x, organism) for x in scorenames)
+    tcr_table = preprocess.get_tcr_table(adata)
+    # copy the list, in case the scoring code modifies it
+    tcrs = list(tcr_table.tuples) if needs_tcrs else None
+
+    def get_tcr_gene_codes(i_ab, i_vj):
+        ''' returns (codes, genes), see preprocess.TcrTable.gene_codes '''
+        return tcr_table.gene_codes(['va ja'.split(), 'vb jb'.split()][i_ab][i_vj])
 
     cols = []
     for name in scorenames:
@@ -333,33 +432,17 @@ def make_tcr_score_table(adata, scorenames, verbose=False):
                 cols.append( np.zeros( adata.shape[0] ) )
             else:
                 cols.append( np.array(adata.obs['N_ins']).astype(float) )
-        elif name in genes:
-            matched = False
-            for i_ab,ab in enumerate('AB'):
-                for i_vj,vj in enumerate('VJ'):
-                    ii_genes = set([x for x,y in organism_genes.items()
-                                    if y.chain==ab and y.region==vj ])
-                    if name in ii_genes:
-                        assert not matched
-                        matched = True
-                        cols.append( [float(x[i_ab][i_vj]==name) for x in tcrs])
-            assert matched
-
-        elif name in count_reps:
-            matched = False
-            for i_ab,ab in enumerate('AB'):
-                for i_vj,vj in enumerate('VJ'):
-                    ii_count_reps = set(
-                        [x.count_rep
-                         for x in organism_genes.values()
-                         if x.chain==ab and x.region==vj ])
-                    if name in ii_count_reps:
-                        assert not matched
-                        matched = True
-                        cols.append(
-                            [float(organism_genes[x[i_ab][i_vj]].count_rep==name)
-                             for x in tcrs])
-            assert matched
+        elif name in gene_columns:
+            codes, genes = get_tcr_gene_codes(*gene_columns[name])
+            # the extra False is for missing genes, which have code -1
+            cols.append( np.append(genes == name, False)[codes].astype(float) )
+
+        elif name in count_rep_columns:
+            organism_genes = all_genes[organism]
+            codes, genes = get_tcr_gene_codes(*count_rep_columns[name])
+            count_reps = np.array([organism_genes[x].count_rep for x in genes])
+            cols.append(
+                np.append(count_reps == name, False)[codes].astype(float) )
 
         else:
             score_mode = name.split('_')[-1]
@@ -370,7 +453,7 @@ def make_tcr_score_table(adata, scorenames, verbose=False):
             cols.append([property_score_tcr(x, score_name, score_mode)
                          for x in tcrs])
 
-    table = np.array(cols).transpose()#[:,np.newaxis]
+    table = np.array(cols, dtype=float).transpose()#[:,np.newaxis]
 
     assert table.shape == (adata.shape[0], len(scorenames))
 
@@ -1,4 +1,5 @@
 from .basic import *
+import numpy as np
 from .all_genes import all_genes, gap_character
 from .amino_acids import amino_acids
 from .tcr_distances_blosum import blosum, bsd4
@@ -190,6 +191,120 @@ def compute_distance(t1, t2, chains, rep_dists):
                 weighted_cdr3_distance( t1[3], t2[3] )
     return dist
 
+## vectorized versions of the functions above, for computing blocks of distances
+##
+## CDR3s are encoded as integer arrays, padded with PAD_CODE, both left-justified
+## (for the N-terminal side of the gap) and right-justified and reversed (for
+## the C-terminal side). The V genes are encoded as row/column indices into a
+## matrix of the rep_dists values.
+##
+aa_codes = { aa:i for i,aa in enumerate(amino_acids) }
+PAD_CODE = len(amino_acids)
+
+def make_distance_lookup_table():
+    ''' DISTANCE_MATRIX as a numpy array indexed by aa_codes, with an extra
+    row and column of zeros for PAD_CODE
+    '''
+    table = np.zeros((PAD_CODE+1, PAD_CODE+1))
+    for a,i in aa_codes.items():
+        for b,j in aa_codes.items():
+            table[i,j] = DISTANCE_MATRIX[(a,b)]
+    return table
+
+def encode_cdr3s( cdr3s ):
+    ''' returns lens, nterm_codes, cterm_codes
+
+    nterm_codes[i,j] = code of cdr3s[i][j]
+    cterm_codes[i,j] = code of cdr3s[i][-1-j]
+    '''
+    lens = np.array([len(x) for x in cdr3s], dtype=int)
+    maxlen = max(1, lens.max()) if len(cdr3s) else 1
+    nterm_codes = np.full((len(cdr3s), maxlen), PAD_CODE, dtype=np.int8)
+    cterm_codes = np.full((len(cdr3s), maxlen), PAD_CODE, dtype=np.int8)
+    for i, cdr3 in enumerate(cdr3s):
+        codes = [aa_codes[x] for x in cdr3] # KeyError for non-standard aa
+        nterm_codes[i,:len(cdr3)] = codes
+        cterm_codes[i,:len(cdr3)] = codes[::-1]
+    return lens, nterm_codes, cterm_codes
+
+def _weighted_cdr3_distances( lens1, lens2, nterm1, nterm2, cterm1, cterm2,
+                              distance_table ):
+    ''' the arrays (as from encode_cdr3s) just have to broadcast against each
+    other, with the cdr3 positions along the last axis of the codes
+    '''
+    assert not ALIGN_CDR3S
+    ntrim = 3 if TRIM_CDR3S else 0
+    ctrim = 2 if TRIM_CDR3S else 0
+
+    lenshort = np.minimum(lens1, lens2)
+    lendiff = np.abs(lens1 - lens2)
+    assert lenshort.size == 0 or lenshort.min() > 1
+    if TRIM_CDR3S:
+        assert lenshort.size == 0 or lenshort.min() >= 3+2
+
+    # see weighted_cdr3_distance
+    gappos = np.minimum( 6, 3 + (lenshort-5)//2 )
+    remainder = lenshort - gappos
+
+    # accumulate in the same order as sequence_distance_with_gappos
+    dist = np.zeros(lenshort.shape)
+    for i in range(ntrim, min(nterm1.shape[-1], nterm2.shape[-1])):
+        mask = i < gappos
+        if not mask.any():
+            break
+        dist += np.where(
+            mask, distance_table[nterm1[...,i], nterm2[...,i]], 0.)
+    for i in range(ctrim, min(cterm1.shape[-1], cterm2.shape[-1])):
+        mask = i < remainder
+        if not mask.any():
+            break
+        dist += np.where(
+            mask, distance_table[cterm1[...,i], cterm2[...,i]], 0.)
+
+    ## Note that WEIGHT_CDR3_REGION is not applied to the gap penalty
+    ##
+    return WEIGHT_CDR3_REGION * dist + lendiff * GAP_PENALTY_CDR3_REGION
+
+def weighted_cdr3_distances_block( enc1, enc2, distance_table ):
+    ''' vectorized weighted_cdr3_distance for all pairs of the cdr3s encoded
+    by encode_cdr3s in enc1 and enc2
+
+    returns array of shape (len(enc1[0]), len(enc2[0]))
+
+    only supports ALIGN_CDR3S = False (ie fixed gap position)
+    '''
+    lens1, nterm1, cterm1 = enc1
+    lens2, nterm2, cterm2 = enc2
+    return _weighted_cdr3_distances(
+        lens1[:,None], lens2[None,:], nterm1[:,None,:], nterm2[None,:,:],
+        cterm1[:,None,:], cterm2[None,:,:], distance_table)
+
+def weighted_cdr3_distances_paired( enc1, enc2, distance_table ):
+    ''' vectorized weighted_cdr3_distance for the cdr3s encoded by
+    encode_cdr3s in enc1 and enc2, taken in pairs: enc1[i] vs enc2[i]
+
+    returns array of shape (len(enc1[0]),)
+    '''
+    lens1, nterm1, cterm1 = enc1
+    lens2, nterm2, cterm2 = enc2
+    assert lens1.shape == lens2.shape
+    return _weighted_cdr3_distances(
+        lens1, lens2, nterm1, nterm2, cterm1, cterm2, distance_table)
+
+class EncodedTcrs:
+    ''' paired tcrs encoded for TcrDistCalculator.pairwise, see
+    TcrDistCalculator.encode_tcrs
+
+    chains is a list [alpha_info, beta_info] where each info is a
+    (vcodes, encoded_cdr3s) tuple
+    '''
+    def __init__(self, chains, num_tcrs):
+        self.chains = chains
+        self.num_tcrs = num_tcrs
+
+    def __len__(self):
+        return self.num_tcrs
+
 ##################################################################################################################
 ##################################################################################################################
 
@@ -218,6 +333,70 @@ class TcrDistCalculator:
     def __init__(self, organism):
         self.rep_dists = compute_all_v_region_distances(organism)
 
+        # for vectorized calculations, see pairwise
+        self.v_codes = { v:i for i,v in enumerate(sorted(self.rep_dists.keys())) }
+        self.v_dists = np.zeros((len(self.v_codes), len(self.v_codes)))
+        for v1, i1 in self.v_codes.items():
+            for v2, d in self.rep_dists[v1].items():
+                self.v_dists[i1, self.v_codes[v2]] = d
+        self.distance_table = make_distance_lookup_table()
+
+    def encode_tcrs(self, tcrs):
+        ''' returns an encoded version of the paired tcrs for use in pairwise
+
+        useful for repeated one-vs-many queries against the same tcrs
+        '''
+        chains = [ ( np.array([self.v_codes[x[ab][0]] for x in tcrs], dtype=int),
+                     encode_cdr3s([x[ab][2] for x in tcrs]) )
+                   for ab in range(2) ]
+        return EncodedTcrs(chains, len(tcrs))
+
+    def pairwise_chunks(self, tcrs_a, tcrs_b=None, chunk_size=1000):
+        ''' Generates (start, stop, D_chunk) where D_chunk is the block of
+        distances between tcrs_a[start:stop] and all of tcrs_b
+
+        tcrs_a and tcrs_b are lists of paired tcrs, as for __call__, or the
+        output of encode_tcrs; tcrs_b=None means tcrs_b=tcrs_a
+        '''
+        enc_a = (tcrs_a if isinstance(tcrs_a, EncodedTcrs) else
+                 self.encode_tcrs(tcrs_a))
+        if tcrs_b is None:
+            enc_b = enc_a
+        else:
+            enc_b = (tcrs_b if isinstance(tcrs_b, EncodedTcrs) else
+                     self.encode_tcrs(tcrs_b))
+
+        for start in range(0, len(enc_a), chunk_size):
+            stop = min(len(enc_a), start+chunk_size)
+            D = None
+            # same order of summation as __call__
+            for (vcodes_a, cdr3s_a), (vcodes_b, cdr3s_b) in zip(enc_a.chains,
+                                                                enc_b.chains):
+                cdr3s_a = tuple(x[start:stop] for x in cdr3s_a)
+                vdists = self.v_dists[vcodes_a[start:stop][:,None],
+                                      vcodes_b[None,:]]
+                D = vdists if D is None else D + vdists
+                D += weighted_cdr3_distances_block(
+                    cdr3s_a, cdr3s_b, self.distance_table)
+            yield start, stop, D
+
+    def pairwise(self, tcrs_a, tcrs_b=None, chunk_size=1000):
+        ''' Returns the matrix of tcrdists between tcrs_a and tcrs_b, with
+        shape (len(tcrs_a), len(tcrs_b)), matching __call__ exactly
+
+        tcrs_a and tcrs_b are lists of paired tcrs, as for __call__, or the
+        output of encode_tcrs; tcrs_b=None means tcrs_b=tcrs_a
+
+        the calculation is done in chunks of chunk_size rows to limit memory
+        use. For one-vs-many queries just pass a single-element list as tcrs_a
+        '''
+        num_b = len(tcrs_a) if tcrs_b is None else len(tcrs_b)
+        D = np.zeros((len(tcrs_a), num_b))
+        for start, stop, D_chunk in self.pairwise_chunks(
+                tcrs_a, tcrs_b, chunk_size=chunk_size):
+            D[start:stop] = D_chunk
+        return D
+
     def __call__(self, tcr1, tcr2):
 
         ''' tcr1 and tcr2 are both paired tcrs, represented as tuples of tuples:
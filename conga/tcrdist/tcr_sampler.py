@@ -1,6 +1,7 @@
 import sys
-import random
+import multiprocessing
 from collections import OrderedDict, Counter
+import numpy as np
 import pandas as pd
 from .basic import *
 from . import translation
@@ -16,6 +17,15 @@ for organism in all_genes:
     all_trbd_nucseq[ organism ] = dict(
         ((d_ids.index(id)+1, all_genes[organism][id].nucseq ) for id in d_ids))
 
+# index the alleles by their gene prefix (eg 'TRAV1-1*'), in all_genes order
+all_allele_prefixes = {}
+for organism in all_genes:
+    prefix2alleles = {}
+    for id in all_genes[organism]:
+        if '*' in id:
+            prefix2alleles.setdefault(id[:id.index('*')+1], []).append(id)
+    all_allele_prefixes[organism] = prefix2alleles
+
 ########################################################################################################################
 default_mismatch_score_for_cdr3_nucseq_probabilities = -4 ## blast is -3
 default_mismatch_score_for_junction_analysis = -4 ## blast is -3
@@ -179,11 +189,13 @@ def find_alternate_alleles(
     # want to eventually make this the default:
     #mismatch_score = -1000 # 2022-01-21  this makes more sense to me (PB)
 
+    prefix2alleles = all_allele_prefixes[organism]
+
     v_prefix = v_gene[:v_gene.index('*')+1]
-    alternate_v_alleles = [ x for x in all_genes[organism] if x.startswith(v_prefix) and x != v_gene]
+    alternate_v_alleles = [ x for x in prefix2alleles.get(v_prefix, []) if x != v_gene]
 
     j_prefix = j_gene[:j_gene.index('*')+1]
-    alternate_j_alleles = [ x for x in all_genes[organism] if x.startswith(j_prefix) and x != j_gene]
+    alternate_j_alleles = [ x for x in prefix2alleles.get(j_prefix, []) if x != j_gene]
 
     best_v_gene = v_gene
     best_num_matched = 0 # initialize in case of problems like hitting the continue statement
@@ -238,12 +250,16 @@ def find_alternate_alleles_for_tcrs(
         print('find_alternate_alleles_for_tcrs: num_tcrs:', len(tcrs))
     all_counts = {}
     all_new_genes = []
+    alternate_alleles = {} # memoize, since there are lots of repeated chains
     for atcr, btcr in tcrs:
         new_genes = []
         for tcr in [atcr, btcr]:
             v, j, _, cdr3_nucseq = tcr
-            new_v, new_j = find_alternate_alleles(
-                organism, v, j, cdr3_nucseq, min_improvement=min_improvement_to_be_called_better)
+            if (v, j, cdr3_nucseq) not in alternate_alleles:
+                alternate_alleles[(v, j, cdr3_nucseq)] = find_alternate_alleles(
+                    organism, v, j, cdr3_nucseq,
+                    min_improvement=min_improvement_to_be_called_better)
+            new_v, new_j = alternate_alleles[(v, j, cdr3_nucseq)]
             all_counts.setdefault(v, Counter())[new_v] += 1
             all_counts.setdefault(j, Counter())[new_j] += 1
             new_genes.append((new_v, new_j))
@@ -451,24 +467,43 @@ def analyze_junction(
         )
 
 
-def parse_tcr_junctions( organism, tcrs ):
+def _analyze_junctions_worker(args):
+    organism, junctions = args
+    return [analyze_junction(organism, v, j, cdr3, cdr3_nucseq,
+                             return_cdr3_nucseq_src=True)
+            for v, j, cdr3, cdr3_nucseq in junctions]
+
+def parse_tcr_junctions( organism, tcrs, n_jobs=1 ):
     '''
     Analyze the junction regions of all the tcrs. Return a pandas dataframe with the results, in the same order
     as tcrs
+
+    Each distinct (v, j, cdr3, cdr3_nucseq) chain is only analyzed once; if
+    n_jobs>1 these are split across a process pool
     '''
 
+    junctions = list(dict.fromkeys(x for tcr in tcrs for x in tcr))
+    print('parse_tcr_junctions: num_tcrs:', len(tcrs),
+          'num_unique_junctions:', len(junctions))
+
+    if n_jobs > 1 and len(junctions) > 1:
+        chunk_size = 1 + (len(junctions)-1)//(4*n_jobs)
+        chunks = [(organism, junctions[i:i+chunk_size])
+                  for i in range(0, len(junctions), chunk_size)]
+        with multiprocessing.Pool(n_jobs) as pool:
+            results = pool.map(_analyze_junctions_worker, chunks)
+    else:
+        results = [_analyze_junctions_worker((organism, junctions))]
+    junction_results = dict(zip(junctions, (x for r in results for x in r)))
+
     dfl = []
 
     for ii, (atcr, btcr) in enumerate(tcrs):
-        if ii%1000==0:
-            print('parse_tcr_junctions:', ii, len(tcrs))
         va, ja, cdr3a, cdr3a_nucseq = atcr
         vb, jb, cdr3b, cdr3b_nucseq = btcr
 
-        aresults = analyze_junction(organism, va, ja, cdr3a, cdr3a_nucseq,
-                                    return_cdr3_nucseq_src=True)
-        bresults = analyze_junction(organism, vb, jb, cdr3b, cdr3b_nucseq,
-                                    return_cdr3_nucseq_src=True)
+        aresults = junction_results[atcr]
+        bresults = junction_results[btcr]
 
         # trims = ( v_trim, d0_trim, d1_trim, j_trim )
         # inserts = ( best_d_id, n_vd_insert, n_dj_insert, n_vj_insert )
@@ -522,137 +557,263 @@ def vj_compatible(v_gene, j_gene, organism):
     else:
         return True
 
-def resample_shuffled_tcr_chains(
+def _setup_shuffled_chain_sampler(
         organism,
-        num_samples,
-        chain, # 'A' or 'B'
-        junctions_df, # dataframe made by the above function
-        preserve_vj_pairings = False,
+        chain,
+        junctions_df,
+        preserve_vj_pairings,
 ):
-    ''' returns list of (v_gene, j_gene, cdr3, cdr3_nucseq) for inputting into tcrdist calcs (e.g.)
-
-    Does not impose a TRBJ1 --> TRBD1 restriction, but that could
-    be added...
-
+    ''' Returns a dict of numpy arrays describing the junctions, for
+    _sample_shuffled_tcr_chains
+
+    The breakpoints are stored in a boolean array indexed by
+    [pre_d/post_d, junction, position]: breakpoints[k,i,bp] is True if bp is
+    a breakpoint of junction i, and breakpoints[k,i,max_len+n] is True if -n
+    is a breakpoint (ie, n positions from the end). A breakpoint is the index
+    we can use as in  nucseq = nucseq1[:breakpoint] + nucseq2[breakpoint:]
     '''
-    assert chain in ['A', 'B']
-    # need list of (v_gene, j_gene, cdr3_nucseq, breakpoints_pre_d, breakpoints_post_d)
-    # breakpoints sets could contain negative numbers: that means read from the back
-    #
-    junctions = []
-    for l in junctions_df.itertuples():
+    ab = chain.lower()
+    v_genes = list(junctions_df['v'+ab])
+    j_genes = list(junctions_df['j'+ab])
+    nucseqs = list(junctions_df[f'cdr3{ab}_nucseq'])
+    nucseq_srcs = list(junctions_df[f'cdr3{ab}_nucseq_src'])
+    num_junctions = len(nucseqs)
+
+    lens = np.array([len(x) for x in nucseqs], dtype=int)
+    max_len = max(3, 3*((np.max(lens, initial=0)+2)//3)) # whole codons
+    seqs = np.zeros((num_junctions, max_len), dtype=np.uint8)
+    breakpoints = np.zeros((2, num_junctions, 2*max_len), dtype=bool)
+
+    for ii, (nucseq, nucseq_src) in enumerate(zip(nucseqs, nucseq_srcs)):
+        seqs[ii, :len(nucseq)] = np.frombuffer(nucseq.encode(), dtype=np.uint8)
         # where are the acceptable breakpoints?
         # dont allow breakpoints in the middle of V D or J
-        # the breakpoint is the index we can use as in  nucseq = nucseq1[:breakpoint] + nucseq2[breakpoint:]
-        breakpoints_pre_d = set()
-        breakpoints_post_d = set()
-        nucseq_src = l.cdr3a_nucseq_src if chain == 'A' else l.cdr3b_nucseq_src
-        #
+        L = len(nucseq_src)
         post_d = False
-        for ii in range(1,len(nucseq_src)):
-            ## ii refers to the breakpoint between position ii-1 and position ii
-            ## ie, right before position ii
-            a,b = nucseq_src[ii-1], nucseq_src[ii]
+        for jj in range(1,L):
+            ## jj refers to the breakpoint between position jj-1 and position jj
+            ## ie, right before position jj
+            a,b = nucseq_src[jj-1], nucseq_src[jj]
             if a=='D':
                 post_d = True
-            if a==b and a!='N':
-                #bad
-                pass
-            else:
-                # -1 would be ii==len(nucseq_src)-1
-                for bp in [ii, ii-len(nucseq_src)]:
-                    if post_d:
-                        breakpoints_post_d.add(bp)
-                    else:
-                        breakpoints_pre_d.add(bp)
-        if chain=='A':
-            junctions.append( (l.va, l.ja, l.cdr3a_nucseq,
-                               breakpoints_pre_d, breakpoints_post_d))
-        else:
-            junctions.append( (l.vb, l.jb, l.cdr3b_nucseq,
-                               breakpoints_pre_d, breakpoints_post_d))
+            if a!=b or a=='N':
+                breakpoints[int(post_d), ii, jj] = True
+                breakpoints[int(post_d), ii, max_len+L-jj] = True
+
+    # codon --> amino acid lookup table, over the nucleotide alphabet
+    alphabet = sorted(set(''.join(nucseqs))) or ['a']
+    char_codes = np.zeros((256,), dtype=np.int16)
+    char_codes[[ord(x) for x in alphabet]] = np.arange(len(alphabet))
+    codon_table = np.array(
+        [ord(translation.get_translation(a+b+c))
+         for a in alphabet for b in alphabet for c in alphabet], dtype=np.uint8)
+
+    v_codes, v_uniques = pd.factorize(pd.Series(v_genes, dtype=object))
+    j_codes, j_uniques = pd.factorize(pd.Series(j_genes, dtype=object))
+    vj_compatible_table = np.array(
+        [[vj_compatible(v, j, organism) for j in j_uniques] for v in v_uniques],
+        dtype=bool).reshape((len(v_uniques), len(j_uniques)))
+
+    data = dict(
+        chain=chain,
+        v_genes=v_genes,
+        j_genes=j_genes,
+        lens=lens,
+        seqs=seqs,
+        breakpoints=breakpoints,
+        nucseq_codes=pd.factorize(pd.Series(nucseqs, dtype=object))[0],
+        v_codes=v_codes,
+        j_codes=j_codes,
+        vj_compatible_table=vj_compatible_table,
+        char_codes=char_codes,
+        alphabet_size=len(alphabet),
+        codon_table=codon_table,
+    )
 
     if preserve_vj_pairings:
         # setup a mapping from v/j genes to junctions
         print('create gene --> junctions mapping')
-        v_gene2junctions, j_gene2junctions = {}, {}
         def trim_allele(g):
             return g[:g.index('*')]
-
-        for j in junctions:
-            vg = trim_allele(j[0])
-            jg = trim_allele(j[1])
-            v_gene2junctions.setdefault(vg,[]).append(j)
-            j_gene2junctions.setdefault(jg,[]).append(j)
-        #debugging
-        v_counts = Counter({x:len(y) for x,y in v_gene2junctions.items()})
-        j_counts = Counter({x:len(y) for x,y in j_gene2junctions.items()})
-        for v,count in v_counts.most_common():
-            print(f'v_count: {count:5d} {count/len(junctions):.3f} {v}')
-        for j,count in j_counts.most_common():
-            print(f'j_count: {count:5d} {count/len(junctions):.3f} {j}')
+        for vj, genes in [('v', v_genes), ('j', j_genes)]:
+            groups, group_genes = pd.factorize(
+                pd.Series([trim_allele(g) for g in genes], dtype=object))
+            sizes = np.bincount(groups, minlength=len(group_genes))
+            data[vj+'_groups'] = groups
+            data[vj+'_group_members'] = np.argsort(groups, kind='stable')
+            data[vj+'_group_starts'] = np.cumsum(sizes) - sizes
+            data[vj+'_group_sizes'] = sizes
+            #debugging
+            counts = Counter(dict(zip(group_genes, sizes)))
+            for g,count in counts.most_common():
+                print(f'{vj}_count: {count:5d} {count/num_junctions:.3f} {g}')
         sys.stdout.flush()
 
+    return data
 
-    # repeat:
-    # choose 2 random tcrs; are their breakpoints compatible?
-    # if so, choose random compatible breakpoint, make frankentcr
 
+def _sample_shuffled_tcr_chains(data, num_samples, seed_seq):
+    ''' Rejection sampler for resample_shuffled_tcr_chains, working on
+    batches of candidates. Returns (new_tcrs, attempts, successes)
+
+    Each candidate is one attempt of the old one-at-a-time loop: choose 2
+    random tcrs; are their breakpoints compatible? if so, choose random
+    compatible breakpoint, make frankentcr, reject if there's a stop codon.
+    For beta chains the pre-D and post-D breakpoints are tried in random
+    order.
+    '''
+    rng = np.random.default_rng(seed_seq)
+    lens, seqs = data['lens'], data['seqs']
+    num_junctions, max_len = seqs.shape
+    positions = np.arange(max_len)[None,:]
+    codon_positions = np.arange(max_len//3)[None,:]
+    num_inds = 1 if data['chain'] == 'A' else 2
+    preserve_vj_pairings = 'v_groups' in data
+
+    def choose_from_group(vj, inds):
+        groups = data[vj+'_groups'][inds]
+        offsets = rng.integers(0, data[vj+'_group_sizes'][groups])
+        return data[vj+'_group_members'][
+            data[vj+'_group_starts'][groups] + offsets]
+
+    def make_frankentcrs(t1, t2, ind):
+        ''' returns (success, new_seqs, new_lens, cdr3s) '''
+        shared = data['breakpoints'][ind, t1] & data['breakpoints'][ind, t2]
+        num_shared = shared.sum(axis=1)
+        # random shared breakpoint: the k-th True in each row of shared
+        k = rng.integers(0, np.maximum(num_shared, 1))
+        pick = np.argmax(np.cumsum(shared, axis=1, dtype=np.int16) > k[:,None],
+                         axis=1)
+        # nucseq = nucseq1[:cut1] + nucseq2[cut2:]
+        is_neg = pick >= max_len
+        offset = np.where(is_neg, pick - max_len, 0)
+        cut1 = np.where(is_neg, lens[t1] - offset, pick)
+        cut2 = np.where(is_neg, lens[t2] - offset, pick)
+        new_lens = cut1 + lens[t2] - cut2
+        assert np.all(new_lens[num_shared>0]%3 == 0)
+        inds2 = np.clip(positions - cut1[:,None] + cut2[:,None], 0, max_len-1)
+        new_seqs = np.where(positions < cut1[:,None], seqs[t1],
+                            np.take_along_axis(seqs[t2], inds2, axis=1))
+        new_seqs[positions >= new_lens[:,None]] = 0
+        # but is there a stop codon??
+        a = data['alphabet_size']
+        codons = data['char_codes'][new_seqs].reshape((len(t1), -1, 3))
+        cdr3s = data['codon_table'][
+            (codons[:,:,0]*a + codons[:,:,1])*a + codons[:,:,2]]
+        cdr3s[codon_positions >= new_lens[:,None]//3] = 0
+        success = (num_shared>0) & ~np.any(cdr3s == ord('*'), axis=1)
+        return success, new_seqs, new_lens, cdr3s
 
     new_tcrs = []
     attempts = 0
     successes = 0
     while len(new_tcrs) < num_samples:
-        #print(len(new_tcrs))
+        batch_size = max(100, 2*(num_samples - len(new_tcrs)))
         if preserve_vj_pairings:
-            j = random.choice(junctions) # determines v and j genes
-            t1 = random.choice(v_gene2junctions[trim_allele(j[0])])
-            t2 = random.choice(j_gene2junctions[trim_allele(j[1])])
+            j = rng.integers(0, num_junctions, size=batch_size) # determines v and j genes
+            t1 = choose_from_group('v', j)
+            t2 = choose_from_group('j', j)
         else:
-            t1 = random.choice(junctions)
-            t2 = random.choice(junctions)
-        nucseq1 = t1[2]
-        nucseq2 = t2[2]
-        if nucseq1 == nucseq2:
+            t1 = rng.integers(0, num_junctions, size=batch_size)
+            t2 = rng.integers(0, num_junctions, size=batch_size)
+        mask = ((data['nucseq_codes'][t1] != data['nucseq_codes'][t2]) &
+                data['vj_compatible_table'][data['v_codes'][t1],
+                                            data['j_codes'][t2]])
+        t1, t2 = t1[mask], t2[mask]
+        if len(t1) == 0:
             continue
 
-        if not vj_compatible(t1[0], t2[1], organism):
-            continue
+        # ind=0 is breakpoints_pre_d, ind=1 is breakpoints_post_d
+        first_ind = rng.integers(0, num_inds, size=len(t1))
+        success, new_seqs, new_lens, cdr3s = make_frankentcrs(t1, t2, first_ind)
+        if num_inds == 2: # try the other breakpoints for the failures
+            retry = np.nonzero(~success)[0]
+            success2, new_seqs2, new_lens2, cdr3s2 = make_frankentcrs(
+                t1[retry], t2[retry], 1-first_ind[retry])
+            retry = retry[success2]
+            success[retry] = True
+            new_seqs[retry] = new_seqs2[success2]
+            new_lens[retry] = new_lens2[success2]
+            cdr3s[retry] = cdr3s2[success2]
+
+        # stop at the success that completes num_samples
+        num_successes = np.cumsum(success)
+        num_tried = len(t1)
+        if num_successes[-1] >= num_samples - len(new_tcrs):
+            num_tried = np.searchsorted(
+                num_successes, num_samples - len(new_tcrs)) + 1
+        attempts += num_tried
+        successes += num_successes[num_tried-1]
+        inds = np.nonzero(success[:num_tried])[0]
+        # the zero-padded byte rows convert to strings as fixed-width arrays
+        new_tcrs.extend(zip(
+            [data['v_genes'][x] for x in t1[inds]],
+            [data['j_genes'][x] for x in t2[inds]],
+            np.ascontiguousarray(cdr3s[inds]).view(f'S{cdr3s.shape[1]}')
+            .ravel().astype(str).tolist(),
+            np.ascontiguousarray(new_seqs[inds]).view(f'S{max_len}')
+            .ravel().astype(str).tolist()))
+
+    return new_tcrs, attempts, successes
+
+
+_shuffled_chains_worker_data = None
+
+def _init_shuffled_chains_worker(data):
+    global _shuffled_chains_worker_data
+    _shuffled_chains_worker_data = data
+
+def _shuffled_chains_worker(args):
+    num_samples, seed_seq = args
+    return _sample_shuffled_tcr_chains(
+        _shuffled_chains_worker_data, num_samples, seed_seq)
+
+
+def resample_shuffled_tcr_chains(
+        organism,
+        num_samples,
+        chain, # 'A' or 'B'
+        junctions_df, # dataframe made by the above function
+        preserve_vj_pairings = False,
+        seed = None, # int or np.random.SeedSequence, None for fresh entropy
+        n_jobs = 1,
+        chunk_size = 10000,
+):
+    ''' returns list of (v_gene, j_gene, cdr3, cdr3_nucseq) for inputting into tcrdist calcs (e.g.)
+
+    Does not impose a TRBJ1 --> TRBD1 restriction, but that could
+    be added...
+
+    The samples are drawn in chunks of chunk_size, each with its own RNG
+    stream spawned from seed, so the results only depend on seed, not on
+    n_jobs (the chunks are split across n_jobs processes)
+
+    '''
+    assert chain in ['A', 'B']
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    data = _setup_shuffled_chain_sampler(
+        organism, chain, junctions_df, preserve_vj_pairings)
+
+    chunks = [min(chunk_size, num_samples-x)
+              for x in range(0, num_samples, chunk_size)]
+    args = list(zip(chunks, seed.spawn(len(chunks))))
+
+    if n_jobs > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(
+                min(n_jobs, len(chunks)),
+                initializer=_init_shuffled_chains_worker,
+                initargs=(data,)) as pool:
+            results = pool.map(_shuffled_chains_worker, args)
+    else:
+        _init_shuffled_chains_worker(data)
+        results = [_shuffled_chains_worker(x) for x in args]
 
-        inds = [3] if chain=='A' else [3,4]
-        random.shuffle(inds)
-
-        success = False
-        for ind in inds:
-            # ind=3: t1[ind] = breakpoints_pre_d
-            # ind=4: t1[ind] = breakpoints_post_d
-            shared = t1[ind] & t2[ind]
-            if shared:
-                bp = random.choice(list(shared))
-                nucseq = nucseq1[: bp] + nucseq2[bp :]
-                assert len(nucseq)%3==0
-                if bp<0: # DEBUGGING
-                    assert len(nucseq) == len(nucseq1)
-                else:
-                    assert len(nucseq) == len(nucseq2)
-                # but is there a stop codon??
-                cdr3 = translation.get_translation(nucseq)
-                assert len(cdr3) == len(nucseq)//3
-                if '*' not in cdr3:
-                    success = True
-                    t_new = ( t1[0], t2[1], cdr3, nucseq)
-                    # print('t1', translation.get_translation(t1[2]), t1)
-                    # print('t2', translation.get_translation(t2[2]), t2)
-                    # print('tn', translation.get_translation(t_new[3]), t_new)
-                    # print(bp, nucseq)
-                    new_tcrs.append(t_new)
-                    break
-        #print('success:', success)
-        attempts += 1
-        successes += success
-        if success and len(new_tcrs) >= num_samples:
-            break
-    print(f'success_rate: {100.0*successes/attempts:.2f}')
+    new_tcrs = [x for r in results for x in r[0]]
+    attempts = sum(r[1] for r in results)
+    successes = sum(r[2] for r in results)
+    print(f'success_rate: {100.0*successes/max(1,attempts):.2f}')
     return new_tcrs
 
 
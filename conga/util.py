@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import sys
 from os import system
 import os.path
@@ -164,6 +165,84 @@ def get_feature_types_varname( adata ):
 
 
 
+# value types in the object columns saved by dataframe_to_arrays
+_OBJECT_VALUE_TYPES = [(str, 1), ((bool, np.bool_), 2),
+                       ((int, np.integer), 3), ((float, np.floating), 4),
+                       (type(None), 5)]
+
+def _is_numpy_numeric_dtype(dtype):
+    return isinstance(dtype, np.dtype) and dtype.kind in 'biufc'
+
+def dataframe_to_arrays(df, prefix=''):
+    ''' Returns a dict of typed numpy arrays (no object arrays, so they can be
+    saved without pickling) from which dataframe_from_arrays rebuilds df
+
+    {prefix}columns and {prefix}dtypes are the column names and pandas dtype
+    strings. Numeric and bool columns are saved as {prefix}column{i}. Other
+    columns (eg the object columns from pd.read_csv: strings with missing
+    values, or bools with missing values) get a type code for each value in
+    {prefix}column{i}_kinds, and the values in {prefix}column{i}_str,
+    _num (bools and floats, including nan), and _int, so they come back
+    with the same Python types
+    '''
+    arrays = {prefix+'columns': np.array([str(x) for x in df.columns], dtype=str),
+              prefix+'dtypes': np.array([str(x) for x in df.dtypes], dtype=str)}
+    for ii, col in enumerate(df.columns):
+        tag = f'{prefix}column{ii}'
+        values = df[col]
+        if _is_numpy_numeric_dtype(values.dtype):
+            arrays[tag] = values.values
+            continue
+        values = np.asarray(values.astype(object))
+        kinds = np.zeros((len(values),), dtype=np.uint8)
+        strs = np.full((len(values),), '', dtype=object)
+        nums = np.full((len(values),), np.nan)
+        ints = np.zeros((len(values),), dtype=np.int64)
+        for jj, x in enumerate(values):
+            for value_type, kind in _OBJECT_VALUE_TYPES:
+                if isinstance(x, value_type):
+                    kinds[jj] = kind
+                    break
+            else:
+                print(f'ERROR dataframe_to_arrays:: column {col} has a value',
+                      f'of unsupported type {type(x)}:', x)
+                sys.exit(1)
+            if kind == 1:
+                strs[jj] = x
+            elif kind == 3:
+                ints[jj] = x
+            elif kind in [2,4]:
+                nums[jj] = x
+        arrays[tag+'_kinds'] = kinds
+        arrays[tag+'_str'] = np.array(strs, dtype=str)
+        arrays[tag+'_num'] = nums
+        arrays[tag+'_int'] = ints
+    return arrays
+
+def dataframe_from_arrays(arrays, prefix=''):
+    ''' Inverse of dataframe_to_arrays. arrays can be a dict, an open npz
+    file, or anything else that maps array names to arrays
+    '''
+    columns = OrderedDict()
+    for ii, (col, dtype) in enumerate(zip(arrays[prefix+'columns'].tolist(),
+                                          arrays[prefix+'dtypes'].tolist())):
+        tag = f'{prefix}column{ii}'
+        dtype = pd.api.types.pandas_dtype(dtype)
+        if _is_numpy_numeric_dtype(dtype):
+            columns[col] = pd.Series(arrays[tag], dtype=dtype)
+            continue
+        kinds = arrays[tag+'_kinds']
+        values = arrays[tag+'_str'].astype(object) # python strs
+        for kind, source, value_type in [(2, '_num', bool), (3, '_int', int),
+                                         (4, '_num', float)]:
+            mask = kinds == kind
+            if np.any(mask):
+                values[mask] = [value_type(x) for x in arrays[tag+source][mask]]
+        values[kinds == 5] = None
+        columns[col] = pd.Series(values, dtype=object).astype(dtype)
+    return pd.DataFrame(columns)
+
+
 def setup_uns_dicts(adata):
     if 'conga_results' not in adata.uns_keys():
         adata.uns['conga_results'] = {}
@@ -0,0 +1,29 @@
+######################################################################################88
+import argparse
+import sys
+import os
+
+parser = argparse.ArgumentParser(
+    description='Convert a clones file, its kernel PCs file, and its barcode '
+    'mapping file into a conga bundle: a directory of .npy files that '
+    'conga.preprocess.read_dataset (and so run_conga.py) memory-maps instead '
+    'of parsing the text files. read_dataset looks for the bundle at '
+    'clones_file[:-4]+\'_conga_bundle\' and uses it unless --kpca_file is '
+    'given or one of the text files is newer than the bundle.')
+
+parser.add_argument('--clones_file', required=True)
+parser.add_argument('--kpca_file', help='default is '
+                    'clones_file[:-4]+\'_AB.dist_50_kpcs\'; the bundle will '
+                    'have no kernel PCs if it doesnt exist')
+parser.add_argument('--bundle_dir', help='default is '
+                    'clones_file[:-4]+\'_conga_bundle\'')
+
+args = parser.parse_args()
+
+# put this after arg parsing because it's so dang slow
+sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) ) # so we can import conga
+from conga.preprocess import make_conga_bundle
+
+make_conga_bundle(args.clones_file, kpca_file=args.kpca_file,
+                  bundle_dir=args.bundle_dir)
+print('DONE')
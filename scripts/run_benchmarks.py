@@ -0,0 +1,1572 @@
+''' This script times some of the computationally intensive steps in the conga
+pipeline on synthetic data, and checks that the fast code paths give the same
+answers as the straightforward implementations they replaced.
+'''
+import argparse
+import sys
+import os
+
+benchmark_modes = ['nbrs', 'nbr_engines', 'kpca_memory', 'tcrdist_python',
+                   'kpca_solvers', 'nbr_nbr_overlaps',
+                   'graph_overlap_stats', 'nbrhood_ttests', 'mwu', 'hotspot',
+                   'tcr_score_table', 'clumping_background', 'tcr_clumping',
+                   'shuffled_chains', 'junctions', 'tcr_db_index',
+                   'db_match_fdr', 'single_chain_db_match', 'reduce_clones',
+                   'conga_bundle']
+
+parser = argparse.ArgumentParser(
+    description='Time core conga calculations on synthetic clonotype data',
+    epilog = f'''
+    Available modes: {' '.join(benchmark_modes)}
+
+    nbrs: GEX/TCR neighbor finding (calc_nbrs) with the vectorized
+          same-agroup/bgroup masking versus the old per-clone masking loop
+
+    nbr_engines: timing and recall@k of the non-exact nbr_engine options in
+          calc_nbrs, relative to the exact calculation
+
+    kpca_memory: peak RSS of the TCRdist kernel PCA calculation
+          (make_tcrdist_kernel_pcs_file_from_clones_file) with compact
+          uint16 tcrdist matrices versus the old float64 calculation. Each
+          version runs in a separate process
+
+    tcrdist_python: the vectorized TcrDistCalculator.pairwise versus the
+          scalar TcrDistCalculator.__call__ in a double loop (use a smaller
+          --num_clones, eg 2000, for this one)
+
+    kpca_solvers: timing and accuracy of the 'randomized' and 'nystroem'
+          kpca_solver options in make_tcrdist_kernel_pcs_file_from_clones_file
+          relative to the exact kernel PCs. Agreement is measured by the
+          largest principal angle between the PC subspaces and by the
+          Procrustes disparity
+
+    nbr_nbr_overlaps: the GEX-nbr vs TCR-nbr overlap scoring used in graph-
+          vs-graph analysis (correlations._find_neighbor_neighbor_interactions)
+          versus the old per-clone loop. Uses random nbr graphs with
+          overlapping nbrs planted in a small fraction of the clones. Only
+          the first --nbr_fracs value is used
+
+    graph_overlap_stats: the shuffling zscore for the overall GEX vs TCR
+          nbr graph overlap (correlations._compute_graph_overlap_stats) with
+          and without early stopping, using --n_jobs processes, versus the
+          old serial COO-matrix shuffling. Same graphs as nbr_nbr_overlaps
+
+    nbrhood_ttests: the nbrhood-vs-rest ttests in graph-vs-features analysis
+          (tcr_nbrhood_rank_genes_fast), computed in blocks of nbrhoods
+          from the sparse nbrhood incidence matrix, versus the old per-clone
+          masking loop. Uses a random sparse log-expression matrix with
+          --num_genes genes and the TCR nbr graph from nbr_nbr_overlaps
+
+    mwu: the cached-rank Mann-Whitney U tests used for graph-vs-features hits
+          (correlations._MannWhitneyRanks) versus scipy.stats.mannwhitneyu,
+          for random nbrhoods and genes of the nbrhood_ttests matrix
+
+    hotspot: the sparse-matmul Hotspot statistic in
+          correlations.find_hotspot_features versus the old per-clone loop,
+          on the nbrhood_ttests matrix and graph. Zscores for all the genes
+          are compared
+
+    tcr_score_table: tcr_scoring.make_tcr_score_table for the graph-vs-
+          features tcr features, first call (fills the cache in adata)
+          versus later calls
+
+    clumping_background: tcr_clumping.estimate_background_tcrdist_distributions
+          with a background_cache_dir: the first call computes and saves the
+          background counts, later calls (and calls with a smaller max_dist)
+          read them from the cache. Uses synthetic rearranged TCRs
+
+    tcr_clumping: tcr_clumping.find_tcr_clumping on synthetic rearranged
+          TCRs with a warm background cache, reporting the time spent in
+          python (Poisson scoring and clump assembly) separately from the
+          time in the C++ executables
+
+    shuffled_chains: tcr_sampler.resample_shuffled_tcr_chains (the batched
+          numpy rejection sampler, with --n_jobs processes) versus the old
+          one-at-a-time sampling loop. The samplers use different random
+          streams, so we compare success rates and the total variation
+          distances of the V, J, CDR3-length, and full (V, J, CDR3) sample
+          distributions to those between two runs of the old loop
+
+    junctions: tcr_sampler.parse_tcr_junctions (each distinct chain analyzed
+          once, in --n_jobs processes) versus the old per-tcr loop, and the
+          time for find_alternate_alleles_for_tcrs. The synthetic TCRs have
+          repeated chains, like real 10x data
+
+    tcr_db_index: paired tcrdist matching of --num_queries synthetic TCRs
+          against a synthetic --num_clones TCR database (default size is
+          about that of VDJdb) using tcr_clumping.build_tcr_db_index and
+          TcrDbIndex.find_matches, versus the C++ find_paired_matches
+          all-vs-all comparison that match_adata_tcrs_to_db_tcrs runs
+          without an index. The match tables have to be identical, and the
+          db tables loaded from the index files (including one for the
+          bundled human db) have to equal pd.read_csv of the tsvfiles
+
+    db_match_fdr: the Benjamini-Hochberg FDR values for tcrdist db matches
+          (tcr_clumping._fdr_bh_with_implicit_ones, memory proportional to
+          the number of hits) versus the old multipletests call on an array
+          padded with 1.0 out to num_comparisons. Uses --num_clones queries
+          against a 50000-tcr db and --num_queries hits (the old version
+          needs several GB at --num_clones 5000). Also checks the zero-hit
+          case, in the FDR calculation and in find_significant_tcrdist_matches
+          (with the C++ matcher and with a TcrDbIndex)
+
+    single_chain_db_match: tcr_clumping.strict_single_chain_match_adata_tcrs_to_db_tcrs
+          (hash join on the CDR3s) versus the old per-db-row scans of adata,
+          for a synthetic db of --num_queries tcrs, half of them sharing
+          chains with adata. Also times the V-gene and edit-distance-1
+          matching options
+
+    reduce_clones: preprocess.reduce_to_single_cell_per_clone on --num_clones
+          synthetic cells (clone sizes are geometric, mean 2) with
+          average_clone_gex, and the old per-clone masking loop for choosing
+          representative cells, run on 20000 cells only since it's
+          O(num_cells * num_clones). Each dataset also has one big clone
+          (20000 cells, or 5000 for the old loop), and the peak memory for
+          finding its representative cell is reported. The reduced X gets
+          densified by sc.pp.scale, so use a modest --num_genes, eg 100, for
+          500k cells
+
+    conga_bundle: preprocess.read_dataset from a memory-mapped conga bundle
+          (preprocess.make_conga_bundle) versus from the clones, kpca, and
+          barcode mapping text files, for --num_clones synthetic clones with
+          1-3 cells each plus some cells without tcrs. The clones table from
+          the bundle has to equal pd.read_csv of the clones file
+
+    Example command:
+
+python3 {sys.argv[0]} --mode nbrs --num_clones 50000
+
+    ''',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+
+parser.add_argument('--mode', choices=benchmark_modes, required=True)
+parser.add_argument('--num_clones', type=int, default=50000)
+parser.add_argument('--num_pcs', type=int, default=50)
+parser.add_argument('--nbr_fracs', type=float, nargs='*', default=[0.01, 0.1])
+parser.add_argument('--organism', default='human')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--n_jobs', type=int, default=1)
+parser.add_argument('--num_genes', type=int, default=2000)
+parser.add_argument('--num_queries', type=int, default=2000)
+parser.add_argument('--num_landmarks', type=int, nargs='*',
+                    default=[500, 1000, 2000])
+parser.add_argument('--float_tcrdists', action='store_true',
+                    help=argparse.SUPPRESS) # internal, for kpca_memory
+parser.add_argument('--kpca_worker', action='store_true',
+                    help=argparse.SUPPRESS) # internal, for kpca_memory
+
+args = parser.parse_args()
+
+import time
+import resource
+import subprocess
+conga_dir = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+sys.path.append(conga_dir) # in order to import conga package
+import numpy as np
+import pandas as pd
+import scipy.sparse as sps
+from scipy import stats
+from scipy.spatial.distance import cdist
+from scipy.spatial import procrustes
+from scipy.linalg import subspace_angles
+from scipy.stats import hypergeom
+from sklearn.decomposition import KernelPCA
+from anndata import AnnData
+import conga
+from conga import preprocess
+from conga import correlations
+from conga.tcrdist.all_genes import all_genes
+from conga.tcrdist.amino_acids import amino_acids
+
+
+def make_synthetic_adata(
+        num_clones,
+        organism,
+        num_pcs = 50,
+        shared_chain_fraction = 0.05,
+        seed = 1,
+):
+    ''' Returns an AnnData with random GEX/TCR PCs and random TCRs
+
+    a fraction of the clones share their alpha or beta chain with another
+    clone, so that the agroups/bgroups are not all singletons
+    '''
+    rng = np.random.default_rng(seed)
+    genes = all_genes[organism]
+    vgenes = {ab:sorted(x for x,g in genes.items()
+                        if g.chain == ab and g.region == 'V')
+              for ab in 'AB'}
+    jgenes = {ab:sorted(x for x,g in genes.items()
+                        if g.chain == ab and g.region == 'J')
+              for ab in 'AB'}
+
+    def random_chain(ab):
+        v = vgenes[ab][rng.integers(len(vgenes[ab]))]
+        j = jgenes[ab][rng.integers(len(jgenes[ab]))]
+        cdr3 = 'CA' + ''.join(rng.choice(list(amino_acids),
+                                         rng.integers(6, 13))) + 'F'
+        nucseq = ''.join(rng.choice(list('acgt'), 3*len(cdr3)))
+        return (v, j, cdr3, nucseq)
+
+    tcrs = []
+    for ii in range(num_clones):
+        atcr, btcr = random_chain('A'), random_chain('B')
+        if ii and rng.random() < shared_chain_fraction:
+            # share a chain with an earlier clone
+            other = tcrs[rng.integers(ii)]
+            if rng.random() < 0.5:
+                atcr = other[0]
+            else:
+                btcr = other[1]
+        tcrs.append((atcr, btcr))
+
+    obs = pd.DataFrame(index=[f'clone_{x}' for x in range(num_clones)])
+    adata = AnnData(X=np.zeros((num_clones, 1), dtype=np.float32), obs=obs)
+    preprocess.store_tcrs_in_adata(adata, tcrs)
+    adata.uns['organism'] = organism
+    adata.obsm['X_pca_gex'] = rng.standard_normal((num_clones, num_pcs))
+    adata.obsm['X_pca_tcr'] = rng.standard_normal((num_clones, num_pcs))
+    return adata
+
+
+def make_synthetic_rearranged_tcrs(
+        num_clones,
+        organism,
+        clump_fraction = 0.05,
+        seed = 1,
+):
+    ''' Returns a list of (atcr, btcr) tuples with cdr3 nucseqs made from
+    the V and J gene nucleotide sequences, with random trimming and N
+    insertions, so that junction parsing and the tcr clumping background
+    resampling work on them.
+
+    A fraction of the clones are single-mutation variants of earlier clones,
+    which gives some tcrdist clumps
+    '''
+    from conga.tcrdist import tcr_sampler
+    from conga.tcrdist.translation import get_translation
+    rng = np.random.default_rng(seed)
+    genes = all_genes[organism]
+    segments = {}
+    for ab in 'AB':
+        for vj, get_cdr3_nucseq in [('V', tcr_sampler.get_v_cdr3_nucseq),
+                                    ('J', tcr_sampler.get_j_cdr3_nucseq)]:
+            segments[ab+vj] = []
+            for g in sorted(genes):
+                if genes[g].chain != ab or genes[g].region != vj:
+                    continue
+                try:
+                    nucseq = get_cdr3_nucseq(organism, g)
+                except Exception: # some genes lack the cdr3 info
+                    continue
+                if len(nucseq) >= 9:
+                    segments[ab+vj].append((g, nucseq))
+
+    def random_chain(ab):
+        while True:
+            v, v_nucseq = segments[ab+'V'][rng.integers(len(segments[ab+'V']))]
+            j, j_nucseq = segments[ab+'J'][rng.integers(len(segments[ab+'J']))]
+            v_nucseq = v_nucseq[:len(v_nucseq)-rng.integers(0, 7)]
+            j_nucseq = j_nucseq[rng.integers(0, 7):]
+            num_n = rng.integers(0, 10)
+            num_n += (-(len(v_nucseq)+num_n+len(j_nucseq)))%3
+            n_nucseq = ''.join(rng.choice(list('acgt'), num_n))
+            nucseq = v_nucseq + n_nucseq + j_nucseq
+            cdr3 = get_translation(nucseq)
+            if '*' not in cdr3 and 8 <= len(cdr3) <= 20:
+                return (v, j, cdr3, nucseq)
+
+    def mutate_chain(tcr):
+        v, j, cdr3, nucseq = tcr
+        while True:
+            pos = rng.integers(3, len(nucseq)-3)
+            new_nucseq = nucseq[:pos] + rng.choice(list('acgt')) + nucseq[pos+1:]
+            new_cdr3 = get_translation(new_nucseq)
+            if '*' not in new_cdr3:
+                return (v, j, new_cdr3, new_nucseq)
+
+    tcrs = []
+    for ii in range(num_clones):
+        if ii and rng.random() < clump_fraction:
+            atcr, btcr = tcrs[rng.integers(ii)]
+            if rng.random() < 0.5:
+                atcr = mutate_chain(atcr)
+            else:
+                btcr = mutate_chain(btcr)
+        else:
+            atcr, btcr = random_chain('A'), random_chain('B')
+        tcrs.append((atcr, btcr))
+    return tcrs
+
+
+def calc_nbrs_batched_legacy(
+        adata,
+        nbr_fracs,
+        obsm_tag,
+        target_N_for_batching = 8192,
+):
+    ''' The old neighbor calculation, with a per-clone O(N) group mask
+    returns dict mapping from nbr_frac to nbrs
+    '''
+    N = adata.shape[0]
+    batch_size = max(10, int(target_N_for_batching**2/N))
+    num_batches = (N-1)//batch_size + 1
+    agroups, bgroups = preprocess.setup_tcr_groups(adata)
+    X = adata.obsm[obsm_tag]
+    all_nbrs = {x:np.zeros((N, max(1, int(x*N))), dtype=np.int32)
+                for x in nbr_fracs}
+    for bb in range(num_batches):
+        b_start = bb*batch_size
+        b_stop = min(N, (bb+1)*batch_size)
+        D = cdist( X[b_start:b_stop, :], X )
+        for ii in range(b_start, b_stop):
+            D[ii-b_start, (agroups==agroups[ii]) ] = 1e3
+            D[ii-b_start, (bgroups==bgroups[ii]) ] = 1e3
+        for nbr_frac in nbr_fracs:
+            num_neighbors = max(1, int(nbr_frac*N))
+            all_nbrs[nbr_frac][b_start:b_stop,:] = np.argpartition(
+                D, num_neighbors-1 )[:,:num_neighbors]
+    return all_nbrs
+
+
+def same_nbr_sets(nbrs1, nbrs2):
+    return np.array_equal(np.sort(nbrs1, axis=1), np.sort(nbrs2, axis=1))
+
+
+def benchmark_nbrs(adata, nbr_fracs):
+    start = time.time()
+    old_nbrs = calc_nbrs_batched_legacy(adata, nbr_fracs, 'X_pca_gex')
+    old_time = time.time() - start
+
+    start = time.time()
+    new_nbrs = preprocess.calc_nbrs(adata, nbr_fracs, obsm_tag_tcr=None)
+    new_time = time.time() - start
+
+    for nbr_frac in nbr_fracs:
+        same = same_nbr_sets(old_nbrs[nbr_frac], new_nbrs[nbr_frac][0])
+        print(f'nbr_frac= {nbr_frac} identical_nbrs= {same}')
+        assert same
+    print(f'benchmark nbrs: num_clones= {adata.shape[0]}',
+          f'old_time= {old_time:.2f} new_time= {new_time:.2f}',
+          f'speedup= {old_time/new_time:.2f}')
+
+
+def benchmark_nbr_engines(adata, nbr_fracs):
+    start = time.time()
+    exact_nbrs = preprocess.calc_nbrs(adata, nbr_fracs, obsm_tag_tcr=None)
+    exact_time = time.time() - start
+    print(f'benchmark nbr_engines: engine= exact time= {exact_time:.2f}')
+
+    for nbr_engine in preprocess.NBR_ENGINES:
+        if nbr_engine == 'exact':
+            continue
+        start = time.time()
+        all_nbrs = preprocess.calc_nbrs(
+            adata, nbr_fracs, obsm_tag_tcr=None, nbr_engine=nbr_engine)
+        engine_time = time.time() - start
+        for nbr_frac in nbr_fracs:
+            recall = preprocess.calc_nbr_recall(
+                all_nbrs[nbr_frac][0], exact_nbrs[nbr_frac][0])
+            print(f'benchmark nbr_engines: engine= {nbr_engine}',
+                  f'time= {engine_time:.2f} nbr_frac= {nbr_frac}',
+                  f'mean_recall= {np.mean(recall):.4f}',
+                  f'min_recall= {np.min(recall):.4f}')
+
+
+def get_peak_rss_gb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss / 1024**2
+
+
+def calc_tcrdist_kpcs_legacy(tcrs, organism, n_components=50):
+    ''' The old kernel PCA calculation, with float64 distances '''
+    D = preprocess.calc_tcrdist_matrix_cpp(tcrs, organism)
+    pca = KernelPCA(kernel='precomputed', n_components=n_components)
+    gram = np.maximum(0.0, 1 - ( D / D.max() ))
+    return pca.fit_transform(gram)
+
+
+def run_kpca_worker(adata, compact_tcrdists):
+    tcrs = preprocess.retrieve_tcrs_from_adata(adata)
+    rss_before = get_peak_rss_gb()
+    start = time.time()
+    if compact_tcrdists:
+        preprocess.make_tcrdist_kernel_pcs_file_from_clones_file(
+            None, adata.uns['organism'], tcrs=tcrs, return_pcs=True)
+    else:
+        calc_tcrdist_kpcs_legacy(tcrs, adata.uns['organism'])
+    print(f'kpca_worker: num_clones= {len(tcrs)}',
+          f'compact_tcrdists= {compact_tcrdists}',
+          f'time= {time.time()-start:.2f}',
+          f'peak_rss_before_kpca= {rss_before:.3f}GB',
+          f'peak_rss= {get_peak_rss_gb():.3f}GB')
+
+
+def benchmark_kpca_memory():
+    for float_tcrdists in [False, True]:
+        cmd = [sys.executable, os.path.abspath(__file__), '--mode',
+               'kpca_memory', '--kpca_worker', '--num_clones',
+               str(args.num_clones), '--organism', args.organism,
+               '--seed', str(args.seed)]
+        if float_tcrdists:
+            cmd.append('--float_tcrdists')
+        output = subprocess.run(cmd, capture_output=True, text=True).stdout
+        lines = [x for x in output.split('\n') if x.startswith('kpca_worker:')]
+        assert len(lines) == 1, output
+        print('benchmark kpca_memory:', lines[0][len('kpca_worker: '):])
+
+
+def benchmark_tcrdist_python(adata):
+    tcrs = preprocess.retrieve_tcrs_from_adata(adata)
+    tcrdister = conga.tcrdist.tcr_distances.TcrDistCalculator(
+        adata.uns['organism'])
+
+    start = time.time()
+    old_D = np.array([[tcrdister(x,y) for y in tcrs] for x in tcrs])
+    old_time = time.time() - start
+
+    start = time.time()
+    new_D = tcrdister.pairwise(tcrs)
+    new_time = time.time() - start
+
+    same = np.array_equal(old_D, new_D)
+    print(f'benchmark tcrdist_python: identical_tcrdists= {same}')
+    assert same
+    print(f'benchmark tcrdist_python: num_clones= {len(tcrs)}',
+          f'old_time= {old_time:.2f} new_time= {new_time:.2f}',
+          f'speedup= {old_time/new_time:.2f}')
+
+
+def compare_kpcs(xy, exact_xy, num_pcs_for_angles=10):
+    ''' returns max principal angle (degrees) between the spans of the top
+    num_pcs_for_angles PCs, and the Procrustes disparity of all the PCs
+    '''
+    n = min(num_pcs_for_angles, xy.shape[1])
+    max_angle = np.degrees(np.max(subspace_angles(xy[:,:n], exact_xy[:,:n])))
+    _, _, disparity = procrustes(exact_xy, xy)
+    return max_angle, disparity
+
+
+def benchmark_kpca_solvers(adata, num_landmarks_list):
+    tcrs = preprocess.retrieve_tcrs_from_adata(adata)
+    organism = adata.uns['organism']
+
+    start = time.time()
+    exact_xy = preprocess.make_tcrdist_kernel_pcs_file_from_clones_file(
+        None, organism, tcrs=tcrs, return_pcs=True)
+    print(f'benchmark kpca_solvers: solver= exact',
+          f'time= {time.time()-start:.2f}')
+
+    runs = [('randomized', None)] + [('nystroem', x)
+                                     for x in num_landmarks_list]
+    for kpca_solver, num_landmarks in runs:
+        start = time.time()
+        xy = preprocess.make_tcrdist_kernel_pcs_file_from_clones_file(
+            None, organism, tcrs=tcrs, return_pcs=True, kpca_solver=kpca_solver,
+            num_landmarks=num_landmarks, random_state=args.seed)
+        solver_time = time.time() - start
+        max_angle, disparity = compare_kpcs(xy, exact_xy)
+        print(f'benchmark kpca_solvers: solver= {kpca_solver}',
+              f'num_landmarks= {num_landmarks} time= {solver_time:.2f}',
+              f'max_angle_top10= {max_angle:.3f}',
+              f'procrustes_disparity= {disparity:.4f}')
+
+
+def find_neighbor_neighbor_interactions_legacy(
+        adata,
+        nbrs_gex,
+        nbrs_tcr,
+        agroups,
+        bgroups,
+        pval_threshold,
+        counts_correction=0,
+        correct_overlaps_for_groups=True,
+        scale_pvals_by_num_clones=True,
+):
+    ''' The old correlations._find_neighbor_neighbor_interactions, with a
+    python loop over all the clones
+    '''
+    preprocess.add_mait_info_to_adata_obs(adata) # for annotation of overlaps
+    is_mait = adata.obs['is_invariant']
+
+    num_clones = len(nbrs_gex)
+
+    pval_rescale = num_clones if scale_pvals_by_num_clones else 1.0
+
+    results = []
+    adjusted_pvalues = [pval_rescale]*num_clones # initialize to big value
+
+    for ii in range(num_clones):
+        is_ii_group = (agroups==agroups[ii]) | (bgroups==bgroups[ii])
+        assert is_ii_group[ii]
+        actual_num_clones = num_clones - np.sum( is_ii_group ) - counts_correction
+
+        ii_nbrs_gex = nbrs_gex[ii] # might be slice of array, or list entry if use_sym_nbrs
+        ii_nbrs_tcr = nbrs_tcr[ii]
+        ii_nbrs_gex_set = frozenset( ii_nbrs_gex)
+        assert ii not in ii_nbrs_gex_set
+
+        num_neighbors_gex = len(ii_nbrs_gex)
+        num_neighbors_tcr = len(ii_nbrs_tcr)
+
+        overlap = sum( 1 for x in ii_nbrs_tcr if x in ii_nbrs_gex_set )
+        expected_overlap = float( num_neighbors_gex*num_neighbors_tcr )/actual_num_clones
+        if overlap and overlap > expected_overlap:
+            nbr_pval = pval_rescale * hypergeom.sf( overlap-1, actual_num_clones, num_neighbors_gex, num_neighbors_tcr)
+        else:
+            nbr_pval = pval_rescale
+
+        adjusted_pvalues[ii] = nbr_pval
+
+        if nbr_pval > pval_threshold:
+            continue ## NOTE
+
+        double_nbrs = [ x for x in ii_nbrs_tcr if x in ii_nbrs_gex_set ]
+        assert overlap == len(double_nbrs)
+
+        overlap_corrected = overlap
+        if correct_overlaps_for_groups:
+            # this is heuristic
+            overlap_corrected = min(len(set(agroups[double_nbrs])),
+                                    len(set(bgroups[double_nbrs])) )
+
+            if overlap_corrected < overlap:
+                delta = overlap-overlap_corrected
+                nbr_pval = pval_rescale * hypergeom.sf(
+                    overlap_corrected-1, actual_num_clones,
+                    num_neighbors_gex-delta, num_neighbors_tcr-delta)
+                adjusted_pvalues[ii] = nbr_pval # update
+                if nbr_pval > pval_threshold:
+                    continue ## NOTE
+
+        nbr_pval = max(nbr_pval, correlations.MIN_CONGA_SCORE) # no 0s
+        results.append(dict(conga_score=nbr_pval,
+                            num_neighbors_gex=num_neighbors_gex,
+                            num_neighbors_tcr=num_neighbors_tcr,
+                            overlap=overlap,
+                            overlap_corrected=overlap_corrected,
+                            mait_fraction=np.sum(is_mait[double_nbrs])/overlap,
+                            clone_index=ii ))#double_nbrs ] )
+
+    adjusted_pvalues = np.maximum(np.array(adjusted_pvalues), correlations.MIN_CONGA_SCORE)
+
+    return pd.DataFrame(results), adjusted_pvalues
+
+
+def make_synthetic_nbrs(num_clones, num_nbrs, signal_fraction=0.02, seed=1):
+    ''' Returns random (nbrs_gex, nbrs_tcr) arrays, without self-nbrs. For a
+    signal_fraction of the clones, half of the tcr nbrs are gex nbrs
+    '''
+    rng = np.random.default_rng(seed)
+    nbrs = []
+    for _ in range(2):
+        inbrs = np.zeros((num_clones, num_nbrs), dtype=np.int32)
+        for ii in range(num_clones):
+            inbrs[ii] = rng.choice(num_clones-1, num_nbrs, replace=False)
+        inbrs += (inbrs >= np.arange(num_clones)[:,None]) # skip self
+        nbrs.append(inbrs)
+    nbrs_gex, nbrs_tcr = nbrs
+    num_shared = num_nbrs//2
+    for ii in np.nonzero(rng.random(num_clones) < signal_fraction)[0]:
+        shared = nbrs_gex[ii, :num_shared]
+        others = np.setdiff1d(nbrs_tcr[ii], shared)[:num_nbrs-num_shared]
+        if len(others) == num_nbrs-num_shared:
+            nbrs_tcr[ii] = np.concatenate([shared, others])
+    return nbrs_gex, nbrs_tcr
+
+
+def benchmark_nbr_nbr_overlaps(adata, nbr_frac):
+    num_clones = adata.shape[0]
+    num_nbrs = max(1, int(nbr_frac*num_clones))
+    nbrs_gex, nbrs_tcr = make_synthetic_nbrs(num_clones, num_nbrs,
+                                             seed=args.seed)
+    agroups, bgroups = preprocess.setup_tcr_groups(adata)
+    pval_threshold = 1.
+
+    start = time.time()
+    old_df, old_pvals = find_neighbor_neighbor_interactions_legacy(
+        adata, nbrs_gex, nbrs_tcr, agroups, bgroups, pval_threshold)
+    old_time = time.time() - start
+
+    start = time.time()
+    new_df, new_pvals = correlations._find_neighbor_neighbor_interactions(
+        adata, nbrs_gex, nbrs_tcr, agroups, bgroups, pval_threshold)
+    new_time = time.time() - start
+
+    same = (np.array_equal(old_pvals, new_pvals) and
+            old_df.shape == new_df.shape and
+            np.array_equal(old_df.values, new_df.values))
+    print(f'benchmark nbr_nbr_overlaps: num_hits= {new_df.shape[0]}',
+          f'identical_results= {same}')
+    assert same
+    print(f'benchmark nbr_nbr_overlaps: num_clones= {num_clones}',
+          f'num_nbrs= {num_nbrs}',
+          f'old_time= {old_time:.2f} new_time= {new_time:.2f}',
+          f'speedup= {old_time/new_time:.2f}')
+
+
+def graph_overlap_zscore_legacy(gex_nbrs, tcr_nbrs, num_random_repeats):
+    ''' The old shuffling in correlations._compute_graph_overlap_stats
+    returns overlap, mean, sdev
+    '''
+    N = len(gex_nbrs)
+    M0 = correlations._make_csr_nbrs(gex_nbrs)
+    M1 = correlations._make_csr_nbrs(tcr_nbrs).tocoo()
+    M2 = M1.copy()
+    overlaps = []
+    for r in range(num_random_repeats+1):
+        if r:
+            p = np.random.permutation(N)
+        else:
+            p = np.arange(N)
+        M1.row = p[M2.row]
+        M1.col = p[M2.col]
+        overlaps.append(M0.multiply(M1.tocsr()).sum())
+    return overlaps[0], np.mean(overlaps[1:]), np.std(overlaps[1:])
+
+
+def benchmark_graph_overlap_stats(adata, nbr_frac, num_random_repeats=100):
+    num_clones = adata.shape[0]
+    num_nbrs = max(1, int(nbr_frac*num_clones))
+    nbrs_gex, nbrs_tcr = make_synthetic_nbrs(num_clones, num_nbrs,
+                                             seed=args.seed)
+    start = time.time()
+    o0, m, s = graph_overlap_zscore_legacy(nbrs_gex, nbrs_tcr,
+                                           num_random_repeats)
+    print(f'benchmark graph_overlap_stats: version= old',
+          f'time= {time.time()-start:.2f} overlap= {o0}',
+          f'zscore= {(o0-m)/s:.2f} num_shuffles= {num_random_repeats}')
+
+    for early_stopping in [False, True]:
+        start = time.time()
+        stats = correlations._compute_graph_overlap_stats(
+            nbrs_gex, nbrs_tcr, num_random_repeats, n_jobs=args.n_jobs,
+            seed=args.seed, early_stopping=early_stopping,
+            max_calculation_time=1e6)
+        print(f'benchmark graph_overlap_stats: version= new',
+              f'early_stopping= {early_stopping} n_jobs= {args.n_jobs}',
+              f'time= {time.time()-start:.2f} overlap= {stats["overlap"]}',
+              f'zscore= {stats["overlap_zscore"]:.2f}',
+              f'num_shuffles= {stats["num_shuffles"]}')
+
+
+def nbrhood_ttests_legacy(X, nbrs, top_n, min_num_fg=3):
+    ''' The old per-clone ttests in correlations.tcr_nbrhood_rank_genes_fast
+    returns {clone_index: (top_n gene indices, their pvals)}
+    '''
+    num_clones = X.shape[0]
+    X_sq = X.multiply(X)
+    mean, mean_sq = X.mean(axis=0).A1, X_sq.mean(axis=0).A1
+    results = {}
+    for ii in range(num_clones):
+        if len(nbrs[ii])==0:
+            continue
+        nbrhood_mask = np.full( (num_clones,), False)
+        nbrhood_mask[ nbrs[ii] ] = True
+        nbrhood_mask[ ii ] = True
+        mean_fg, var_fg, mean_bg, var_bg = correlations._get_split_mean_var(
+            X, X_sq, nbrhood_mask, mean, mean_sq)
+        num_fg = np.sum(nbrhood_mask)
+        if num_fg < min_num_fg:
+            continue
+        scores, pvals = stats.ttest_ind_from_stats(
+            mean1=mean_fg, std1=np.sqrt(np.maximum(var_fg, 1e-12)),
+            nobs1=num_fg,
+            mean2=mean_bg, std2=np.sqrt(np.maximum(var_bg, 1e-12)),
+            nobs2=num_clones-num_fg, equal_var=False)
+        scores[np.isnan(scores)] = 0.
+        pvals[np.isnan(pvals)] = 1.
+        partition = np.argpartition(scores, -top_n)[-top_n:]
+        results[ii] = (partition, pvals[partition])
+    return results
+
+
+def nbrhood_ttests(X, nbrs, top_n, min_num_fg=3):
+    ''' Same as nbrhood_ttests_legacy, using the blocked calculation
+    from correlations.tcr_nbrhood_rank_genes_fast
+    '''
+    num_clones = X.shape[0]
+    X_sq = X.multiply(X)
+    mean, mean_sq = X.mean(axis=0).A1, X_sq.mean(axis=0).A1
+    A = correlations._make_nbrhood_matrix(nbrs)
+    all_num_fg = np.diff(A.indptr)
+    test_clones = np.nonzero(all_num_fg >= max(1, min_num_fg))[0]
+    block_size = correlations._get_nbrhood_block_size(X.shape[1])
+    results = {}
+    for b_start in range(0, len(test_clones), block_size):
+        block_clones = test_clones[b_start:b_start+block_size]
+        num_fg = all_num_fg[block_clones][:,None]
+        mean_fg, var_fg, mean_bg, var_bg = \
+            correlations._get_nbrhood_split_mean_var(
+                A[block_clones], X, X_sq, mean, mean_sq)
+        std_fg = np.sqrt(np.maximum(var_fg, 1e-12))
+        std_bg = np.sqrt(np.maximum(var_bg, 1e-12))
+        scores = correlations._welch_ttest_scores(
+            mean_fg, std_fg, num_fg, mean_bg, std_bg, num_clones-num_fg)
+        scores[np.isnan(scores)] = 0.
+        partition = np.argpartition(scores, -top_n, axis=1)[:,-top_n:]
+        def top(M):
+            return np.take_along_axis(M, partition, axis=1)
+        _, pvals = stats.ttest_ind_from_stats(
+            mean1=top(mean_fg), std1=top(std_fg), nobs1=num_fg,
+            mean2=top(mean_bg), std2=top(std_bg), nobs2=num_clones-num_fg,
+            equal_var=False)
+        pvals[np.isnan(pvals)] = 1.
+        for ib, ii in enumerate(block_clones):
+            results[ii] = (partition[ib], pvals[ib])
+    return results
+
+
+def benchmark_nbrhood_ttests(adata, nbr_frac, num_genes, top_n=50):
+    num_clones = adata.shape[0]
+    num_nbrs = max(1, int(nbr_frac*num_clones))
+    _, nbrs_tcr = make_synthetic_nbrs(num_clones, num_nbrs, seed=args.seed)
+    rng = np.random.default_rng(args.seed)
+    # roughly 10% nonzero, like a typical filtered scRNA-seq matrix
+    X = sps.random(num_clones, num_genes, density=0.1, format='csr',
+                   random_state=rng, data_rvs=lambda n: rng.poisson(2., n)+1.)
+    X.data = np.log1p(X.data)
+
+    start = time.time()
+    old_results = nbrhood_ttests_legacy(X, nbrs_tcr, top_n)
+    old_time = time.time() - start
+    start = time.time()
+    new_results = nbrhood_ttests(X, nbrs_tcr, top_n)
+    new_time = time.time() - start
+
+    # same top_n genes, and the same pvals for them. Compare log pvals,
+    #  since the tiny ones are the ones we care about
+    assert sorted(old_results.keys()) == sorted(new_results.keys())
+    num_mismatched, max_log10_diff = 0, 0.
+    for ii, (old_inds, old_pvals) in old_results.items():
+        new_inds, new_pvals = new_results[ii]
+        if set(old_inds) != set(new_inds): # could be ties at the cutoff
+            num_mismatched += 1
+            continue
+        old_pvals = old_pvals[np.argsort(old_inds)]
+        new_pvals = new_pvals[np.argsort(new_inds)]
+        max_log10_diff = max(max_log10_diff, np.max(np.abs(
+            np.log10(np.maximum(old_pvals, 1e-300)) -
+            np.log10(np.maximum(new_pvals, 1e-300)))))
+    print(f'benchmark nbrhood_ttests: num_clones= {num_clones}',
+          f'num_nbrs= {num_nbrs} num_genes= {num_genes} top_n= {top_n}',
+          f'mismatched_top_n= {num_mismatched}',
+          f'max_log10_pval_diff= {max_log10_diff:.2e}')
+    assert max_log10_diff < 1e-6
+    print(f'benchmark nbrhood_ttests: old_time= {old_time:.2f}',
+          f'new_time= {new_time:.2f} speedup= {old_time/new_time:.2f}')
+
+
+def benchmark_mwu(adata, nbr_frac, num_genes, num_tests=2000):
+    num_clones = adata.shape[0]
+    num_nbrs = max(1, int(nbr_frac*num_clones))
+    _, nbrs_tcr = make_synthetic_nbrs(num_clones, num_nbrs, seed=args.seed)
+    rng = np.random.default_rng(args.seed)
+    X = sps.random(num_clones, num_genes, density=0.1, format='csr',
+                   random_state=rng, data_rvs=lambda n: rng.poisson(2., n)+1.)
+    X.data = np.log1p(X.data)
+    X_csc = X.tocsc()
+    # hits tend to reuse the same genes, so draw them from a smaller pool
+    tests = [(rng.integers(num_clones), rng.integers(num_genes//10))
+             for _ in range(num_tests)]
+
+    start = time.time()
+    old_pvals = []
+    for ii, ind in tests:
+        nbrhood_mask = np.full( (num_clones,), False)
+        nbrhood_mask[ nbrs_tcr[ii] ] = True
+        nbrhood_mask[ ii ] = True
+        col = X_csc[:,ind][nbrhood_mask]
+        noncol = X_csc[:,ind][~nbrhood_mask]
+        old_pvals.append(stats.mannwhitneyu(
+            col.toarray()[:,0], noncol.toarray()[:,0], alternative='greater',
+            method='asymptotic')[1])
+    old_time = time.time() - start
+
+    start = time.time()
+    mwu_ranks = correlations._MannWhitneyRanks(X)
+    new_pvals = []
+    for ii, ind in tests:
+        nbrhood_indices = np.unique(np.append(nbrs_tcr[ii], ii))
+        nbrhood_X = X[nbrhood_indices]
+        col_data = nbrhood_X.data[nbrhood_X.indices == ind]
+        new_pvals.append(mwu_ranks.pvalue(ind, col_data, len(nbrhood_indices),
+                                          alternative='greater'))
+    new_time = time.time() - start
+
+    max_rel_diff = np.max(np.abs(np.array(old_pvals)-np.array(new_pvals)) /
+                          np.maximum(old_pvals, 1e-300))
+    print(f'benchmark mwu: num_clones= {num_clones} num_nbrs= {num_nbrs}',
+          f'num_tests= {num_tests} max_rel_pval_diff= {max_rel_diff:.2e}')
+    assert max_rel_diff < 1e-9
+    print(f'benchmark mwu: old_time= {old_time:.2f} new_time= {new_time:.2f}',
+          f'speedup= {old_time/new_time:.2f}')
+
+
+def hotspot_zscores_legacy(X, nbrs):
+    ''' The old per-clone loops in correlations.find_hotspot_features
+    returns the zscores for all the features, before the pvalue filtering
+    '''
+    num_clones, num_features = X.shape
+    X_mean = X.mean(axis=0).A1
+    X_var = X.multiply(X).mean(axis=0).A1 - X_mean**2
+    H = sps.csr_matrix( np.zeros((num_features,)) )
+    indegrees = np.zeros((num_clones,))
+    for ii in range(num_clones):
+        X_ii = X[ii,:]
+        ii_nbrs = nbrs[ii]
+        if len(ii_nbrs)==0:
+            continue
+        indegrees[ii_nbrs] += 1
+        H += X_ii.multiply( X[ii_nbrs,:].sum(axis=0) )
+    indegrees_mat = sps.csr_matrix( indegrees[:, np.newaxis] )
+    X_mean_mat = sps.csr_matrix( X_mean )
+    Y = X.multiply( indegrees_mat ).multiply( X_mean_mat ).sum(axis=0)
+    H = (H-Y).A1
+    H /= np.maximum(1e-9, X_var)
+    H[X_var==0] = 0
+    nbrs_sets = [frozenset(x) for x in nbrs]
+    H_var = 0
+    for ii in range(num_clones):
+        for jj in nbrs[ii]:
+            H_var += 2 if ii in nbrs_sets[jj] else 1
+    return H / np.sqrt(H_var)
+
+
+def benchmark_hotspot(adata, nbr_frac, num_genes):
+    num_clones = adata.shape[0]
+    num_nbrs = max(1, int(nbr_frac*num_clones))
+    _, nbrs_tcr = make_synthetic_nbrs(num_clones, num_nbrs, seed=args.seed)
+    rng = np.random.default_rng(args.seed)
+    X = sps.random(num_clones, num_genes, density=0.1, format='csr',
+                   random_state=rng, data_rvs=lambda n: rng.poisson(2., n)+1.)
+    X.data = np.log1p(X.data)
+    features = [f'gene{x}' for x in range(num_genes)]
+
+    start = time.time()
+    old_Z = hotspot_zscores_legacy(X, nbrs_tcr)
+    old_time = time.time() - start
+    start = time.time()
+    df = correlations.find_hotspot_features(
+        X, nbrs_tcr, features, pval_threshold=np.inf)
+    new_time = time.time() - start
+
+    assert df.shape[0] == num_genes
+    new_Z = np.array(df.set_index('feature').Z[features])
+    max_Z_diff = np.max(np.abs(old_Z - new_Z))
+    print(f'benchmark hotspot: num_clones= {num_clones} num_nbrs= {num_nbrs}',
+          f'num_genes= {num_genes} max_Z_diff= {max_Z_diff:.2e}')
+    assert max_Z_diff < 1e-6
+    print(f'benchmark hotspot: old_time= {old_time:.2f}',
+          f'new_time= {new_time:.2f} speedup= {old_time/new_time:.2f}')
+
+
+def benchmark_tcr_score_table(adata):
+    from conga import tcr_scoring
+    _, count_rep_columns = tcr_scoring._get_tcr_gene_columns(args.organism)
+    features = tcr_scoring.all_tcr_scorenames + sorted(count_rep_columns)
+    times = []
+    for repeat in range(3):
+        start = time.time()
+        table = tcr_scoring.make_tcr_score_table(adata, features)
+        times.append(time.time() - start)
+    assert table.shape == (adata.shape[0], len(features))
+    print(f'benchmark tcr_score_table: num_clones= {adata.shape[0]}',
+          f'num_features= {len(features)} first_time= {times[0]:.2f}',
+          'later_times=', ' '.join(f'{x:.3f}' for x in times[1:]))
+
+
+def benchmark_clumping_background(num_clones, organism, seed):
+    import tempfile
+    from conga import tcr_clumping
+    tcrs = make_synthetic_rearranged_tcrs(num_clones, organism, seed=seed)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        times, results = [], []
+        for max_dist in [96, 96, 48]:
+            start = time.time()
+            counts = tcr_clumping.estimate_background_tcrdist_distributions(
+                organism, tcrs, max_dist, seed=seed,
+                background_cache_dir=cache_dir)
+            times.append(time.time() - start)
+            results.append(counts)
+        num_cachefiles = len(os.listdir(cache_dir))
+    assert num_cachefiles == 1
+    assert np.array_equal(results[0], results[1])
+    assert np.array_equal(results[0][:,:49], results[2])
+    print(f'benchmark clumping_background: num_clones= {num_clones}',
+          f'compute_time= {times[0]:.2f} cached_time= {times[1]:.3f}',
+          f'cached_smaller_max_dist_time= {times[2]:.3f}')
+
+
+def benchmark_tcr_clumping(num_clones, organism, seed):
+    import tempfile
+    from conga import tcr_clumping, util
+    tcrs = make_synthetic_rearranged_tcrs(
+        num_clones, organism, clump_fraction=0.2, seed=seed)
+    run_command = util.run_command
+    command_time = [0.]
+    def timed_run_command(*args, **kwargs):
+        start = time.time()
+        run_command(*args, **kwargs)
+        command_time[0] += time.time() - start
+    with tempfile.TemporaryDirectory() as tmpdir:
+        kwargs = dict(tmpfile_prefix=tmpdir+'/tmp', verbose=False, seed=seed,
+                      background_cache_dir=tmpdir)
+        tcr_clumping.estimate_background_tcrdist_distributions(
+            organism, tcrs, 96, tcrs_for_background_generation=tcrs,
+            seed=seed, background_cache_dir=tmpdir)
+        util.run_command = timed_run_command
+        try:
+            start = time.time()
+            results = tcr_clumping.find_tcr_clumping(tcrs, organism, **kwargs)
+            total_time = time.time() - start
+        finally:
+            util.run_command = run_command
+    num_groups = results.clumping_group.max() if results.shape[0] else 0
+    print(f'benchmark tcr_clumping: num_clones= {num_clones}',
+          f'num_hits= {results.shape[0]} num_clumping_groups= {num_groups}',
+          f'total_time= {total_time:.2f}',
+          f'python_time= {total_time-command_time[0]:.2f}')
+
+
+def resample_shuffled_tcr_chains_legacy(
+        organism, num_samples, chain, junctions_df, seed):
+    ''' The old one-at-a-time loop in tcr_sampler.resample_shuffled_tcr_chains,
+    without the preserve_vj_pairings option. Returns (new_tcrs, success_rate)
+    '''
+    import random
+    from conga.tcrdist import tcr_sampler, translation
+    rng = random.Random(seed)
+    junctions = []
+    for l in junctions_df.itertuples():
+        breakpoints_pre_d, breakpoints_post_d = set(), set()
+        nucseq_src = l.cdr3a_nucseq_src if chain == 'A' else l.cdr3b_nucseq_src
+        post_d = False
+        for ii in range(1,len(nucseq_src)):
+            a,b = nucseq_src[ii-1], nucseq_src[ii]
+            if a=='D':
+                post_d = True
+            if a!=b or a=='N':
+                for bp in [ii, ii-len(nucseq_src)]:
+                    if post_d:
+                        breakpoints_post_d.add(bp)
+                    else:
+                        breakpoints_pre_d.add(bp)
+        if chain=='A':
+            junctions.append( (l.va, l.ja, l.cdr3a_nucseq,
+                               breakpoints_pre_d, breakpoints_post_d))
+        else:
+            junctions.append( (l.vb, l.jb, l.cdr3b_nucseq,
+                               breakpoints_pre_d, breakpoints_post_d))
+
+    new_tcrs = []
+    attempts = 0
+    while len(new_tcrs) < num_samples:
+        t1 = rng.choice(junctions)
+        t2 = rng.choice(junctions)
+        nucseq1, nucseq2 = t1[2], t2[2]
+        if nucseq1 == nucseq2:
+            continue
+        if not tcr_sampler.vj_compatible(t1[0], t2[1], organism):
+            continue
+        inds = [3] if chain=='A' else [3,4]
+        rng.shuffle(inds)
+        attempts += 1
+        for ind in inds:
+            shared = t1[ind] & t2[ind]
+            if shared:
+                bp = rng.choice(list(shared))
+                nucseq = nucseq1[: bp] + nucseq2[bp :]
+                cdr3 = translation.get_translation(nucseq)
+                if '*' not in cdr3:
+                    new_tcrs.append(( t1[0], t2[1], cdr3, nucseq))
+                    break
+    return new_tcrs, len(new_tcrs)/attempts
+
+
+def benchmark_shuffled_chains(num_clones, organism, seed, n_jobs,
+                              num_samples=50000):
+    import io
+    import contextlib
+    from collections import Counter
+    from conga.tcrdist import tcr_sampler
+    tcrs = make_synthetic_rearranged_tcrs(num_clones, organism, seed=seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        junctions_df = tcr_sampler.parse_tcr_junctions(organism, tcrs)
+
+    def total_variation(a, b):
+        a, b = Counter(a), Counter(b)
+        na, nb = sum(a.values()), sum(b.values())
+        return 0.5*sum(abs(a[x]/na - b[x]/nb) for x in set(a)|set(b))
+
+    for chain in 'AB':
+        start = time.time()
+        old_tcrs, old_rate = resample_shuffled_tcr_chains_legacy(
+            organism, num_samples, chain, junctions_df, seed)
+        old_time = time.time() - start
+        # a second old run, for the sampling noise in the total variations
+        old_tcrs2, _ = resample_shuffled_tcr_chains_legacy(
+            organism, num_samples, chain, junctions_df, seed+1)
+
+        start = time.time()
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            new_tcrs = tcr_sampler.resample_shuffled_tcr_chains(
+                organism, num_samples, chain, junctions_df, seed=seed,
+                n_jobs=n_jobs)
+        new_time = time.time() - start
+        new_rate = float(stdout.getvalue().split()[-1])/100
+        assert len(new_tcrs) == num_samples
+
+        # v, j, nucseq length, and the full (v, j, cdr3) samples
+        features = [lambda x:x[0], lambda x:x[1], lambda x:len(x[3]),
+                    lambda x:x[:3]]
+        tvs = [total_variation([f(x) for x in old_tcrs],
+                               [f(x) for x in new_tcrs]) for f in features]
+        old_tvs = [total_variation([f(x) for x in old_tcrs],
+                                   [f(x) for x in old_tcrs2]) for f in features]
+        print(f'benchmark shuffled_chains: chain= {chain}',
+              f'num_samples= {num_samples} n_jobs= {n_jobs}',
+              f'old_time= {old_time:.2f} new_time= {new_time:.2f}',
+              f'old_success_rate= {old_rate:.3f}',
+              f'new_success_rate= {new_rate:.3f}')
+        print(f'benchmark shuffled_chains: chain= {chain}',
+              'total_variation_v_j_len_full old_vs_new=',
+              ' '.join(f'{x:.4f}' for x in tvs), 'old_vs_old=',
+              ' '.join(f'{x:.4f}' for x in old_tvs))
+
+
+def parse_tcr_junctions_legacy(organism, tcrs):
+    ''' The old per-tcr loop in tcr_sampler.parse_tcr_junctions, returns the
+    analyze_junction results for each chain
+    '''
+    from conga.tcrdist import tcr_sampler
+    return [[tcr_sampler.analyze_junction(
+        organism, v, j, cdr3, cdr3_nucseq, return_cdr3_nucseq_src=True)
+             for v, j, cdr3, cdr3_nucseq in tcr] for tcr in tcrs]
+
+
+def benchmark_junctions(num_clones, organism, seed, n_jobs):
+    import io
+    import contextlib
+    from conga.tcrdist import tcr_sampler
+    tcrs = make_synthetic_rearranged_tcrs(
+        num_clones, organism, clump_fraction=0.3, seed=seed)
+
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        tcrs = tcr_sampler.find_alternate_alleles_for_tcrs(organism, tcrs)
+    allele_time = time.time() - start
+
+    start = time.time()
+    old_results = parse_tcr_junctions_legacy(organism, tcrs)
+    old_time = time.time() - start
+
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        junctions_df = tcr_sampler.parse_tcr_junctions(
+            organism, tcrs, n_jobs=n_jobs)
+    new_time = time.time() - start
+
+    for ab, ind in [('a',0), ('b',1)]:
+        assert list(junctions_df[f'cdr3{ab}_nucseq_src']) == [
+            ''.join(x[ind][5]) for x in old_results]
+        assert list(junctions_df[f'cdr3{ab}_protseq_masked']) == [
+            x[ind][1] for x in old_results]
+    num_unique = len(set(x for tcr in tcrs for x in tcr))
+    print(f'benchmark junctions: num_clones= {num_clones}',
+          f'num_unique_chains= {num_unique} n_jobs= {n_jobs}',
+          f'find_alternate_alleles_time= {allele_time:.2f}',
+          f'old_parse_time= {old_time:.2f} new_parse_time= {new_time:.2f}')
+
+
+def find_paired_matches_cpp(query_tcrs_df, db_tcrs_df, max_dist, organism,
+                            tmpfile_prefix):
+    ''' The C++ all-vs-all matching in find_significant_tcrdist_matches
+    '''
+    from conga import util
+    query_tcrs_file = tmpfile_prefix+'_query_tcrs.tsv'
+    db_tcrs_file = tmpfile_prefix+'_db_tcrs.tsv'
+    outfile = tmpfile_prefix+'_matches.tsv'
+    cols = 'va cdr3a vb cdr3b'.split()
+    query_tcrs_df[cols].to_csv(query_tcrs_file, sep='\t', index=False)
+    db_tcrs_df[cols].to_csv(db_tcrs_file, sep='\t', index=False)
+    exe = os.path.join(util.path_to_tcrdist_cpp_bin, 'find_paired_matches')
+    db_filename = os.path.join(util.path_to_tcrdist_cpp_db,
+                               f'tcrdist_info_{organism}.txt')
+    subprocess.run([exe, '-i', query_tcrs_file, '-j', db_tcrs_file,
+                    '-t', str(max_dist), '-d', db_filename, '-o', outfile],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return pd.read_csv(outfile, sep='\t')
+
+
+def benchmark_tcr_db_index(num_clones, num_queries, organism, seed):
+    import io
+    import tempfile
+    import contextlib
+    from conga.tcr_clumping import build_tcr_db_index, TcrDbIndex
+    # queries are drawn along with the db tcrs, so some are near db tcrs
+    tcrs = make_synthetic_rearranged_tcrs(
+        num_clones+num_queries, organism, clump_fraction=0.2, seed=seed)
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame([dict(va=a[0], ja=a[1], cdr3a=a[2],
+                            vb=b[0], jb=b[1], cdr3b=b[2]) for a,b in tcrs])
+    query_mask = np.zeros((len(tcrs),), dtype=bool)
+    query_mask[rng.choice(len(tcrs), num_queries, replace=False)] = True
+    query_tcrs_df = df[query_mask].reset_index(drop=True)
+    db_tcrs_df = df[~query_mask].reset_index(drop=True)
+    db_tcrs_df['epitope'] = rng.choice(['A','B','C'], db_tcrs_df.shape[0])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_tsv = tmpdir+'/db_tcrs.tsv'
+        db_tcrs_df.to_csv(db_tsv, sep='\t', index=False)
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            index_file = build_tcr_db_index(db_tsv, organism)
+        build_time = time.time() - start
+
+        start = time.time()
+        db_index = TcrDbIndex(index_file)
+        load_time = time.time() - start
+        assert db_index.db_tcrs_df.equals(pd.read_csv(db_tsv, sep='\t'))
+
+        if organism == 'human':
+            # the bundled db has mixed-type columns, eg bools with missing values
+            real_db_tsv = os.path.join(
+                conga_dir, 'conga/data/new_paired_tcr_db_for_matching_nr.tsv')
+            with contextlib.redirect_stdout(io.StringIO()):
+                real_index_file = build_tcr_db_index(
+                    real_db_tsv, organism,
+                    index_file=tmpdir+'/real_db.tcrdist_index.npz')
+            assert TcrDbIndex(real_index_file).db_tcrs_df.equals(
+                pd.read_csv(real_db_tsv, sep='\t'))
+
+        for max_dist in [24, 48, 96]:
+            start = time.time()
+            new_df = db_index.find_matches(query_tcrs_df, max_dist)
+            new_time = time.time() - start
+
+            start = time.time()
+            old_df = find_paired_matches_cpp(
+                query_tcrs_df, db_tcrs_df, max_dist, organism, tmpdir+'/tmp')
+            old_time = time.time() - start
+
+            cols = 'tcrdist index1 index2 cdr3b1 cdr3b2'.split()
+            assert new_df[cols].equals(old_df[cols])
+            print(f'benchmark tcr_db_index: num_db_tcrs= {num_clones}',
+                  f'num_queries= {num_queries} max_dist= {max_dist}',
+                  f'num_matches= {new_df.shape[0]}',
+                  f'build_time= {build_time:.2f} load_time= {load_time:.2f}',
+                  f'cpp_time= {old_time:.2f} index_time= {new_time:.2f}')
+
+
+def strict_single_chain_matches_legacy(adata, db_tcrs_df):
+    ''' The old loop in strict_single_chain_match_adata_tcrs_to_db_tcrs
+    '''
+    matched_dfs = []
+    for chain in ['cdr3a', 'cdr3b']:
+        matched_df = db_tcrs_df[
+            db_tcrs_df[chain].isin(adata.obs[chain])].copy()
+        clones, gex_clusters, tcr_clusters = [], [], []
+        for (idx, row) in matched_df.iterrows():
+            mask = adata.obs[chain] == row.loc[chain]
+            clones.append(",".join(adata.obs.index[mask].to_list()))
+            gex_clusters.append(",".join(
+                adata.obs.clusters_gex[mask].astype(str).unique().tolist()))
+            tcr_clusters.append(",".join(
+                adata.obs.clusters_tcr[mask].astype(str).unique().tolist()))
+        if not matched_df.empty:
+            matched_df[f'{chain}_match_UMI'] = clones
+            matched_df[f'{chain}_match_gex_clusters'] = gex_clusters
+            matched_df[f'{chain}_match_tcr_clusters'] = tcr_clusters
+        matched_dfs.append(matched_df)
+    return matched_dfs
+
+
+def benchmark_single_chain_db_match(adata, num_db_tcrs, seed):
+    import io
+    import tempfile
+    import contextlib
+    from conga.tcr_clumping import strict_single_chain_match_adata_tcrs_to_db_tcrs
+    rng = np.random.default_rng(seed)
+    adata.obs['clusters_gex'] = rng.integers(0, 10, adata.shape[0])
+    adata.obs['clusters_tcr'] = rng.integers(0, 10, adata.shape[0])
+    cols = 'va ja cdr3a vb jb cdr3b'.split()
+    db_tcrs_df = adata.obs[cols].iloc[
+        rng.choice(adata.shape[0], num_db_tcrs)].reset_index(drop=True)
+    # the other half get random cdr3s
+    for ab in 'ab':
+        mask = rng.random(num_db_tcrs) < 0.5
+        db_tcrs_df.loc[mask, 'cdr3'+ab] = [
+            'CA' + ''.join(rng.choice(list(amino_acids), 10)) + 'F'
+            for _ in range(mask.sum())]
+
+    start = time.time()
+    old_dfs = strict_single_chain_matches_legacy(adata, db_tcrs_df)
+    old_time = time.time() - start
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_tcrs_df.to_csv(tmpdir+'/db_tcrs.tsv', sep='\t', index=False)
+        times = {}
+        for match_genes, max_cdr3_edits in [('', 0), ('v', 0), ('', 1)]:
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                new_dfs = strict_single_chain_match_adata_tcrs_to_db_tcrs(
+                    adata, db_tcrs_tsvfile=tmpdir+'/db_tcrs.tsv',
+                    match_genes=match_genes, max_cdr3_edits=max_cdr3_edits)
+            times[(match_genes, max_cdr3_edits)] = time.time() - start
+            if (match_genes, max_cdr3_edits) == ('', 0):
+                for old_df, new_df in zip(old_dfs, new_dfs):
+                    assert old_df.reset_index(drop=True).equals(
+                        new_df.reset_index(drop=True))
+            print(f'match_genes= {match_genes!r} max_cdr3_edits=',
+                  max_cdr3_edits, 'num_matched_db_rows=',
+                  ' '.join(str(x.shape[0]) for x in new_dfs))
+
+    print(f'benchmark single_chain_db_match: num_clones= {adata.shape[0]}',
+          f'num_db_tcrs= {num_db_tcrs} old_time= {old_time:.2f}',
+          f"new_time= {times[('', 0)]:.2f}",
+          f"v_gene_time= {times[('v', 0)]:.2f}",
+          f"edit_distance_1_time= {times[('', 1)]:.2f}")
+
+
+def clone_rep_cells_legacy(X_pca, clone_ids, num_clones):
+    ''' The old per-clone loop in reduce_to_single_cell_per_clone, returns
+    rep_cell_indices, gex_var
+    '''
+    from sklearn.metrics import pairwise_distances
+    rep_cell_indices, gex_var = [], []
+    for c in range(num_clones):
+        clone_cells = np.nonzero(clone_ids==c)[0]
+        if len(clone_cells) == 1:
+            rep_cell_indices.append(clone_cells[0])
+            gex_var.append(0.0)
+        else:
+            D = pairwise_distances(X_pca[clone_cells], X_pca[clone_cells])
+            rep_ind = np.argmin(D.sum(axis=1))
+            rep_cell_indices.append(clone_cells[rep_ind])
+            gex_var.append(np.sum(D[rep_ind,:]**2)/len(clone_cells))
+    return np.array(rep_cell_indices), np.array(gex_var)
+
+
+def make_synthetic_clone_cells(num_cells, num_genes, num_pcs, seed,
+                               big_clone_size=0):
+    ''' Returns an AnnData of num_cells cells with raw counts, tcrs, and
+    random 'X_pca' obsm. Clones sizes are geometric, except for one clone
+    of big_clone_size cells
+    '''
+    rng = np.random.default_rng(seed)
+    clone_sizes = rng.geometric(0.5, num_cells)
+    clone_ids = np.repeat(np.arange(num_cells), clone_sizes)[:num_cells]
+    clone_ids[:big_clone_size] = num_cells # a clone id that isnt used yet
+    clone_ids = rng.permutation(clone_ids)
+    clone_strs = pd.Series(clone_ids).astype(str)
+    obs = pd.DataFrame(dict(
+        va='TRAV1-1*01', ja='TRAJ10*01', cdr3a='CA'+clone_strs+'F',
+        cdr3a_nucseq='tgt'+clone_strs+'ttt',
+        vb='TRBV2*01', jb='TRBJ1-1*01', cdr3b='CAS'+clone_strs+'F',
+        cdr3b_nucseq='tgc'+clone_strs+'ttc',
+        batch=rng.integers(0, 4, num_cells)))
+    obs.index = 'cell_' + obs.index.astype(str)
+    X = sps.random(num_cells, num_genes, density=0.1, format='csr',
+                   random_state=seed, dtype=np.float32)
+    X.data = np.ceil(20*X.data)
+    X = X + sps.csr_matrix( # at least one count per cell
+        (np.ones(num_cells, dtype=np.float32),
+         (np.arange(num_cells), rng.integers(0, num_genes, num_cells))),
+        shape=X.shape)
+    adata = AnnData(X=X, obs=obs)
+    adata.var_names = [f'gene_{x}' for x in range(num_genes)]
+    adata.raw = adata
+    adata.uns['batch_keys'] = ['batch']
+    adata.obsm['X_pca'] = rng.standard_normal(
+        (num_cells, num_pcs)).astype(np.float32)
+    return adata
+
+
+def benchmark_reduce_clones(num_cells, num_genes, num_pcs, seed,
+                            num_legacy_cells=20000, big_clone_size=20000,
+                            legacy_big_clone_size=5000):
+    import io
+    import tracemalloc
+    import contextlib
+    big_clone_size = min(big_clone_size, num_cells//2)
+    adata = make_synthetic_clone_cells(num_cells, num_genes, num_pcs, seed,
+                                       big_clone_size=big_clone_size)
+
+    # old vs new representative cells on a smaller dataset
+    small_adata = make_synthetic_clone_cells(
+        num_legacy_cells, num_genes, num_pcs, seed,
+        big_clone_size=legacy_big_clone_size)
+    tcrs = preprocess.retrieve_tcrs_from_adata(small_adata)
+    tcr2clone_id = {y:x for x,y in enumerate(sorted(set(tcrs)))}
+    clone_ids = np.array([tcr2clone_id[x] for x in tcrs])
+    X_pca = small_adata.obsm['X_pca']
+
+    start = time.time()
+    old_reps, old_gex_var = clone_rep_cells_legacy(
+        X_pca, clone_ids, len(tcr2clone_id))
+    old_time = time.time() - start
+
+    start = time.time()
+    new_reps, new_gex_var = preprocess._find_clone_rep_cells(
+        X_pca, clone_ids, np.bincount(clone_ids))
+    new_time = time.time() - start
+    assert np.array_equal(old_reps, new_reps)
+    assert np.allclose(old_gex_var, new_gex_var, rtol=1e-4, atol=1e-4)
+
+    # peak memory for the big clone on its own
+    big_cells = np.nonzero(
+        np.array(adata.obs.cdr3b == f'CAS{num_cells}F'))[0]
+    tracemalloc.start()
+    start = time.time()
+    preprocess._find_clone_rep_cells(
+        adata.obsm['X_pca'][big_cells], np.zeros(len(big_cells), dtype=int),
+        np.array([len(big_cells)]))
+    big_clone_time = time.time() - start
+    big_clone_peak_gb = tracemalloc.get_traced_memory()[1]/1e9
+    tracemalloc.stop()
+
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        new_adata = preprocess.reduce_to_single_cell_per_clone(
+            adata, average_clone_gex=True, use_existing_pca_obsm_tag='X_pca')
+    total_time = time.time() - start
+    assert new_adata.obs.clone_sizes.sum() == num_cells
+
+    print(f'benchmark reduce_clones: num_legacy_cells= {num_legacy_cells}',
+          f'num_legacy_clones= {len(tcr2clone_id)}',
+          f'old_rep_cells_time= {old_time:.2f}',
+          f'new_rep_cells_time= {new_time:.2f}',
+          f'legacy_big_clone_size= {legacy_big_clone_size}')
+    print(f'benchmark reduce_clones: big_clone_size= {len(big_cells)}',
+          f'big_clone_rep_cell_time= {big_clone_time:.2f}',
+          f'big_clone_peak_gb= {big_clone_peak_gb:.3f}')
+    print(f'benchmark reduce_clones: num_cells= {num_cells}',
+          f'num_clones= {new_adata.shape[0]} num_genes= {num_genes}',
+          f'reduce_to_single_cell_per_clone_time= {total_time:.2f}')
+
+
+def fdr_values_for_db_matches_legacy(raw_pvalues, num_comparisons):
+    ''' The old padded-array BH calculation in
+    find_significant_tcrdist_matches
+    '''
+    from statsmodels.stats.multitest import multipletests
+    num_matches = len(raw_pvalues)
+    raw_pvalues_argsort = np.argsort(raw_pvalues)
+    raw_pvalues_sorted = np.concatenate(
+        [np.sort(raw_pvalues), np.full((num_comparisons - num_matches,), 1.0)])
+    _, fdr_values_sorted, _, _ = multipletests(
+        raw_pvalues_sorted, alpha=0.05, is_sorted=True, method='fdr_bh')
+    return fdr_values_sorted[np.argsort(raw_pvalues_argsort)]
+
+
+def benchmark_db_match_fdr(num_clones, num_hits, seed, num_db_tcrs=50000):
+    from conga.tcr_clumping import _fdr_bh_with_implicit_ones
+    rng = np.random.default_rng(seed)
+    num_comparisons = num_clones * num_db_tcrs
+    raw_pvalues = rng.random(num_hits)**4 / num_db_tcrs
+
+    start = time.time()
+    old_fdr_values = fdr_values_for_db_matches_legacy(
+        raw_pvalues, num_comparisons)
+    old_time = time.time() - start
+
+    start = time.time()
+    new_fdr_values = _fdr_bh_with_implicit_ones(raw_pvalues, num_comparisons)
+    new_time = time.time() - start
+
+    assert np.array_equal(old_fdr_values, new_fdr_values)
+    print(f'benchmark db_match_fdr: num_comparisons= {num_comparisons}',
+          f'num_hits= {num_hits} old_time= {old_time:.2f}',
+          f'new_time= {new_time:.4f}',
+          f'old_array_gb= {8*num_comparisons/1e9:.1f}')
+
+    # no hits at all
+    assert np.array_equal(
+        fdr_values_for_db_matches_legacy(np.zeros((0,)), num_comparisons),
+        _fdr_bh_with_implicit_ones(np.zeros((0,)), num_comparisons))
+    benchmark_db_match_no_hits(seed)
+
+
+def benchmark_db_match_no_hits(seed, organism='human'):
+    ''' find_significant_tcrdist_matches with 3 query and 3 db tcrs and a
+    tiny adjusted_pvalue_threshold should return an empty DataFrame
+    '''
+    import io
+    import tempfile
+    import contextlib
+    from conga import tcr_clumping
+    tcrs = make_synthetic_rearranged_tcrs(200, organism, seed=seed)
+    tcrs_df = pd.DataFrame(
+        [dict(va=x[0], ja=x[1], cdr3a=x[2], cdr3a_nucseq=x[3],
+              vb=y[0], jb=y[1], cdr3b=y[2], cdr3b_nucseq=y[3])
+         for x,y in tcrs])
+    query_tcrs_df, db_tcrs_df = tcrs_df.iloc[:3].copy(), tcrs_df.iloc[3:6].copy()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_tsv = os.path.join(tmpdir, 'db_tcrs.tsv')
+        db_tcrs_df.to_csv(db_tsv, sep='\t', index=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            db_index = tcr_clumping.TcrDbIndex(
+                tcr_clumping.build_tcr_db_index(db_tsv, organism))
+        for index in [None, db_index]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = tcr_clumping.find_significant_tcrdist_matches(
+                    query_tcrs_df, db_tcrs_df.reset_index(drop=True), organism,
+                    tmpfile_prefix=os.path.join(tmpdir, 'tmp'),
+                    adjusted_pvalue_threshold=1e-20,
+                    background_tcrs_df=tcrs_df,
+                    num_random_samples_for_bg_freqs=5000, db_index=index)
+            assert results.empty
+    print('benchmark db_match_fdr: zero-hit find_significant_tcrdist_matches',
+          'OK for the C++ matcher and TcrDbIndex')
+
+
+def write_synthetic_clones_files(adata, outdir, seed, num_genes=10):
+    ''' Writes a clones file, a kpca file, a barcode mapping file, and a
+    gex h5ad file for the clones in adata, like setup_10x_for_conga.py would.
+    Returns clones_file, gex_file
+    '''
+    rng = np.random.default_rng(seed)
+    tcrs = preprocess.retrieve_tcrs_from_adata(adata)
+    num_clones = len(tcrs)
+    clone_ids = [f'clone_{x}' for x in range(num_clones)]
+    clones_file = os.path.join(outdir, 'synthetic_clones.tsv')
+    clones_df = pd.DataFrame(dict(
+        clone_id=clone_ids,
+        va_gene=[x[0][0] for x in tcrs], ja_gene=[x[0][1] for x in tcrs],
+        cdr3a=[x[0][2] for x in tcrs], cdr3a_nucseq=[x[0][3] for x in tcrs],
+        vb_gene=[x[1][0] for x in tcrs], jb_gene=[x[1][1] for x in tcrs],
+        cdr3b=[x[1][2] for x in tcrs], cdr3b_nucseq=[x[1][3] for x in tcrs],
+        clone_size=rng.integers(1, 4, num_clones),
+        # columns that pd.read_csv reads as object columns with missing values
+        is_second_alpha_chain=rng.choice([True, False, np.nan], num_clones),
+        subject=rng.choice(['donor1', 'donor2', '', '3'], num_clones)))
+    clones_df.to_csv(clones_file, sep='\t', index=False)
+
+    xy = adata.obsm['X_pca_tcr']
+    with open(clones_file[:-4]+'_AB.dist_50_kpcs', 'w') as out:
+        for ii in range(num_clones):
+            out.write('pc_comps: {} {}\n'.format(
+                clone_ids[ii], ' '.join('{:.6f}'.format(x) for x in xy[ii])))
+
+    barcodes = []
+    with open(clones_file+'.barcode_mapping.tsv', 'w') as out:
+        out.write('clone_id\tbarcodes\n')
+        for clone_id, size in zip(clone_ids, clones_df.clone_size):
+            bcs = [f'{clone_id}_bc{x}' for x in range(size)]
+            out.write(f'{clone_id}\t{",".join(bcs)}\n')
+            barcodes.extend(bcs)
+
+    # some cells without tcrs, in random order
+    barcodes.extend(f'no_tcr_{x}' for x in range(len(barcodes)//10))
+    barcodes = list(rng.permutation(barcodes))
+    X = sps.random(len(barcodes), num_genes, density=0.1, format='csr',
+                   random_state=seed, dtype=np.float32)
+    gex_adata = AnnData(X=X, obs=pd.DataFrame(index=barcodes))
+    gex_adata.var_names = [f'gene_{x}' for x in range(num_genes)]
+    gex_file = os.path.join(outdir, 'synthetic_gex.h5ad')
+    gex_adata.write_h5ad(gex_file)
+    return clones_file, gex_file
+
+
+def benchmark_conga_bundle(adata, seed):
+    import io
+    import tempfile
+    import contextlib
+    with tempfile.TemporaryDirectory() as outdir:
+        clones_file, gex_file = write_synthetic_clones_files(adata, outdir, seed)
+
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            # passing the kpca_file explicitly means the text files get used
+            old_adata = preprocess.read_dataset(
+                gex_file, 'h5ad', clones_file,
+                kpca_file=clones_file[:-4]+'_AB.dist_50_kpcs')
+        old_time = time.time() - start
+
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            bundle_dir = preprocess.make_conga_bundle(clones_file)
+        convert_time = time.time() - start
+        clones_df = pd.read_csv(clones_file, sep='\t')
+        assert preprocess.read_conga_bundle(bundle_dir)[0].equals(clones_df)
+
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            new_adata = preprocess.read_dataset(gex_file, 'h5ad', clones_file)
+        new_time = time.time() - start
+
+    assert np.array_equal(old_adata.obs_names, new_adata.obs_names)
+    assert np.array_equal(old_adata.obsm['X_pca_tcr'],
+                          new_adata.obsm['X_pca_tcr'])
+    for tag in preprocess.tcr_keys:
+        assert np.array_equal(old_adata.obs[tag], new_adata.obs[tag]), tag
+    print(f'benchmark conga_bundle: num_clones= {adata.shape[0]}',
+          f'num_cells_w_tcr= {new_adata.shape[0]}',
+          f'text_files_read_time= {old_time:.2f}',
+          f'make_conga_bundle_time= {convert_time:.2f}',
+          f'bundle_read_time= {new_time:.2f}')
+
+
+if args.mode == 'kpca_memory' and not args.kpca_worker:
+    benchmark_kpca_memory() # each run in its own process, for peak RSS
+    sys.exit()
+
+if args.mode == 'tcr_db_index': # doesn't need the synthetic adata
+    benchmark_tcr_db_index(
+        args.num_clones, args.num_queries, args.organism, args.seed)
+    sys.exit()
+
+if args.mode == 'reduce_clones': # doesn't need the synthetic adata
+    benchmark_reduce_clones(
+        args.num_clones, args.num_genes, args.num_pcs, args.seed)
+    sys.exit()
+
+if args.mode == 'db_match_fdr':
+    benchmark_db_match_fdr(args.num_clones, args.num_queries, args.seed)
+    sys.exit()
+
+adata = make_synthetic_adata(
+    args.num_clones, args.organism, num_pcs=args.num_pcs, seed=args.seed)
+agroups, bgroups = preprocess.setup_tcr_groups(adata)
+print('synthetic dataset: num_clones=', adata.shape[0],
+      'num_agroups=', np.max(agroups)+1, 'num_bgroups=', np.max(bgroups)+1)
+
+if args.mode == 'nbrs':
+    benchmark_nbrs(adata, args.nbr_fracs)
+elif args.mode == 'nbr_engines':
+    benchmark_nbr_engines(adata, args.nbr_fracs)
+elif args.mode == 'kpca_memory':
+    run_kpca_worker(adata, compact_tcrdists=not args.float_tcrdists)
+elif args.mode == 'tcrdist_python':
+    benchmark_tcrdist_python(adata)
+elif args.mode == 'kpca_solvers':
+    benchmark_kpca_solvers(adata, args.num_landmarks)
+elif args.mode == 'nbr_nbr_overlaps':
+    benchmark_nbr_nbr_overlaps(adata, args.nbr_fracs[0])
+elif args.mode == 'graph_overlap_stats':
+    benchmark_graph_overlap_stats(adata, args.nbr_fracs[0])
+elif args.mode == 'nbrhood_ttests':
+    benchmark_nbrhood_ttests(adata, args.nbr_fracs[0], args.num_genes)
+elif args.mode == 'mwu':
+    benchmark_mwu(adata, args.nbr_fracs[0], args.num_genes)
+elif args.mode == 'hotspot':
+    benchmark_hotspot(adata, args.nbr_fracs[0], args.num_genes)
+elif args.mode == 'tcr_score_table':
+    benchmark_tcr_score_table(adata)
+elif args.mode == 'clumping_background':
+    benchmark_clumping_background(args.num_clones, args.organism, args.seed)
+elif args.mode == 'tcr_clumping':
+    benchmark_tcr_clumping(args.num_clones, args.organism, args.seed)
+elif args.mode == 'junctions':
+    benchmark_junctions(args.num_clones, args.organism, args.seed, args.n_jobs)
+elif args.mode == 'single_chain_db_match':
+    benchmark_single_chain_db_match(adata, args.num_queries, args.seed)
+elif args.mode == 'conga_bundle':
+    benchmark_conga_bundle(adata, args.seed)
+elif args.mode == 'shuffled_chains':
+    benchmark_shuffled_chains(
+        args.num_clones, args.organism, args.seed, args.n_jobs)
@@ -73,6 +73,17 @@ parser.add_argument('--nbr_fracs', type=float, nargs='*', default=[0.01,0.1],
 parser.add_argument('--outfile_prefix',
                     help='string that will be prepended to all output files'
                     ' and images')
+parser.add_argument('--nbr_engine', default='exact',
+                    choices=['exact', 'kdtree', 'nndescent'],
+                    help='Method for finding the GEX and TCR K nearest'
+                    ' neighbors. "exact" (the default) computes all pairwise'
+                    ' distances; "kdtree" and "nndescent" (approximate) avoid'
+                    ' that and scale better to very large datasets')
+parser.add_argument('--n_jobs', type=int, default=1,
+                    help='Number of processes to use for the steps that'
+                    ' support parallel execution (currently the'
+                    ' --graph_vs_graph_stats shuffling, the --tcr_clumping'
+                    ' background resampling and the junction parsing)')
 
 
 # the main modes of operation
@@ -90,6 +101,10 @@ parser.add_argument('--tcr_database_tsvfile',
                     help='Must have columns va cdr3a vb cdr3b, minimally;'
                     ' with imgt-recognized allele names; default is'
                     ' conga/data/new_paired_tcr_db_for_matching_nr.tsv')
+parser.add_argument('--tcr_database_indexfile',
+                    help='Index file for the paired tcr database, made by'
+                    ' conga.tcr_clumping.build_tcr_db_index; used instead of'
+                    ' --tcr_database_tsvfile, much faster for big databases')
 parser.add_argument('--tcr_clumping', action='store_true')
 parser.add_argument('--find_hotspot_features', action='store_true')
 
@@ -144,6 +159,16 @@ parser.add_argument('--make_hotspot_raw_feature_plots', action='store_true',
                     ' values')
 parser.add_argument('--analyze_junctions', action='store_true')
 parser.add_argument('--radii_for_tcr_clumping', type=int, nargs='*')
+parser.add_argument('--tcr_clumping_cache_dir',
+                    help='Directory for saving and reusing the tcr clumping'
+                    ' background tcrdist counts, which are the slow part of'
+                    ' --tcr_clumping. Reruns on the same clonotypes (eg with'
+                    ' --restart or different --radii_for_tcr_clumping) can'
+                    ' reuse them')
+parser.add_argument('--tcr_clumping_seed', type=int,
+                    help='Random seed for the tcr clumping background'
+                    ' resampling. Defaults to 1 if --tcr_clumping_cache_dir'
+                    ' is given, otherwise unseeded')
 parser.add_argument('--qc_plots', action='store_true')
 parser.add_argument('--max_clones_for_clustermaps', type=int, default=20000,
                     help='Currently the clustermapping code computes the full'
@@ -226,6 +251,15 @@ parser.add_argument('--kpca_gaussian_kernel_sdev', default=100.0, type=float,
                     help='only used if rerun_kpca and kpca_kernel=\'gaussian\'')
 parser.add_argument('--kpca_default_kernel_Dmax', type=float,
                     help='only used if rerun_kpca and kpca_kernel==None')
+parser.add_argument('--kpca_solver', default='exact',
+                    choices=['exact', 'randomized', 'nystroem'],
+                    help='only used if rerun_kpca. "randomized" uses a'
+                    ' randomized eigensolver on the full kernel matrix;'
+                    ' "nystroem" only computes TCRdists to'
+                    ' --kpca_num_landmarks randomly chosen clonotypes, which'
+                    ' scales to much larger datasets')
+parser.add_argument('--kpca_num_landmarks', type=int, default=2000,
+                    help='only used if rerun_kpca and kpca_solver=nystroem')
 
 # option to save a checkpoint file for looking at umaps, clusters during analysis
 parser.add_argument('--checkpoint', action='store_true',
@@ -374,6 +408,8 @@ if args.restart is None: ################################## load GEX/TCR data
             outfile=args.kpca_file,
             gaussian_kernel_sdev = args.kpca_gaussian_kernel_sdev,
             force_Dmax = args.kpca_default_kernel_Dmax,
+            kpca_solver = args.kpca_solver,
+            num_landmarks = args.kpca_num_landmarks,
         )
 
     adata = conga.preprocess.read_dataset(
@@ -412,6 +448,8 @@ if args.restart is None: ################################## load GEX/TCR data
             force_Dmax=args.kpca_default_kernel_Dmax,
             tcrs=tcrs,
             return_pcs = True,
+            kpca_solver = args.kpca_solver,
+            num_landmarks = args.kpca_num_landmarks,
         )
         adata.obsm['X_pca_tcr'] = kpcs
 
@@ -763,6 +801,7 @@ all_nbrs, nndists_gex, nndists_tcr = conga.preprocess.calc_nbrs(
     nbr_frac_for_nndists = nbr_frac_for_nndists,
     obsm_tag_tcr = obsm_tag_tcr,
     use_exact_tcrdist_nbrs = args.use_exact_tcrdist_nbrs,
+    nbr_engine = args.nbr_engine,
 )
 
 
@@ -772,7 +811,7 @@ if args.analyze_junctions:
     new_tcrs = conga.tcrdist.tcr_sampler.find_alternate_alleles_for_tcrs(
         adata.uns['organism'], tcrs, verbose=False)
     junctions_df = conga.tcrdist.tcr_sampler.parse_tcr_junctions(
-        adata.uns['organism'], new_tcrs)
+        adata.uns['organism'], new_tcrs, n_jobs=args.n_jobs)
 
     num_inserts = (np.array(junctions_df.a_insert) +
                    np.array(junctions_df.vd_insert) +
@@ -822,7 +861,8 @@ if args.verbose_nbrs:
 ###############################################################################
 
 if (args.match_to_tcr_database and
-    (args.tcr_database_tsvfile or adata.uns['organism'] == 'human')):
+    (args.tcr_database_tsvfile or args.tcr_database_indexfile or
+     adata.uns['organism'] == 'human')):
     # we only have a built-in database for human alpha-beta tcrs right now
 
     # this function
@@ -832,6 +872,7 @@ if (args.match_to_tcr_database and
     conga.tcr_clumping.match_adata_tcrs_to_db_tcrs(
         adata,
         db_tcrs_tsvfile= args.tcr_database_tsvfile,
+        db_index_file= args.tcr_database_indexfile,
         outfile_prefix= args.outfile_prefix, # save results as tsvfile
         tmpfile_prefix= args.outfile_prefix,
         num_random_samples_for_bg_freqs=
@@ -851,6 +892,10 @@ if args.tcr_clumping: #########################################################
     radii = [24, 48, 72, 96] if args.radii_for_tcr_clumping is None else \
             args.radii_for_tcr_clumping
 
+    seed = args.tcr_clumping_seed
+    if seed is None and args.tcr_clumping_cache_dir is not None:
+        seed = 1 # need a seed for caching
+
     # results are stored in adata.uns['conga_results'][TCR_CLUMPING]
     # and also returned by this function:
     conga.tcr_clumping.assess_tcr_clumping(
@@ -861,6 +906,9 @@ if args.tcr_clumping: #########################################################
         num_random_samples= num_random_samples,
         pvalue_threshold= args.pvalue_threshold_for_tcr_clumping,
         also_find_clumps_within_gex_clusters= args.intra_cluster_tcr_clumping,
+        seed= seed,
+        background_cache_dir= args.tcr_clumping_cache_dir,
+        n_jobs= args.n_jobs,
     )
 
     nbrs_gex, nbrs_tcr = all_nbrs[ max(args.nbr_fracs) ]
@@ -879,7 +927,7 @@ if args.tcr_clumping: #########################################################
 if args.graph_vs_graph_stats: #################################################
     conga.correlations.compute_graph_vs_graph_stats(
         adata, all_nbrs, num_random_repeats=100,
-        outfile_prefix=args.outfile_prefix)
+        outfile_prefix=args.outfile_prefix, n_jobs=args.n_jobs)
 
     # cols = ('graph_overlap_type nbr_frac overlap expected_overlap'
     #         ' overlap_zscore').split()
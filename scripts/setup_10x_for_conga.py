@@ -25,6 +25,10 @@ parser.add_argument('--kpca_gaussian_kernel_sdev', default=100.0, type=float,
 parser.add_argument('--kpca_outfile')
 parser.add_argument('--condense_clonotypes_by_tcrdist', action='store_true')
 parser.add_argument('--tcrdist_threshold_for_condensing', type=float, default=50. )
+parser.add_argument('--write_bundle', action='store_true', help='Also write the '
+                    'clones, kernel PCs, and barcode mapping as a directory of .npy '
+                    'files next to the clones file, which run_conga.py will load '
+                    'in place of the text files (see scripts/make_conga_bundle.py)')
 parser.add_argument('--verbose', action='store_true')
 
 args = parser.parse_args()
@@ -62,7 +66,8 @@ assert args.kpca_kernel in [None, 'gaussian'] #None means classic default
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) ) # so we can import conga
 import conga
 from conga.preprocess import (make_tcrdist_kernel_pcs_file_from_clones_file,
-                              condense_clones_file_and_barcode_mapping_file_by_tcrdist)
+                              condense_clones_file_and_barcode_mapping_file_by_tcrdist,
+                              make_conga_bundle)
 
 from conga.tcrdist.make_10x_clones_file import make_10x_clones_file
 
@@ -121,6 +126,9 @@ else:
         output_distfile=output_distfile,
     )
 
+if args.write_bundle:
+    make_conga_bundle(output_clones_file, kpca_file=args.kpca_outfile)
+
 print(f'If this all worked you should be able to pass {output_clones_file} as the --clones_file argument to run_conga.py')
 print('DONE')
 
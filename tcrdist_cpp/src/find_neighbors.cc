@@ -31,11 +31,23 @@ int main(int argc, char** argv)
 		TCLAP::SwitchArg only_tcrdists_arg("m","only_tcrdists", "Just write the matrix of tcrdists. "
 			"Don't find neighbors. Matrix will be called <outfile_prefix>_tcrdists.txt", cmd, false);
 
+		TCLAP::SwitchArg binary_arg("B","binary", "Write the --num_nbrs or --only_tcrdists output "
+			"in binary format (see io.hh) to <outfile_prefix>_knn.bin or <outfile_prefix>_tcrdists.bin",
+			cmd, false);
+
+		TCLAP::SwitchArg stdout_arg("s","stdout", "Write the binary output to stdout rather than to a "
+			"file (implies --binary). Text messages go to stderr", cmd, false);
+
  		TCLAP::ValueArg<string> tcrs_file_arg("f","tcrs_file","TSV (tab separated values) "
 			"file containing TCRs for neighbor calculation. Should contain the 4 columns "
 			"'va_gene' 'cdr3a' 'vb_gene' 'cdr3b' (or alt fieldnames: 'va' and 'vb')", true,
 			"unk", "string", cmd);
 
+ 		TCLAP::ValueArg<string> target_tcrs_file_arg("g","target_tcrs_file","TSV file with a second set "
+			"of TCRs, same format as --tcrs_file. With --only_tcrdists, write the rectangular matrix of "
+			"tcrdists from the --tcrs_file TCRs (rows) to these TCRs (columns)", false,
+			"", "string", cmd);
+
  		TCLAP::ValueArg<string> agroups_file_arg("a","agroups_file","np.savetxt output "
 			"(ie, one integer per line) ith the agroups information so we can exclude same-group neighbors", false,
 			"", "string", cmd);
@@ -51,11 +63,21 @@ int main(int argc, char** argv)
 		int const threshold_int( threshold_arg.getValue() );
 		bool const only_tcrdists( only_tcrdists_arg.getValue() );
 		string const tcrs_file( tcrs_file_arg.getValue() );
+		string const target_tcrs_file( target_tcrs_file_arg.getValue() );
 		string const agroups_file( agroups_file_arg.getValue() );
 		string const bgroups_file( bgroups_file_arg.getValue() );
 		string const outfile_prefix( outfile_prefix_arg.getValue());
+		bool const to_stdout( stdout_arg.getValue() );
+		bool const binary( binary_arg.getValue() || to_stdout );
 
 		runtime_assert( only_tcrdists || ( num_nbrs>0 && threshold_int==-1) || (num_nbrs==0 && threshold_int >=0 ) );
+		runtime_assert( !binary || only_tcrdists || num_nbrs>0 ); // no binary format for --threshold
+		runtime_assert( target_tcrs_file.empty() || only_tcrdists );
+
+		// if the binary output goes to stdout, send the text messages to stderr
+		streambuf * const stdout_buf( cout.rdbuf() );
+		if ( to_stdout ) cout.rdbuf( cerr.rdbuf() );
+		ostream binary_stdout( stdout_buf );
 
 		TCRdistCalculator const atcrdist('A', db_filename), btcrdist('B', db_filename);
 
@@ -64,6 +86,14 @@ int main(int argc, char** argv)
 
 		Size const num_tcrs(tcrs.size());
 
+		// the columns of the --only_tcrdists matrix
+		vector< PairedTCR > target_tcrs_storage;
+		if ( target_tcrs_file.size() ) {
+			read_paired_tcrs_from_tsv_file(target_tcrs_file, atcrdist, btcrdist, target_tcrs_storage);
+		}
+		vector< PairedTCR > const & target_tcrs( target_tcrs_file.size() ? target_tcrs_storage : tcrs );
+		Size const num_target_tcrs(target_tcrs.size());
+
 		Sizes agroups( agroups_file.size() ? read_groups_from_file(agroups_file) : Sizes() );
 		Sizes bgroups( bgroups_file.size() ? read_groups_from_file(bgroups_file) : Sizes() );
 		if ( agroups.empty() ) {
@@ -79,7 +109,38 @@ int main(int argc, char** argv)
 
 		Size const BIG_DIST(10000);
 
-		if ( only_tcrdists ) {
+		if ( only_tcrdists && binary ) {
+			string const filename( outfile_prefix+"_tcrdists.bin" );
+			ofstream binary_file;
+			if ( !to_stdout ) {
+				binary_file.open( filename, ios::binary );
+				cout << "making " << filename << endl;
+			}
+			ostream & out( to_stdout ? binary_stdout : binary_file );
+			write_binary_header( "TDMX", num_tcrs, num_target_tcrs, out );
+
+			Sizes dists( num_target_tcrs );
+			vector< char > buffer;
+			buffer.reserve( 2*num_target_tcrs );
+			for ( Size ii=0; ii< num_tcrs; ++ii ) {
+				if ( ii && ii%100==0 ) cerr << '.';
+				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
+
+				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
+				for ( Size jj=0; jj< num_target_tcrs; ++jj ) {
+					// NOTE we round down to an integer here!
+					dists[jj] = Size( 0.5 + atcrdist(atcr, target_tcrs[jj].first) +
+						btcrdist(btcr, target_tcrs[jj].second) );
+				}
+				buffer.clear();
+				append_binary_distances( dists, buffer );
+				out.write( &buffer[0], buffer.size() );
+			}
+			cerr << endl;
+			out.flush();
+			if ( !to_stdout ) binary_file.close();
+
+		} else if ( only_tcrdists ) {
 			ofstream out(outfile_prefix+"_tcrdists.txt");
 			cout << "making " << outfile_prefix+"_tcrdists.txt" << endl;
 			for ( Size ii=0; ii< num_tcrs; ++ii ) {
@@ -88,7 +149,7 @@ int main(int argc, char** argv)
 
 				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
 				bool first(true);
-				for ( PairedTCR const & other_tcr : tcrs ) {
+				for ( PairedTCR const & other_tcr : target_tcrs ) {
 					// NOTE we round down to an integer here!
 					if ( first ) first=false;
 					else out << ' ';
@@ -101,11 +162,22 @@ int main(int argc, char** argv)
 
 		} else if ( num_nbrs > 0 ) {
 			// open the outfiles
-			ofstream out_indices(outfile_prefix+"_knn_indices.txt");
-			ofstream out_distances(outfile_prefix+"_knn_distances.txt");
-
-			cout << "making " << outfile_prefix+"_knn_indices.txt" << " and " <<
-				outfile_prefix+"_knn_distances.txt" << endl;
+			ofstream out_indices, out_distances, binary_file;
+			if ( !binary ) {
+				out_indices.open(outfile_prefix+"_knn_indices.txt");
+				out_distances.open(outfile_prefix+"_knn_distances.txt");
+				cout << "making " << outfile_prefix+"_knn_indices.txt" << " and " <<
+					outfile_prefix+"_knn_distances.txt" << endl;
+			} else if ( !to_stdout ) {
+				binary_file.open(outfile_prefix+"_knn.bin", ios::binary);
+				cout << "making " << outfile_prefix+"_knn.bin" << endl;
+			}
+			ostream & out_binary( to_stdout ? binary_stdout : binary_file );
+			vector< char > buffer;
+			if ( binary ) {
+				write_binary_header( "TDKN", num_tcrs, num_nbrs, out_binary );
+				buffer.reserve( 6*num_nbrs );
+			}
 
 			Sizes dists(num_tcrs), sortdists(num_tcrs); // must be a better way to do this...
 			Sizes knn_indices, knn_distances;
@@ -166,6 +238,13 @@ int main(int argc, char** argv)
 				runtime_assert(knn_indices.size() == num_nbrs);
 				runtime_assert(knn_distances.size() == num_nbrs);
 				// save to files:
+				if ( binary ) {
+					buffer.clear();
+					append_binary_indices( knn_indices, buffer );
+					append_binary_distances( knn_distances, buffer );
+					out_binary.write( &buffer[0], buffer.size() );
+					continue;
+				}
 				for ( Size j=0; j<num_nbrs; ++j ) {
 					if (j) {
 						out_indices << ' ';
@@ -179,8 +258,13 @@ int main(int argc, char** argv)
 			}
 			cerr << endl;
 			// close the output files
-			out_indices.close();
-			out_distances.close();
+			if ( binary ) {
+				out_binary.flush();
+				if ( !to_stdout ) binary_file.close();
+			} else {
+				out_indices.close();
+				out_distances.close();
+			}
 
 		} else { // using threshold definition of nbr-ness
 			// open the outfiles
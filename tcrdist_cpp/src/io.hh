@@ -158,5 +158,70 @@ read_groups_from_file( string const & filename )
 }
 
 
+//////////////////////////////////// BINARY OUTPUT
+//
+// format used by find_neighbors --binary: a 12 byte header with a 4 character
+// tag ("TDKN" for knn output, "TDMX" for a distance matrix) and the number of
+// rows and columns as little-endian uint32. Then one record per row: for TDKN,
+// num_cols int32 nbr indices followed by num_cols uint16 distances; for TDMX,
+// num_cols uint16 distances. All little-endian.
+//
+
+// append the low num_bytes bytes of val to buffer, little-endian
+inline
+void
+append_little_endian(
+	Size const val,
+	Size const num_bytes,
+	vector< char > & buffer
+)
+{
+	for ( Size i=0; i<num_bytes; ++i ) {
+		buffer.push_back( char( ( val >> (8*i) ) & 0xff ) );
+	}
+}
+
+void
+write_binary_header(
+	string const & tag,
+	Size const num_rows,
+	Size const num_cols,
+	ostream & out
+)
+{
+	runtime_assert( tag.size() == 4 );
+	vector< char > buffer( tag.begin(), tag.end() );
+	append_little_endian( num_rows, 4, buffer );
+	append_little_endian( num_cols, 4, buffer );
+	out.write( &buffer[0], buffer.size() );
+}
+
+// distances are stored as uint16
+inline
+void
+append_binary_distances(
+	Sizes const & distances,
+	vector< char > & buffer
+)
+{
+	for ( Size const d : distances ) {
+		runtime_assert( d < 65536 );
+		append_little_endian( d, 2, buffer );
+	}
+}
+
+inline
+void
+append_binary_indices(
+	Sizes const & indices,
+	vector< char > & buffer
+)
+{
+	for ( Size const i : indices ) {
+		runtime_assert( i < 2147483648 );
+		append_little_endian( i, 4, buffer );
+	}
+}
+
 
 #endif